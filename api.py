@@ -1,63 +1,50 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http import HTTPStatus
 import json
 import asyncio
+import concurrent.futures
 import sys
 import socket
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime
 import os
+import time
 
-def makeAPIHandler(queue, logger, token):
-    class APIHandler(BaseHTTPRequestHandler):
-        def __init__(self, *args, **kwargs):
-            super(APIHandler, self).__init__(*args, **kwargs)
-
-        def do_GET(self):
-            parsed_path = urlparse(self.path).path
-            if parsed_path == "/":
-                self.send_response(200)
-                self.send_header('content-type', 'text')
-                self.end_headers()
-                self.wfile.write('room\nhello'.encode('utf-8'))
-            else:
-                self.send_response(404)
-                self.send_header('content-type', 'text')
-                self.end_headers()
-                self.wfile.write('room\n404 not found'.encode('utf-8'))
-
-        def do_POST(self):
-            res = { 'status': 0, 'type': 'none', 'message': 'none' }
-            got = { }
-            try:
-                s = self.rfile.read(int(self.headers.get('content-length'))).decode('utf-8')
-                got = json.loads(s)
-                if got['token'] is not None and got['token'] == token:
-                    self.queue.put(got)
-                    res = { 'status': 200 }
-                else:
-                    res = { 'status': 403 }
-            except Exception as e:
-                res = { 'status': 500 }
-                self.logger.exception('APIHandler.do_POST()', stack_info=True)
-
-            self.send_response(res['status'])
-            self.send_header('content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps(res).encode('utf-8'))
-    ret = APIHandler
-    ret.queue = queue
-    ret.logger = logger
-    return ret
+import dispatcher
+import history
+import metrics
 
+MAX_HEADER = 8 * 1024       # リクエスト行とヘッダの最大長
+MAX_BODY = 64 * 1024        # ボディの最大長
+REQUEST_TIMEOUT = 10        # リクエストを読み終えるまでの秒数
+KEEPALIVE_TIMEOUT = 30      # 次のリクエストを待つ秒数
+WAIT_TIMEOUT = 60           # wait=trueでコマンドの完了を待つ秒数
+
+class HTTPError(Exception):
+    def __init__(self, status, message=None):
+        super(HTTPError, self).__init__(message or HTTPStatus(status).phrase)
+        self.status = status
+
+# 時刻(epoch秒またはISO 8601)
+def parsetime(s):
+    try:
+        return float(s)
+    except ValueError:
+        return datetime.fromisoformat(s).timestamp()
+
+# asyncioのHTTP/1.1サーバ
+#  同時接続、keep-alive、サイズ制限、タイムアウトに対応
+#  POSTはMain.queueにコマンドを入れる。wait=trueならMainが実行し終えるまで待ち、
+#  結果と待ち時間を返す
 class API():
-    def __init__(self, loop, queue, logger, token):
+    def __init__(self, loop, queue, logger, token, rollups=None):
         self.loop = loop
         self.queue = queue
         self.logger = logger
         self.token = token
+        self.rollups = rollups
 
     def run(self):
         asyncio.set_event_loop(self.loop)
-        handler = makeAPIHandler(self.queue, self.logger, self.token)
         port = 80
         try:
             port = int(os.environ.get('PORT'))
@@ -65,7 +52,180 @@ class API():
             pass
         if port is None:
             port = 80
-        server = HTTPServer(('', port), handler)
+        self.loop.run_until_complete(asyncio.start_server(self.handle, '', port, limit=MAX_HEADER))
         self.logger.debug('listen api at {0}:{1}'.format(socket.gethostbyname_ex(socket.gethostname()), port))
-        server.serve_forever()
+        self.loop.run_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            keepalive = True
+            while keepalive:
+                # 次のリクエスト行を待つ
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), KEEPALIVE_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                except asyncio.LimitOverrunError:
+                    await self.respond(writer, 431, 'text', b'room\n431 request header fields too large', False)
+                    break
+                try:
+                    (method, path, version, headers) = self.parsehead(head)
+                    keepalive = self.keepalive(version, headers)
+                    length = self.contentlength(headers)
+                    if length is None:
+                        # ボディの終わりがわからないので切る
+                        keepalive = False
+                        raise HTTPError(400, 'bad content-length')
+                    if length > MAX_BODY:
+                        keepalive = False
+                        raise HTTPError(413)
+                    body = await asyncio.wait_for(reader.readexactly(length), REQUEST_TIMEOUT)
+                    keepalive = await self.route(writer, method, path, version, body, keepalive)
+                except HTTPError as e:
+                    await self.respond(writer, e.status, 'text', f'room\n{e.status} {e}'.encode('utf-8'), keepalive)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                except (ConnectionError, asyncio.CancelledError):
+                    raise
+                except Exception:
+                    self.logger.exception('API.handle()', stack_info=True)
+                    await self.respond(writer, 500, 'application/json', json.dumps({ 'status': 500 }).encode('utf-8'), False)
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    def parsehead(self, head):
+        try:
+            lines = head.decode('latin-1').rstrip('\r\n').split('\r\n')
+            (method, path, version) = lines[0].split(' ')
+            headers = {}
+            for line in lines[1:]:
+                (k, v) = line.split(':', 1)
+                headers[k.strip().lower()] = v.strip()
+            return method, path, version, headers
+        except ValueError:
+            raise HTTPError(400)
+
+    # content-lengthの値(なければ0、数でないか負ならNone)
+    def contentlength(self, headers):
+        value = headers.get('content-length', '0')
+        if not value.isdigit():
+            return None
+        return int(value)
+
+    def keepalive(self, version, headers):
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+    async def respond(self, writer, status, ctype, body, keepalive, headers={}):
+        lines = [f'HTTP/1.1 {status} {HTTPStatus(status).phrase}',
+            f'content-type: {ctype}',
+            f'content-length: {len(body)}',
+            'connection: ' + ('keep-alive' if keepalive else 'close')]
+        lines += [f'{k}: {v}' for k, v in headers.items()]
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+        await writer.drain()
+
+    # 応答したあとも接続を続けるかを返す
+    async def route(self, writer, method, path, version, body, keepalive):
+        u = urlparse(path)
+        q = { k: v[0] for k, v in parse_qs(u.query).items() }
+        if method == 'GET' and u.path == '/':
+            await self.respond(writer, 200, 'text', 'room\nhello'.encode('utf-8'), keepalive)
+        elif method == 'GET' and u.path == '/metrics':
+            if q.get('token') != self.token:
+                raise HTTPError(403, 'forbidden')
+            await self.respond(writer, 200, 'text/plain; version=0.0.4', metrics.exposition().encode('utf-8'), keepalive)
+        elif method == 'GET' and u.path == '/history' and self.rollups is not None:
+            return await self.history(writer, q, version, keepalive)
+        elif method == 'POST':
+            (status, res) = await self.command(body, q)
+            await self.respond(writer, status, 'application/json', json.dumps(res).encode('utf-8'), keepalive)
+        elif method in ('GET', 'POST'):
+            raise HTTPError(404, 'not found')
+        else:
+            raise HTTPError(405, 'method not allowed')
+        return keepalive
+
+    # POST {"token": ..., "command": ..., "wait": true}
+    #  wait=trueかクエリ?wait=1でコマンドの完了を待つ
+    async def command(self, body, q):
+        try:
+            got = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return 400, { 'status': 400 }
+        if not isinstance(got, dict) or got.get('token') is None or got.get('token') != self.token:
+            return 403, { 'status': 403 }
+        if got.get('command') not in dispatcher.COMMANDS:
+            return 400, { 'status': 400, 'error': 'unknown command' }
+        wait = bool(got.pop('wait', False)) or q.get('wait') in ('1', 'true')
+        got['enqueued'] = time.time()
+        if not wait:
+            self.queue.put(got)
+            return 200, { 'status': 200 }
+
+        future = concurrent.futures.Future()
+        got['future'] = future
+        self.queue.put(got)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(future), WAIT_TIMEOUT)
+            return 200, { 'status': 200, 'result': result, 'latency': time.time() - got['enqueued'] }
+        except asyncio.TimeoutError:
+            return 504, { 'status': 504, 'latency': time.time() - got['enqueued'] }
+        except Exception as e:
+            return 500, { 'status': 500, 'error': str(e), 'latency': time.time() - got['enqueued'] }
+
+    # GET /history?from=&to=&step=&format=json|csv&token=
+    #  from, to: epoch秒かISO 8601(既定は直近1日)、step: 秒(既定は1000点程度)
+    #  HTTP/1.1ではchunkedで少しずつ返す(それ以外は送り終えたら切る)
+    async def history(self, writer, q, version, keepalive):
+        if q.get('token') != self.token:
+            raise HTTPError(403, 'forbidden')
+        try:
+            end = parsetime(q['to']) if 'to' in q else time.time()
+            start = parsetime(q['from']) if 'from' in q else end - 24 * 60 * 60
+            step = float(q['step']) if 'step' in q else (end - start) / 1000
+            fmt = q.get('format', 'json')
+            if fmt not in ('json', 'csv') or end < start:
+                raise ValueError(fmt)
+        except ValueError:
+            raise HTTPError(400, 'bad request')
+
+        chunked = version == 'HTTP/1.1'
+        if not chunked:
+            keepalive = False
+        lines = ['HTTP/1.1 200 OK',
+            'content-type: ' + ('text/csv' if fmt == 'csv' else 'application/json'),
+            'connection: ' + ('keep-alive' if keepalive else 'close')]
+        if chunked:
+            lines.append('transfer-encoding: chunked')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+        (source, columns, rows) = self.rollups.query(start, end, step)
+        buf = []
+        size = 0
+        for chunk in history.format_rows(fmt, source, columns, rows):
+            buf.append(chunk)
+            size += len(chunk)
+            if size > 65536:
+                await self.writechunk(writer, ''.join(buf).encode('utf-8'), chunked)
+                buf = []
+                size = 0
+        await self.writechunk(writer, ''.join(buf).encode('utf-8'), chunked)
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+        return keepalive
 
+    async def writechunk(self, writer, data, chunked):
+        if not data:
+            return
+        if chunked:
+            writer.write(b'%x\r\n' % len(data) + data + b'\r\n')
+        else:
+            writer.write(data)
+        await writer.drain()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmark of irrp.carrier against the old per-cycle loop
+
+python3 bench/carrier.py
+
+First checks that the pulses are identical for a range of carrier
+frequencies and mark lengths, then times a 9 ms leader at 38 kHz.
+pigpio comes from bench/fake, no Pi is needed.
+"""
+
+import os
+import sys
+import timeit
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH, '..'))
+sys.path.insert(0, os.path.join(BENCH, 'fake'))
+import irrp
+import pigpio
+
+def loop_carrier(gpio, frequency, micros):
+    # The carrier irrp.py used before carrier_timings(), kept for comparison
+    wf = []
+    cycle = 1000.0 / frequency
+    cycles = int(round(micros/cycle))
+    on = int(round(cycle / 2.0))
+    sofar = 0
+    for c in range(cycles):
+        target = int(round((c+1)*cycle))
+        sofar += on
+        off = target - sofar
+        sofar += off
+        wf.append(pigpio.pulse(1<<gpio, 0, on))
+        wf.append(pigpio.pulse(0, 1<<gpio, off))
+    return wf
+
+def timings(wf):
+    return [(p.gpio_on, p.gpio_off, p.delay) for p in wf]
+
+def check():
+    n = 0
+    for freq in [30.0, 33.0, 36.0, 36.7, 38.0, 40.0, 56.0]:
+        for micros in range(0, 20000, 37):
+            if timings(irrp.carrier(13, freq, micros)) != timings(loop_carrier(13, freq, micros)):
+                raise Exception(f'carrier differs at {freq} kHz {micros} us')
+            n += 1
+    print(f'identical pulses for {n} marks (numpy: {irrp.numpy is not None})')
+
+def main():
+    check()
+    number = 200
+    cases = [
+        ('per-cycle loop', lambda: loop_carrier(13, 38.0, 9000)),
+        ('bulk, uncached', lambda: irrp._carrier.__wrapped__(13, 38.0, 9000)),
+        ('bulk, memoised', lambda: irrp.carrier(13, 38.0, 9000)),
+    ]
+    for name, f in cases:
+        t = min(timeit.repeat(f, number=number, repeat=5)) / number
+        print(f'{name:16} {t*1e6:9.1f} us per 9 ms mark')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark irrp.compress against the old n-gram compressor
+
+python3 bench/compress.py [--old-max 1000]
+
+Synthetic waves of 600-2000 entries are made of air conditioner like
+frames (leader, 2 marks x 2 spaces bits, trailer) repeated with a
+partial last frame.  Each chain is expanded again to check it plays
+the same waves.  pigpio comes from bench/fake, no Pi is needed.
+"""
+
+import argparse
+import collections
+import os
+import random
+import sys
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH, '..'))
+sys.path.insert(0, os.path.join(BENCH, 'fake'))
+import irrp
+
+def ngram_compress(wave):
+    # The compressor irrp.py used before find_runs(), kept for comparison
+    if len(wave) <= irrp.ENTRY_MAX:
+        return wave
+
+    def make_ngram(l, n):
+        ngrams = list(zip(*(l[i:] for i in range(n))))
+        return(collections.Counter(ngrams).most_common())
+
+    def depth_of_tuple(t):
+        if isinstance(t, tuple):
+            if t == tuple() : return 1
+            return 1 + max(depth_of_tuple(item) for item in t)
+        else:
+            return 0
+
+    def nonloop_decode(wave, i, t):
+        wave[i:i+1] = [t[num] for num in range(len(t)-1)]*t[-1]
+        return wave
+
+    def loop_decode(wave, i, t):
+        repeat_unit = [t[num] for num in range(len(t)-1)]
+        code = [255, 0, 255, 1, t[-1], 0]
+        code[2:2] = repeat_unit
+        wave[i:i+1] = code
+        return wave
+
+    wave = wave[:]
+    for wl in range(2, len(wave)//2):
+        pre_len = 0
+        while len(wave) != pre_len:
+            pre_len = len(wave)
+            ngrams = make_ngram(wave, wl)
+            for ngram in ngrams:
+                ngram_wave = ngram[0]
+                ngram_freq = ngram[1]
+                if ngram_freq >= 2:
+                    for i in range(len(wave) - len(ngram_wave)):
+                        if tuple(wave[i:i+wl]) == ngram_wave:
+                            for rn in range(2, ngram_freq):
+                                if wave[i:i+(wl*rn)] != list(ngram_wave * rn):
+                                    if wl*(rn-2) > 6 or depth_of_tuple(ngram_wave) >= 2 and rn-1 >= 2 :
+                                        loop_code = list(ngram_wave) + [rn-1]
+                                        wave[i:i+((rn-1)*wl)] = [tuple(loop_code)]
+                                    break
+
+    rest_loop_count = irrp.LOOP_MAX
+    for d in range(depth_of_tuple(tuple(wave))):
+        for i,item in enumerate(wave):
+            if isinstance(item, tuple):
+                if rest_loop_count <= 0:
+                    nonloop_decode(wave, i, item)
+                elif depth_of_tuple(item) > 1:
+                    loop_decode(wave, i, item)
+                    rest_loop_count -= 1
+    efficiencies = sorted(set([(len(item)-1)*(item[-1]-1) for item in wave if isinstance(item, tuple)]), reverse=True)
+    for eff in efficiencies:
+        for i,item in enumerate(wave):
+            if isinstance(item, tuple):
+                if rest_loop_count <= 0:
+                    nonloop_decode(wave, i, item)
+                elif (len(item)-1)*(item[-1]-1) == eff:
+                    loop_decode(wave, i, item)
+                    rest_loop_count -= 1
+    return wave
+
+# Play a chain back into the list of wave ids it sends
+def expand(chain):
+    out = []
+    starts = []
+    i = 0
+    while i < len(chain):
+        if chain[i] == 255 and chain[i+1] == 0:
+            starts.append(len(out))
+            i += 2
+        elif chain[i] == 255 and chain[i+1] == 1:
+            block = out[starts.pop():]
+            out.extend(block * (chain[i+2] + 256*chain[i+3] - 1))
+            i += 4
+        else:
+            out.append(chain[i])
+            i += 1
+    return out
+
+def loops(chain):
+    return sum(1 for i in range(len(chain)-1) if chain[i] == 255 and chain[i+1] == 0)
+
+# wave ids: 0 leader mark, 1 leader space, 2 bit mark, 3/4 bit spaces, 5 trailer
+def synthetic(length, rng):
+    bits = [rng.randint(0, 1) for i in range(rng.randint(48, 140))]
+    frame = [0, 1] + [x for b in bits for x in (2, 3 if b else 4)] + [2, 5]
+    return (frame * (length // len(frame) + 1))[:length]
+
+def bench(f, wave):
+    start = time.perf_counter()
+    chain = f(wave)
+    elapsed = time.perf_counter() - start
+    if expand(chain) != wave:
+        raise Exception('chain does not expand to the original wave')
+    return elapsed, chain
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('--old-max', type=int, default=1000,
+        help='skip the old compressor above this length, it is very slow')
+    args = p.parse_args()
+
+    rng = random.Random(args.seed)
+    print('{:>6} {:>10} {:>6} {:>5} {:>10} {:>6} {:>5}'.format(
+        'length', 'new ms', 'chain', 'loops', 'old ms', 'chain', 'loops'))
+    for length in [600, 800, 1000, 1500, 2000]:
+        wave = synthetic(length, rng)
+        t, chain = bench(irrp.compress, wave)
+        line = '{:>6} {:>10.1f} {:>6} {:>5}'.format(length, t*1000, len(chain), loops(chain))
+        if length <= args.old_max:
+            t, chain = bench(ngram_compress, wave)
+            line += ' {:>10.1f} {:>6} {:>5}'.format(t*1000, len(chain), loops(chain))
+        print(line)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""
+Stand-in for the pigpio module, for running on machines without pigpiod
+
+Only what room uses is implemented.  Every call costs COMMAND_S like a
+round trip to pigpiod over its socket.  The wave engine keeps the
+created waves, enforces the pulse, control block and wave id limits of
+a Pi 4 and plays chains (loops included) in real time unless REALTIME is
+False, in which case wave_tx_busy() is never busy.
+
+Wave resources are allocated as pigpiod does: a new wave goes on top of
+the others and takes the id after the highest one, a deleted wave only
+gives its pulses and id back once every higher numbered wave has been
+deleted too, or when a new wave of exactly the same size reuses it.
+
+Buttons are pressed with pi.press(gpio, seconds), which calls the
+registered callbacks with the edges and ticks pigpiod would.
+"""
+
+import threading
+import time
+
+INPUT = 0
+OUTPUT = 1
+
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+TIMEOUT = 2
+
+# Round trip of one pigpiod command
+COMMAND_S = 0.0001
+REALTIME = True
+
+# Limits of pigpio 79 on a Pi 4
+MAX_PULSES = 12000
+MAX_CBS = 25016
+MAX_WAVES = 250
+
+class error(Exception):
+    pass
+
+class pulse:
+    def __init__(self, gpio_on, gpio_off, delay):
+        self.gpio_on = gpio_on
+        self.gpio_off = gpio_off
+        self.delay = delay
+
+def tick():
+    return int(time.monotonic() * 1000000) & 0xffffffff
+
+def tickDiff(t1, t2):
+    return (t2 - t1) & 0xffffffff
+
+class _callback:
+    def __init__(self, pi, gpio, edge, func):
+        self.pi = pi
+        self.gpio = gpio
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        if self in self.pi.callbacks:
+            self.pi.callbacks.remove(self)
+
+class pi:
+    def __init__(self, host='localhost', port=8888):
+        self.connected = True
+        self.commands = 0
+        self.modes = {}
+        self.levels = {}
+        self.callbacks = []
+        self.watchdogs = {}
+        self.lock = threading.Lock()
+        # wave id -> pulses, live waves
+        self.waves = {}
+        # wave id -> pulses, deleted but below a live wave
+        self.deleted = {}
+        self.pending = []
+        # wave_create calls that failed for lack of ids, pulses or CBs
+        self.rejected = 0
+        self.busy_until = 0
+        self.chains = 0
+        # Transmitted time of the last chain in micros
+        self.last_chain_us = 0
+
+    def _command(self):
+        self.commands += 1
+        if not self.connected:
+            raise error('pigpio not connected')
+        if COMMAND_S:
+            time.sleep(COMMAND_S)
+
+    def get_pigpio_version(self):
+        self._command()
+        return 79
+
+    def stop(self):
+        self.connected = False
+
+    # GPIO
+
+    def set_mode(self, gpio, mode):
+        self._command()
+        self.modes[gpio] = mode
+
+    def get_mode(self, gpio):
+        self._command()
+        return self.modes.get(gpio, INPUT)
+
+    def write(self, gpio, level):
+        self._command()
+        self.levels[gpio] = 1 if level else 0
+
+    def read(self, gpio):
+        self._command()
+        return self.levels.get(gpio, 1)
+
+    def set_glitch_filter(self, gpio, steady):
+        self._command()
+
+    def set_watchdog(self, gpio, wdog_timeout):
+        self._command()
+        timer = self.watchdogs.pop(gpio, None)
+        if timer is not None:
+            timer.cancel()
+        if wdog_timeout > 0:
+            timer = threading.Timer(wdog_timeout / 1000.0, self._fire, (gpio, TIMEOUT))
+            timer.daemon = True
+            self.watchdogs[gpio] = timer
+            timer.start()
+
+    def callback(self, user_gpio, edge=RISING_EDGE, func=None):
+        self._command()
+        cb = _callback(self, user_gpio, edge, func)
+        self.callbacks.append(cb)
+        return cb
+
+    def _fire(self, gpio, level):
+        t = tick()
+        if level != TIMEOUT:
+            self.levels[gpio] = level
+        for cb in list(self.callbacks):
+            if cb.gpio != gpio or cb.func is None:
+                continue
+            if level == TIMEOUT or cb.edge == EITHER_EDGE or \
+                (cb.edge == RISING_EDGE) == (level == 1):
+                cb.func(gpio, level, t)
+
+    def press(self, gpio, seconds=0.05):
+        """
+        Press an active low button for seconds and release it.
+        """
+        self._fire(gpio, 0)
+        time.sleep(seconds)
+        self._fire(gpio, 1)
+
+    # Waves
+
+    def wave_add_new(self):
+        self._command()
+        self.pending = []
+
+    def wave_add_generic(self, pulses):
+        self._command()
+        if len(self.pending) + len(pulses) > MAX_PULSES:
+            raise error("'too many pulses'")
+        self.pending.extend((p.gpio_on, p.gpio_off, p.delay) for p in pulses)
+        return len(self.pending)
+
+    def wave_create(self):
+        self._command()
+        if not self.pending:
+            raise error("'attempt to create an empty waveform'")
+        # A deleted wave of exactly the same size is reused in place
+        for (wid, w) in sorted(self.deleted.items()):
+            if len(w) == len(self.pending):
+                del self.deleted[wid]
+                break
+        else:
+            if self.wave_get_pulses() + len(self.pending) > MAX_PULSES or \
+                self.wave_get_cbs() + 2 * len(self.pending) > MAX_CBS:
+                self.rejected += 1
+                raise error("'No more CBs for waveform'")
+            wid = max(list(self.waves) + list(self.deleted), default=-1) + 1
+            if wid >= MAX_WAVES:
+                self.rejected += 1
+                raise error("'No more waveforms'")
+        self.waves[wid] = self.pending
+        self.pending = []
+        return wid
+
+    def wave_delete(self, wave_id):
+        self._command()
+        if wave_id not in self.waves:
+            raise error("'bad wave id'")
+        self.deleted[wave_id] = self.waves.pop(wave_id)
+        # Resources come back only from the top
+        top = max(self.waves, default=-1)
+        for wid in [wid for wid in self.deleted if wid > top]:
+            del self.deleted[wid]
+
+    def wave_clear(self):
+        self._command()
+        self.waves = {}
+        self.deleted = {}
+        self.pending = []
+
+    def wave_get_max_pulses(self):
+        self._command()
+        return MAX_PULSES
+
+    def wave_get_max_cbs(self):
+        self._command()
+        return MAX_CBS
+
+    # Pulses in use, deleted waves below live ones included
+    def wave_get_pulses(self):
+        return sum(len(w) for w in self.waves.values()) + sum(len(w) for w in self.deleted.values())
+
+    def wave_get_cbs(self):
+        return 2 * self.wave_get_pulses()
+
+    def _duration(self, chain):
+        # Micros of a chain, loops (255 0 ... 255 1 x y) may nest
+        total = 0
+        stack = []
+        i = 0
+        while i < len(chain):
+            c = chain[i]
+            if c == 255:
+                cmd = chain[i + 1]
+                if cmd == 0:
+                    stack.append(total)
+                    total = 0
+                    i += 2
+                elif cmd == 1:
+                    count = chain[i + 2] + 256 * chain[i + 3]
+                    total = stack.pop() + total * count
+                    i += 4
+                elif cmd == 2:
+                    total += chain[i + 2] + 256 * chain[i + 3]
+                    i += 4
+                else:
+                    raise error("'bad chain command'")
+            else:
+                if c not in self.waves:
+                    raise error("'bad wave id'")
+                total += sum(p[2] for p in self.waves[c])
+                i += 1
+        if stack:
+            raise error("'chain loop counter error'")
+        return total
+
+    def wave_chain(self, data):
+        self._command()
+        self.last_chain_us = self._duration(list(data))
+        self.chains += 1
+        self.busy_until = time.monotonic() + (self.last_chain_us / 1000000.0 if REALTIME else 0)
+
+    def wave_tx_busy(self):
+        self._command()
+        return 1 if time.monotonic() < self.busy_until else 0
+
+    def wave_tx_stop(self):
+        self._command()
+        self.busy_until = 0
@@ -0,0 +1,145 @@
+"""
+Local stand-in for the radiko endpoints room uses
+
+    server = radiko.Radiko(latency=0.05)
+    server.start()
+    radio.RADIKO_HTTP = radio.RADIKO_HTTPS = server.url
+    radio.PLAYER_URL = server.url + radiko.PLAYER_PATH
+
+Serves the player swf (zlib compressed, the key in DefineBinaryData 12,
+ETag and Last-Modified so that a conditional GET gets 304), auth1_fms
+(token and key offset/length headers), auth2_fms (checks the partial
+key, answers the area), program/today and station/stream/{id}.xml.
+Each response waits latency seconds like a round trip to Tokyo and
+every path is counted in requests.
+"""
+
+import base64
+import collections
+import http.server
+import os
+import random
+import struct
+import threading
+import time
+import zlib
+
+PLAYER_PATH = '/apps/js/flash/myplayer-release.swf'
+STATIONS = ['TBS', 'QRR', 'LFR', 'RN1', 'RN2', 'INT', 'FMT', 'FMJ', 'JORF', 'BAYFM78', 'NACK5', 'YFM', 'HOUSOU-DAIGAKU', 'JOAK', 'JOAK-FM']
+AREA = 'JP13'
+
+# swf with a DefineBinaryData tag holding key
+def make_swf(key, tag=12, padding=200000):
+    # RECT of 5 bit fields (nbits 15), frame rate and count
+    rect = bytes([15 << 3]) + bytes(8)
+    body = rect + struct.pack('<HH', 24 << 8, 1)
+    # Something to skip before the key, as in the real player
+    filler = os.urandom(padding)
+    body += struct.pack('<HI', (87 << 6) | 0x3f, 6 + len(filler)) + struct.pack('<HI', 1, 0) + filler
+    body += struct.pack('<HI', (87 << 6) | 0x3f, 6 + len(key)) + struct.pack('<HI', tag, 0) + key
+    body += struct.pack('<H', 0)
+    return b'CWS' + struct.pack('<BI', 10, 8 + len(body)) + zlib.compress(body)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=b'', headers={}):
+        radiko = self.server.radiko
+        if radiko.latency:
+            time.sleep(radiko.latency)
+        self.send_response(status)
+        for (k, v) in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        radiko = self.server.radiko
+        path = self.path.split('?')[0]
+        radiko.count(path)
+        if path == PLAYER_PATH:
+            if self.headers.get('If-None-Match') == radiko.etag:
+                self.reply(304, headers={'ETag': radiko.etag})
+            else:
+                self.reply(200, radiko.swf, {
+                    'Content-Type': 'application/x-shockwave-flash',
+                    'ETag': radiko.etag,
+                    'Last-Modified': radiko.modified})
+        elif path == '/v2/api/program/today':
+            stations = ''.join(f'<station id="{s}"><name>{s}</name></station>' for s in radiko.stations)
+            self.reply(200, f'<?xml version="1.0" encoding="UTF-8"?><radiko><stations area_id="{AREA}">{stations}</stations></radiko>'.encode('utf-8'))
+        elif path.startswith('/v2/station/stream/') and path.endswith('.xml'):
+            station = path[len('/v2/station/stream/'):-len('.xml')]
+            if station not in radiko.stations:
+                self.reply(404)
+                return
+            self.reply(200, f'<?xml version="1.0" encoding="UTF-8"?><url><item>rtmpe://f-radiko.smartstream.ne.jp/{station}/_definst_/simul-stream.stream</item></url>'.encode('utf-8'))
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        radiko = self.server.radiko
+        path = self.path.split('?')[0]
+        radiko.count(path)
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        if path == '/v2/api/auth1_fms':
+            token = base64.b64encode(os.urandom(16)).decode('ascii')
+            offset = random.randrange(0, len(radiko.key) - 16)
+            keylength = 16
+            with radiko.lock:
+                radiko.tokens[token] = (offset, keylength)
+            self.reply(200, b'\r\n', {
+                'X-Radiko-AuthToken': token,
+                'X-Radiko-KeyOffset': str(offset),
+                'X-Radiko-KeyLength': str(keylength)})
+        elif path == '/v2/api/auth2_fms':
+            token = self.headers.get('X-Radiko-Authtoken')
+            with radiko.lock:
+                expected = radiko.tokens.pop(token, None)
+            if expected is None:
+                self.reply(401)
+                return
+            (offset, keylength) = expected
+            partial = base64.b64encode(radiko.key[offset:offset + keylength]).decode('ascii')
+            if self.headers.get('X-Radiko-Partialkey') != partial:
+                self.reply(401)
+                return
+            self.reply(200, f'\r\n{AREA},TOKYO JAPAN,tokyo Japan\r\n'.encode('utf-8'))
+        else:
+            self.reply(404)
+
+class Radiko:
+    def __init__(self, latency=0.0, stations=STATIONS):
+        self.latency = latency
+        self.stations = stations
+        self.key = os.urandom(16384)
+        self.swf = make_swf(self.key)
+        self.etag = '"%x"' % zlib.crc32(self.swf)
+        self.modified = 'Mon, 01 Apr 2019 00:00:00 GMT'
+        self.tokens = {}
+        self.requests = collections.Counter()
+        self.lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.server.radiko = self
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def count(self, path):
+        with self.lock:
+            self.requests[path] += 1
+
+    def reset(self):
+        with self.lock:
+            self.requests.clear()
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name='radiko', daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
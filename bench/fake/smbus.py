@@ -0,0 +1,257 @@
+"""
+Stand-in for the smbus module with a BME280 and a TSL2572 on the bus
+
+devices maps I2C addresses to simulated sensors, by default the two
+BME280 of room (0x76 external, 0x77 on board) and the TSL2572 (0x39).
+Every transaction sleeps BYTE_S per byte like a 100 kHz bus and a
+missing device raises IOError (errno 121) as the kernel driver does.
+Set fail on a device to make its next transactions fail.
+
+BME280
+ Register map of the datasheet: chip id 0xD0, calibration 0x88-0xA1 and
+ 0xE1-0xE7 (the datasheet's example trimming values), ctrl_hum 0xF2,
+ status 0xF3, ctrl_meas 0xF4, config 0xF5 and data 0xF7-0xFE.  A forced
+ measurement takes the datasheet's typical time for the oversampling
+ set and sets status bit 3 meanwhile.  The data registers read the
+ reset value 0x80000 until the first measurement ends.  The raw values
+ are adc_T, adc_P and adc_H.
+
+TSL2572
+ Registers are addressed with the command bit and auto increment
+ (reg | 0xA0): ENABLE 0x00, ATIME 0x01, CONFIG 0x0D (AGL 0x04), CONTROL
+ 0x0F, ID 0x12, STATUS 0x13 and C0DATA/C1DATA 0x14-0x17.  Integration
+ cycles of (256 - ATIME) * 2.73 ms run while ENABLE has AEN, each sets
+ AVALID and AINT.  AINT is cleared by the special function 0xE6.  The
+ counts follow lux with ch1 = ratio * ch0 and saturate at the full
+ scale count of ATIME.
+"""
+
+import errno
+import time
+
+# 9 bits per byte at 100 kHz
+BYTE_S = 0.00009
+
+OVERSAMPLING = [0, 1, 2, 4, 8, 16, 16, 16]
+T_SB = [0.0005, 0.0625, 0.125, 0.25, 0.5, 1.0, 0.01, 0.02]
+
+class BME280:
+    # Example trimming values of the datasheet (section 8.1)
+    CAL = {
+        'T1': 27504, 'T2': 26435, 'T3': -1000,
+        'P1': 36477, 'P2': -10685, 'P3': 3024, 'P4': 2855, 'P5': 140,
+        'P6': -7, 'P7': 15500, 'P8': -14600, 'P9': 6000,
+        'H1': 75, 'H2': 362, 'H3': 0, 'H4': 313, 'H5': 50, 'H6': 30,
+    }
+
+    def __init__(self, adc_T=519888, adc_P=415148, adc_H=30000):
+        # 25.08 C, 1006.5 hPa with CAL
+        self.adc_T = adc_T
+        self.adc_P = adc_P
+        self.adc_H = adc_H
+        self.fail = 0
+        self.regs = bytearray(256)
+        self.regs[0xD0] = 0x60
+        self.load_cal()
+        self.reset()
+
+    def load_cal(self):
+        c = self.CAL
+        b = bytearray()
+        for k in ('T1', 'T2', 'T3', 'P1', 'P2', 'P3', 'P4', 'P5', 'P6', 'P7', 'P8', 'P9'):
+            b += (c[k] & 0xFFFF).to_bytes(2, 'little')
+        self.regs[0x88:0x88 + 24] = b
+        self.regs[0xA1] = c['H1']
+        self.regs[0xE1:0xE3] = (c['H2'] & 0xFFFF).to_bytes(2, 'little')
+        self.regs[0xE3] = c['H3']
+        self.regs[0xE4] = (c['H4'] >> 4) & 0xFF
+        self.regs[0xE5] = (c['H4'] & 0xF) | ((c['H5'] & 0xF) << 4)
+        self.regs[0xE6] = (c['H5'] >> 4) & 0xFF
+        self.regs[0xE7] = c['H6'] & 0xFF
+
+    # Power on reset, sleep mode with the reset values in data
+    def reset(self):
+        for r in (0xF2, 0xF4, 0xF5):
+            self.regs[r] = 0
+        self.latch(0x80000, 0x80000, 0x8000)
+        self.mode = 0
+        self.measured = None    # time the running measurement ends
+        self.started = None     # time normal mode was entered
+
+    def latch(self, p, t, h):
+        self.regs[0xF7:0xFF] = bytes([
+            (p >> 12) & 0xFF, (p >> 4) & 0xFF, (p & 0xF) << 4,
+            (t >> 12) & 0xFF, (t >> 4) & 0xFF, (t & 0xF) << 4,
+            (h >> 8) & 0xFF, h & 0xFF])
+
+    # Typical measurement time (datasheet 9.1) in seconds
+    def meas_time(self):
+        ost = OVERSAMPLING[self.regs[0xF4] >> 5]
+        osp = OVERSAMPLING[(self.regs[0xF4] >> 2) & 0x7]
+        osh = OVERSAMPLING[self.regs[0xF2] & 0x7]
+        t = 1.0 + 2.0 * ost
+        if osp:
+            t += 2.0 * osp + 0.5
+        if osh:
+            t += 2.0 * osh + 0.5
+        return t / 1000
+
+    def update(self, now):
+        if self.mode == 0x1 and self.measured is not None and now >= self.measured:
+            self.latch(self.adc_P, self.adc_T, self.adc_H)
+            self.measured = None
+            # Back to sleep after a forced measurement
+            self.mode = 0
+            self.regs[0xF4] &= 0xFC
+        elif self.mode == 0x3 and now - self.started >= self.meas_time():
+            self.latch(self.adc_P, self.adc_T, self.adc_H)
+
+    def status(self, now):
+        if self.mode == 0x1 and self.measured is not None:
+            return 0x08
+        if self.mode == 0x3:
+            period = self.meas_time() + T_SB[self.regs[0xF5] >> 5]
+            if (now - self.started) % period < self.meas_time():
+                return 0x08
+        return 0x00
+
+    def read(self, reg, length, now):
+        self.update(now)
+        data = []
+        for r in range(reg, reg + length):
+            data.append(self.status(now) if r == 0xF3 else self.regs[r & 0xFF])
+        return data
+
+    def write(self, reg, data, now):
+        self.update(now)
+        # Writes are register/value pairs, room writes one at a time
+        for (i, v) in enumerate(data):
+            r = reg + i
+            if r == 0xE0 and v == 0xB6:
+                self.reset()
+                continue
+            if r == 0xF5 and self.mode != 0:
+                # config is ignored out of sleep mode
+                continue
+            self.regs[r] = v
+            if r == 0xF4:
+                self.mode = v & 0x3
+                if self.mode == 0x1:
+                    self.measured = now + self.meas_time()
+                elif self.mode == 0x3:
+                    self.started = now
+                elif self.mode == 0x2:
+                    self.mode = 0x1
+                    self.measured = now + self.meas_time()
+
+    def write_byte(self, value, now):
+        pass
+
+class TSL2572:
+    GAIN = [1, 8, 16, 120]
+
+    def __init__(self, lux=300.0, ratio=0.2):
+        self.lux = lux
+        self.ratio = ratio
+        self.fail = 0
+        self.regs = bytearray(32)
+        self.regs[0x01] = 0xFF
+        self.regs[0x12] = 0x34
+        self.started = None     # time AEN was set
+        self.cleared = 0        # completed cycles when AINT was cleared
+        self.valid = False
+
+    def cycle(self):
+        return (256 - self.regs[0x01]) * 0.00273
+
+    def cycles(self, now):
+        if self.started is None:
+            return 0
+        return int((now - self.started) / self.cycle())
+
+    def gain(self):
+        g = self.GAIN[self.regs[0x0F] & 0x3]
+        if self.regs[0x0D] & 0x04 and g == 1:
+            g = 0.16
+        return g
+
+    # ch0/ch1 counts of the current light, gain and ATIME
+    def counts(self):
+        atime_ms = (256 - self.regs[0x01]) * 2.73
+        cpl = atime_ms * self.gain() / 60
+        full = min(65535, (256 - self.regs[0x01]) * 1024)
+        # calc_lux(): lux = (ch0 - 1.87 * ch1) / cpl
+        ch0 = int(self.lux * cpl / (1 - 1.87 * self.ratio))
+        ch1 = int(ch0 * self.ratio)
+        return min(ch0, full), min(ch1, full)
+
+    def read(self, reg, length, now):
+        reg &= 0x1F
+        n = self.cycles(now)
+        if n > 0:
+            self.valid = True
+            (ch0, ch1) = self.counts()
+            self.regs[0x14:0x18] = bytes([ch0 & 0xFF, ch0 >> 8, ch1 & 0xFF, ch1 >> 8])
+        self.regs[0x13] = (0x01 if self.valid else 0) | (0x10 if n > self.cleared else 0)
+        return [self.regs[(reg + i) & 0x1F] for i in range(length)]
+
+    def write(self, reg, data, now):
+        reg &= 0x1F
+        for (i, v) in enumerate(data):
+            r = (reg + i) & 0x1F
+            if r == 0x00:
+                if v & 0x02 and not self.regs[0x00] & 0x02:
+                    self.started = now
+                    self.cleared = 0
+                    self.valid = False
+                elif not v & 0x02:
+                    self.started = None
+                    self.cleared = 0
+            self.regs[r] = v
+
+    # Special function, 0xE6 clears the ALS interrupt
+    def write_byte(self, value, now):
+        if value == 0xE6:
+            self.cleared = self.cycles(now)
+
+devices = {
+    0x76: BME280(),
+    0x77: BME280(adc_T=520500),
+    0x39: TSL2572(),
+}
+
+class SMBus:
+    def __init__(self, bus=None):
+        self.bus = bus
+        self.transactions = 0
+
+    def device(self, addr, nbytes):
+        self.transactions += 1
+        if BYTE_S:
+            time.sleep(BYTE_S * nbytes)
+        dev = devices.get(addr)
+        if dev is None:
+            raise IOError(errno.EREMOTEIO, 'Remote I/O error')
+        if dev.fail > 0:
+            dev.fail -= 1
+            raise IOError(errno.EREMOTEIO, 'Remote I/O error')
+        return dev
+
+    # address, register, repeated start, address, data
+    def read_i2c_block_data(self, addr, cmd, length=32):
+        return self.device(addr, 3 + length).read(cmd, length, time.monotonic())
+
+    def read_byte_data(self, addr, cmd):
+        return self.read_i2c_block_data(addr, cmd, 1)[0]
+
+    def write_i2c_block_data(self, addr, cmd, vals):
+        self.device(addr, 2 + len(vals)).write(cmd, list(vals), time.monotonic())
+
+    def write_byte_data(self, addr, cmd, val):
+        self.write_i2c_block_data(addr, cmd, [val])
+
+    def write_byte(self, addr, val):
+        self.device(addr, 2).write_byte(val, time.monotonic())
+
+    def close(self):
+        pass
@@ -0,0 +1,445 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark suite that runs without a Pi, pigpiod, sensors or radiko
+
+python3 bench/suite.py [--baseline bench/baseline.json] [--update]
+                       [--threshold 0.25] [--output results.json]
+                       [--only irrp,bme280,tsl2572,radio,loop]
+
+The modules in bench/fake stand in for pigpio and smbus (register maps
+and timing of the BME280 and TSL2572, a wave engine), bench/fake/bin
+for rtmpdump and mplayer, and bench/fake/radiko.py serves the radiko
+endpoints on localhost.  Each benchmark runs in a temporary directory.
+
+Results are compared with the baseline and anything slower than the
+threshold (25% by default) is reported as a regression, the exit
+status is then 1.  The first run, or --update, writes the baseline.
+Timings depend on the machine, keep one baseline per machine.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCH, '..'))
+sys.path.insert(0, os.path.join(BENCH, 'fake'))
+os.environ['PATH'] = os.path.join(BENCH, 'fake', 'bin') + os.pathsep + os.environ.get('PATH', '')
+
+import pigpio
+import smbus
+import radiko
+
+import bme280i2c
+import irrp
+import metrics
+import radio
+import tsl2572
+
+CODES = ['ac:off', 'ac:heating', 'ac:cooling', 'iris:toggle', 'iris:off']
+
+def quiet_logger():
+    logger = logging.getLogger('bench')
+    logger.handlers = [logging.NullHandler()]
+    logger.setLevel(logging.WARNING)
+    logger.propagate = False
+    return logger
+
+@contextlib.contextmanager
+def workdir():
+    cwd = os.getcwd()
+    d = tempfile.mkdtemp(prefix='room-bench-')
+    os.chdir(d)
+    try:
+        yield d
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(d, ignore_errors=True)
+
+def result(value, unit='s', better='lower'):
+    return {'value': value, 'unit': unit, 'better': better}
+
+# Best of repeat runs of number calls, seconds per call
+def measure(f, number=1, repeat=5, setup=None):
+    times = []
+    for r in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for i in range(number):
+            f()
+        times.append((time.perf_counter() - start) / number)
+    return min(times)
+
+def ac_code(rnd, bits=152, frames=2, jitter=0.08):
+    # Leader, 2 marks x 2 spaces bits and a trailer per frame, as recorded
+    def j(v):
+        return int(v * rnd.uniform(1 - jitter, 1 + jitter))
+    code = []
+    for f in range(frames):
+        code += [j(3400), j(1700)]
+        for b in range(bits):
+            code += [j(430), j(1290) if rnd.random() < 0.5 else j(430)]
+        code += [j(430), j(13000)]
+    return code[:-1]
+
+def ir_records(seed=1):
+    rnd = random.Random(seed)
+    records = {name: ac_code(rnd) for name in CODES}
+    # The iris remote sends a short NEC like code repeated
+    records['iris:toggle'] = ac_code(rnd, bits=32, frames=4)
+    records['iris:off'] = ac_code(rnd, bits=32, frames=4)
+    return records
+
+def write_ir(records, path='ir/data'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    for code in records.values():
+        irrp.normalise(code)
+    irrp.tidy(records)
+    with open(path, 'w') as f:
+        json.dump(records, f)
+
+def bench_irrp():
+    out = {}
+    records = ir_records()
+    code = records['ac:heating']
+    out['irrp.normalise'] = result(measure(lambda: irrp.normalise(list(code)), number=20))
+    out['irrp.tidy'] = result(measure(lambda: irrp.tidy({k: list(v) for k, v in records.items()}), number=20))
+    with workdir():
+        write_ir(records)
+        with open('ir/data') as f:
+            tidied = json.load(f)
+        layout = irrp.compile_code(tidied['ac:heating'])[1]
+        out['irrp.compile_code'] = result(measure(lambda: irrp.compile_code(tidied['ac:heating']), number=20))
+        out['irrp.compile_codes'] = result(measure(lambda: irrp.compile_codes(tidied), number=5))
+        out['irrp.chain_entries'] = result(len(layout), 'entries')
+
+        # Software latency of a send, the wave engine does not wait for airtime
+        pigpio.REALTIME = False
+        try:
+            pi = pigpio.pi()
+            tx = irrp.IRTransmitter(pi, 13, 'ir/data', gap=0)
+            def cold():
+                tx.cache.clear()
+            out['irrp.send_cold'] = result(measure(lambda: tx.send('ac:heating'), setup=cold))
+            commands = pi.commands
+            tx.send('ac:heating')
+            out['irrp.send_warm'] = result(measure(lambda: tx.send('ac:heating'), number=10))
+            out['irrp.send_warm_commands'] = result(pi.commands - commands, 'commands')
+            out['irrp.airtime'] = result(pi.last_chain_us / 1e6)
+            tx.close()
+            out.update(bench_irrp_churn())
+        finally:
+            pigpio.REALTIME = True
+    return out
+
+# More codes than pigpio can hold at once, sent in a random order so that
+# evictions leave holes below live waves
+def bench_irrp_churn(codes=80, hot=60, sends=2000):
+    out = {}
+    rnd = random.Random(3)
+    records = {}
+    for i in range(codes):
+        code = ac_code(rnd, bits=8, frames=1, jitter=0)
+        # A leader of its own so that the codes share few waves
+        code[0] = 2000 + 150 * i
+        irrp.normalise(code)
+        records[f'code{i}'] = code
+    with open('ir/churn', 'w') as f:
+        json.dump(records, f)
+    pi = pigpio.pi()
+    tx = irrp.IRTransmitter(pi, 13, 'ir/churn', gap=0)
+    reconnects = 0
+    reconnect = tx.reconnect
+    def counted():
+        nonlocal reconnects
+        reconnects += 1
+        reconnect()
+    tx.reconnect = counted
+    names = list(records)
+    order = [rnd.choice(names[:hot]) if rnd.random() < 0.9 else rnd.choice(names) for i in range(sends)]
+    start = time.perf_counter()
+    for name in order:
+        tx.send(name)
+    out['irrp.churn_send'] = result((time.perf_counter() - start) / sends)
+    out['irrp.churn_hit_rate'] = result(100.0 * tx.cache.hits / sends, '%', 'higher')
+    if pi.rejected or reconnects:
+        raise Exception(f'wave cache overran pigpio: {pi.rejected} rejected creates, {reconnects} reconnects')
+    tx.close()
+    return out
+
+def bench_bme280():
+    out = {}
+    smbus.devices[0x76] = smbus.BME280()
+    def cold():
+        nonlocal bme
+        bme = bme280i2c.BME280I2C(0x76, bme280i2c.BME280I2C.MODE_FORCED)
+    bme = None
+    out['bme280.meas_forced_cold'] = result(measure(lambda: bme.meas(), setup=cold))
+    bme.meas()
+    out['bme280.meas_forced'] = result(measure(lambda: bme.meas()))
+    out['bme280.meas_forced_transactions'] = result(bme.meas_transactions, 'transactions')
+    bme = bme280i2c.BME280I2C(0x76, bme280i2c.BME280I2C.MODE_NORMAL)
+    bme.meas()
+    out['bme280.meas_normal'] = result(measure(lambda: bme.meas(), number=20))
+    out['bme280.meas_normal_transactions'] = result(bme.meas_transactions, 'transactions')
+    if (bme.T, round(bme.P, 2)) != (25.08, 1006.53):
+        raise Exception(f'BME280 compensation differs: {bme.T} C {bme.P} hPa')
+    return out
+
+def bench_tsl2572():
+    out = {}
+    sensor = smbus.devices[0x39] = smbus.TSL2572()
+    for (name, lux) in (('bright', 300.0), ('dark', 2.0), ('sunlight', 50000.0)):
+        sensor.lux = lux
+        tsl = tsl2572.TSL2572(0x39)
+        # First from the default range, then from the remembered one
+        out[f'tsl2572.meas_single_{name}_first'] = result(measure(tsl.meas_single, repeat=1))
+        out[f'tsl2572.meas_single_{name}'] = result(measure(tsl.meas_single, repeat=3))
+        if abs(tsl.lux - lux) > lux * 0.05 + 0.5:
+            raise Exception(f'TSL2572 reads {tsl.lux} lux for {lux} lux')
+    sensor.lux = 300.0
+    tsl.start_continuous()
+    time.sleep(tsl.integration_time() * 2)
+    out['tsl2572.read_continuous'] = result(measure(tsl.read, number=100))
+    return out
+
+def wait_playing(r, timeout=10):
+    deadline = time.time() + timeout
+    while r.active is not None and r.active.playing is None:
+        if time.time() > deadline:
+            raise Exception('mplayer did not start playback')
+        time.sleep(0.001)
+    return r.active.playing
+
+def bench_radio(latency=0.02):
+    out = {}
+    server = radiko.Radiko(latency=latency)
+    server.start()
+    (http, https, player, maxload) = (radio.RADIKO_HTTP, radio.RADIKO_HTTPS, radio.PLAYER_URL, radio.STANDBY_MAXLOAD)
+    radio.RADIKO_HTTP = radio.RADIKO_HTTPS = server.url
+    radio.PLAYER_URL = server.url + radiko.PLAYER_PATH
+    # Standby pipelines regardless of the load of this machine
+    radio.STANDBY_MAXLOAD = float('inf')
+    logger = quiet_logger()
+    try:
+        with workdir():
+            server.reset()
+            r = radio.Radio(logger, './cache/radiko')
+            out['radio.auth_cold'] = result(measure(r.auth, repeat=1))
+            r.prefetching.join()
+            out['radio.auth_cold_requests'] = result(sum(server.requests.values()), 'requests')
+            out['radio.auth_memory'] = result(measure(r.auth, number=10000))
+            server.reset()
+            r = radio.Radio(logger, './cache/radiko')
+            out['radio.auth_token_file'] = result(measure(r.auth, repeat=1))
+            # Stream URLs of the neighbours are fetched in the background
+            r.prefetching.join()
+            out['radio.auth_token_file_requests'] = result(sum(server.requests.values()), 'requests')
+            server.reset()
+            out['radio.auth_player_cached'] = result(measure(lambda: r.auth(force=True), repeat=3))
+            out['radio.auth_player_cached_requests'] = result(sum(server.requests.values()) / 3, 'requests')
+
+            # Cold: stream URL, rtmpdump and mplayer; spawned is when changechannel returns
+            def cold():
+                r.stop()
+                r.streams.clear()
+            spawned = []
+            playing = []
+            for i in range(3):
+                cold()
+                start = time.time()
+                r.changechannel(r.channels[1])
+                spawned.append(time.time() - start)
+                playing.append(wait_playing(r) - start)
+            out['radio.changechannel_cold'] = result(statistics.median(spawned))
+            out['radio.changechannel_cold_playback'] = result(statistics.median(playing))
+            r.stop()
+
+            # Standby: the next channel is already playing muted
+            r.standbyenabled = True
+            r.nextchannel()
+            wait_playing(r)
+            latencies = []
+            for i in range(3):
+                deadline = time.time() + 10
+                while r.standby is None or r.standby.playing is None:
+                    if time.time() > deadline:
+                        raise Exception('no standby pipeline')
+                    time.sleep(0.001)
+                r.nextchannel()
+                latencies.append(r.switchlatency)
+            out['radio.changechannel_standby'] = result(statistics.median(latencies))
+            r.close()
+    finally:
+        (radio.RADIKO_HTTP, radio.RADIKO_HTTPS, radio.PLAYER_URL, radio.STANDBY_MAXLOAD) = (http, https, player, maxload)
+        server.stop()
+    return out
+
+def loop_count():
+    t = metrics.histogram('room_loop_seconds').cells.total()
+    return sum(t[:-1]), t[-1]
+
+def bench_loop(seconds=3.0):
+    out = {}
+    server = radiko.Radiko(latency=0.01)
+    server.start()
+    (http, https, player) = (radio.RADIKO_HTTP, radio.RADIKO_HTTPS, radio.PLAYER_URL)
+    radio.RADIKO_HTTP = radio.RADIKO_HTTPS = server.url
+    radio.PLAYER_URL = server.url + radiko.PLAYER_PATH
+    os.environ.setdefault('TOKEN', 'bench')
+    os.environ.setdefault('PORT', '0')
+    (stdout, stderr) = (sys.stdout, sys.stderr)
+    smbus.devices[0x76] = smbus.BME280()
+    smbus.devices[0x39] = smbus.TSL2572()
+    import run
+    with workdir():
+        write_ir(ir_records())
+        main = run.Main(quiet_logger())
+        overruns = main.overruns.cells.total()[0]
+        thread = threading.Thread(target=main.run, name='main', daemon=True)
+        try:
+            thread.start()
+            deadline = time.time() + 10
+            while len(main.radio.channels) == 0:
+                if time.time() > deadline:
+                    raise Exception('Main.run did not start')
+                time.sleep(0.01)
+            time.sleep(0.5)
+
+            # Idle, the loop waits 50 ms for the queue every iteration
+            (n, total) = loop_count()
+            time.sleep(seconds)
+            (n2, total2) = loop_count()
+            out['loop.idle_iterations'] = result((n2 - n) / seconds, 'iterations/s', 'higher')
+
+            # Saturated, a wake up is always waiting so the loop never blocks
+            running = True
+            def feed():
+                while running:
+                    if main.queue.qsize() < 2:
+                        main.queue.put(None)
+                    time.sleep(0.0002)
+            feeder = threading.Thread(target=feed, daemon=True)
+            (n, total) = loop_count()
+            start = time.time()
+            feeder.start()
+            time.sleep(seconds)
+            running = False
+            feeder.join()
+            (n2, total2) = loop_count()
+            out['loop.busy_iterations'] = result((n2 - n) / (time.time() - start), 'iterations/s', 'higher')
+            out['loop.busy_iteration'] = result((total2 - total) / max(1, n2 - n))
+
+            # Buttons and API commands from the queue to their completion
+            latencies = []
+            for i in range(5):
+                future = concurrent.futures.Future()
+                main.queue.put({'command': 'ac-off', 'enqueued': time.time(), 'future': future})
+                future.result(10)
+                latencies.append(main.dispatcher.stats()['ac-off']['last'])
+            out['loop.command_ac_off'] = result(statistics.median(latencies))
+            # A short press of sw2 is reported after the double click window
+            pressed = time.time()
+            main.device.io.press(6)
+            while main.radio.active is None:
+                if time.time() > pressed + 10:
+                    raise Exception('sw2 did not start the radio')
+                time.sleep(0.001)
+            out['loop.button_radio'] = result(wait_playing(main.radio) - pressed)
+            out['loop.overruns'] = result(main.overruns.cells.total()[0] - overruns, 'iterations')
+        finally:
+            main.sampler.stop()
+            main.radio.close()
+            (sys.stdout, sys.stderr) = (stdout, stderr)
+            (radio.RADIKO_HTTP, radio.RADIKO_HTTPS, radio.PLAYER_URL) = (http, https, player)
+            server.stop()
+    return out
+
+BENCHMARKS = {
+    'irrp': bench_irrp,
+    'bme280': bench_bme280,
+    'tsl2572': bench_tsl2572,
+    'radio': bench_radio,
+    # Leaves Main.run running, keep it last
+    'loop': bench_loop,
+}
+
+def machine():
+    return {'platform': platform.platform(), 'python': platform.python_version(),
+        'cpus': os.cpu_count(), 'numpy': irrp.numpy is not None}
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if base is None or not base['value'] or not r['value']:
+            mark = ''
+        else:
+            if r['better'] == 'lower':
+                ratio = r['value'] / base['value']
+            else:
+                ratio = base['value'] / r['value']
+            mark = f'{ratio:6.2f}x'
+            # Counts that do not depend on timing regress on any increase
+            limit = 1.0 if r['unit'] in ('requests', 'commands', 'entries') else 1.0 + threshold
+            if ratio > limit:
+                mark += ' REGRESSION'
+                regressions.append(name)
+        if r['unit'] == 's':
+            value = f'{r["value"] * 1000:10.3f} ms'
+        else:
+            value = f'{r["value"]:10.1f} {r["unit"]}'
+        print(f'{name:40} {value:24} {mark}')
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='hardware-free benchmarks of room')
+    parser.add_argument('--baseline', default=os.path.join(BENCH, 'baseline.json'))
+    parser.add_argument('--update', action='store_true', help='write the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25)
+    parser.add_argument('--output', help='also write the results here')
+    parser.add_argument('--only', help='comma separated benchmarks')
+    args = parser.parse_args()
+
+    names = args.only.split(',') if args.only else list(BENCHMARKS)
+    results = {}
+    for name in BENCHMARKS:
+        if name in names:
+            results.update(BENCHMARKS[name]())
+
+    baseline = {'machine': None, 'results': {}}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if baseline['machine'] not in (None, machine()):
+        print(f'baseline is from another machine: {baseline["machine"]}')
+    regressions = compare(results, baseline['results'], args.threshold)
+
+    document = {'machine': machine(), 'time': time.time(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(document, f, indent=2)
+    if args.update or not baseline['results']:
+        document['results'] = {**baseline['results'], **results}
+        with open(args.baseline, 'w') as f:
+            json.dump(document, f, indent=2)
+        print(f'baseline written to {args.baseline}')
+    elif regressions:
+        print(f'{len(regressions)} regressions over {args.threshold:.0%}')
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -6,9 +6,39 @@ BME280 Control Module via I2C
 """
 
 import smbus
+import struct
 import time
 
+# Calibration data, read once per sensor
+class BME280Cal:
+    __slots__ = ('dig_T1', 'dig_T2', 'dig_T3',
+        'dig_P1', 'dig_P2', 'dig_P3', 'dig_P4', 'dig_P5',
+        'dig_P6', 'dig_P7', 'dig_P8', 'dig_P9',
+        'dig_H1', 'dig_H2', 'dig_H3', 'dig_H4', 'dig_H5', 'dig_H6')
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.__slots__]
+
 class BME280I2C:
+    # ctrl_meas mode bits
+    MODE_FORCED = 0x1   # One measurement per meas(), sleeps in between
+    MODE_NORMAL = 0x3   # Sensor samples on its own, meas() only reads
+
+    # config t_sb, standby time between normal mode samples
+    T_SB_0_5MS = 0x0
+    T_SB_62_5MS = 0x1
+    T_SB_125MS = 0x2
+    T_SB_250MS = 0x3
+    T_SB_500MS = 0x4
+    T_SB_1000MS = 0x5
+
+    # config filter, IIR filter coefficient
+    FILTER_OFF = 0x0
+    FILTER_2 = 0x1
+    FILTER_4 = 0x2
+    FILTER_8 = 0x3
+    FILTER_16 = 0x4
+
     # Return signed int from 16bit uint
     @staticmethod
     def get_signed8(uint):
@@ -24,10 +54,18 @@ class BME280I2C:
         return uint
 
     # i2c_addr 0x76 or 0x77
-    def __init__(self, i2c_addr):
+    # mode MODE_FORCED or MODE_NORMAL
+    def __init__(self, i2c_addr, mode=MODE_FORCED,
+            t_sb=T_SB_1000MS, iir=FILTER_16):
         self.i2c_addr = i2c_addr
         self.i2c = smbus.SMBus(1)
-        self.cal = {}               # Calibration data
+        self.mode = mode
+        self.t_sb = t_sb
+        self.iir = iir
+        self.normal_running = False # Normal mode has been set up
+        self.cal = None             # Calibration data, None until read
+        self.transactions = 0       # I2C transactions so far
+        self.meas_transactions = 0  # I2C transactions of the last meas()
         self.adc_T = 0
         self.adc_P = 0
         self.adc_H = 0
@@ -37,19 +75,27 @@ class BME280I2C:
         self.t_fine = 0
 
     # I2C read length byte from addr
+    #  The calibration is dropped on IOError so that it is read again
     def read_address(self, addr, length):
+        self.transactions += 1
         try:
             return self.i2c.read_i2c_block_data(self.i2c_addr, addr, length)
         except IOError:
+            self.cal = None
             return [0 for i in range(length)]
 
     def read_address_twobyte(self, addr):
-        data = self.i2c.read_i2c_block_data(self.i2c_addr, addr, 2)
+        data = self.read_address(addr, 2)
         return data[0] + (data[1]<<8)
 
     # I2C write data to addr
     def write_address(self, addr, data):
-        self.i2c.write_i2c_block_data(self.i2c_addr, addr, data)
+        self.transactions += 1
+        try:
+            self.i2c.write_i2c_block_data(self.i2c_addr, addr, data)
+        except IOError:
+            self.cal = None
+            raise
 
     # Read BME280 ID and return True if success
     def id_read(self):
@@ -64,28 +110,26 @@ class BME280I2C:
         im_update = data[0]&0x1
         return measuring, im_update
 
-    # Read calibration registers and store in cal dict
+    # Read calibration registers and store in cal
+    #  Two block reads, 0x88-0xA1 and 0xE1-0xE7
     def read_cal(self):
-        self.cal['dig_T1'] = self.read_address_twobyte(0x88)
-        self.cal['dig_T2'] = self.get_signed16(self.read_address_twobyte(0x8A))
-        self.cal['dig_T3'] = self.get_signed16(self.read_address_twobyte(0x8C))
-        self.cal['dig_P1'] = self.read_address_twobyte(0x8E)
-        self.cal['dig_P2'] = self.get_signed16(self.read_address_twobyte(0x90))
-        self.cal['dig_P3'] = self.get_signed16(self.read_address_twobyte(0x92))
-        self.cal['dig_P4'] = self.get_signed16(self.read_address_twobyte(0x94))
-        self.cal['dig_P5'] = self.get_signed16(self.read_address_twobyte(0x96))
-        self.cal['dig_P6'] = self.get_signed16(self.read_address_twobyte(0x98))
-        self.cal['dig_P7'] = self.get_signed16(self.read_address_twobyte(0x9A))
-        self.cal['dig_P8'] = self.get_signed16(self.read_address_twobyte(0x9C))
-        self.cal['dig_P9'] = self.get_signed16(self.read_address_twobyte(0x9E))
-        self.cal['dig_H1'] = self.read_address(0xA1,1)[0]
-        self.cal['dig_H2'] = self.get_signed16(self.read_address_twobyte(0xE1))
-        self.cal['dig_H3'] = self.read_address(0xE3,1)[0]
-        self.cal['dig_H4'] = self.get_signed16(
-            (self.read_address(0xE4,1)[0]<<4) + 
-            (self.read_address(0xE5,1)[0]&0xF))
-        self.cal['dig_H5'] = self.get_signed16(self.read_address_twobyte(0xE5)>>4)
-        self.cal['dig_H6'] = self.get_signed8(self.read_address(0xE7,1)[0])
+        self.cal = None
+        b1 = self.read_address(0x88, 26)
+        b2 = self.read_address(0xE1, 7)
+        cal = BME280Cal()
+        (cal.dig_T1, cal.dig_T2, cal.dig_T3,
+         cal.dig_P1, cal.dig_P2, cal.dig_P3, cal.dig_P4, cal.dig_P5,
+         cal.dig_P6, cal.dig_P7, cal.dig_P8, cal.dig_P9,
+         cal.dig_H1) = struct.unpack('<HhhHhhhhhhhhxB', bytes(b1))
+        cal.dig_H2 = self.get_signed16(b2[0] + (b2[1]<<8))
+        cal.dig_H3 = b2[2]
+        cal.dig_H4 = self.get_signed16((b2[3]<<4) + (b2[4]&0xF))
+        cal.dig_H5 = self.get_signed16((b2[4] + (b2[5]<<8))>>4)
+        cal.dig_H6 = self.get_signed8(b2[6])
+        # read_address() leaves cal None on IOError, keep zeros out
+        if self.cal is None and any(b1 + b2):
+            self.cal = cal
+        return self.cal is not None
 
     def print_cal(self):
         for k, v in sorted(self.cal.items(), key=lambda x: x[0]):
@@ -93,6 +137,7 @@ class BME280I2C:
 
     # Measure sensor data and store in adc_T, adc_P and adc_H
     def forced(self):
+        self.normal_running = False
         self.write_address(0xF5, [0x0])  # config
         self.write_address(0xF2, [0x5])  # ctrl_hum, oversampling x16
         self.write_address(0xF4, [0xB5]) # ctrl_meas, oversampling x16, forced mode
@@ -102,6 +147,18 @@ class BME280I2C:
             time.sleep(0.001)
             measuring, im_update = self.status_read()
 
+        self.read_data()
+
+    # Start normal mode, the sensor then samples every t_sb through the IIR filter
+    def normal(self):
+        self.write_address(0xF4, [0x0])  # ctrl_meas, sleep mode so config is not ignored
+        self.write_address(0xF5, [(self.t_sb<<5) | (self.iir<<2)]) # config
+        self.write_address(0xF2, [0x5])  # ctrl_hum, oversampling x16
+        self.write_address(0xF4, [0xB7]) # ctrl_meas, oversampling x16, normal mode
+        self.normal_running = True
+
+    # Burst read the latest sample and store in adc_T, adc_P and adc_H
+    def read_data(self):
         data = self.read_address(0xF7, 8)
         self.adc_P = (data[0]<<12) + (data[1]<<4) + (data[2]>>4)
         self.adc_T = (data[3]<<12) + (data[4]<<4) + (data[5]>>4)
@@ -109,41 +166,41 @@ class BME280I2C:
 
     # Calculate temp from adc_T and calibration data
     def comp_T(self):
-        var1 = ((((self.adc_T>>3) - (self.cal['dig_T1']<<1))) * (self.cal['dig_T2'])) >> 11
-        var2  = (((((self.adc_T>>4) - (self.cal['dig_T1'])) * 
-            ((self.adc_T>>4) - (self.cal['dig_T1']))) >> 12) *
-            (self.cal['dig_T3'])) >> 14
+        var1 = ((((self.adc_T>>3) - (self.cal.dig_T1<<1))) * (self.cal.dig_T2)) >> 11
+        var2  = (((((self.adc_T>>4) - (self.cal.dig_T1)) * 
+            ((self.adc_T>>4) - (self.cal.dig_T1))) >> 12) *
+            (self.cal.dig_T3)) >> 14
         self.t_fine = var1 + var2
         self.T  = ((self.t_fine * 5 + 128) >> 8)/100
 
     # Calculate pressure from adc_P and calibration data
     def comp_P(self):
         var1 = self.t_fine - 128000
-        var2 = var1 * var1 * self.cal['dig_P6']
-        var2 = var2 + ((var1*self.cal['dig_P5'])<<17)
-        var2 = var2 + (self.cal['dig_P4']<<35)
-        var1 = ((var1 * var1 * self.cal['dig_P3'])>>8) + ((var1 * self.cal['dig_P2'])<<12)
-        var1 = (((1<<47)+var1))*(self.cal['dig_P1'])>>33
+        var2 = var1 * var1 * self.cal.dig_P6
+        var2 = var2 + ((var1*self.cal.dig_P5)<<17)
+        var2 = var2 + (self.cal.dig_P4<<35)
+        var1 = ((var1 * var1 * self.cal.dig_P3)>>8) + ((var1 * self.cal.dig_P2)<<12)
+        var1 = (((1<<47)+var1))*(self.cal.dig_P1)>>33
         if var1 == 0:
             return
 
         p = 1048576 - self.adc_P
         p = (((p<<31)-var2)*3125)//var1
-        var1 = (self.cal['dig_P9'] * (p>>13) * (p>>13)) >> 25
-        var2 = (self.cal['dig_P8'] * p) >> 19
-        p = ((p + var1 + var2) >> 8) + ((self.cal['dig_P7'])<<4)
+        var1 = (self.cal.dig_P9 * (p>>13) * (p>>13)) >> 25
+        var2 = (self.cal.dig_P8 * p) >> 19
+        p = ((p + var1 + var2) >> 8) + ((self.cal.dig_P7)<<4)
         self.P = p/25600
 
     # Calculate humidity from adc_H and calibration data
     def comp_H(self):
         v_x1_u32r = (self.t_fine - 76800)
-        v_x1_u32r = (((((self.adc_H << 14) - ((self.cal['dig_H4']) << 20) - 
-            ((self.cal['dig_H5']) * v_x1_u32r)) + 16384) >> 15) * 
-            (((((((v_x1_u32r * self.cal['dig_H6']) >> 10) * (((v_x1_u32r *
-            self.cal['dig_H3']) >> 11) + 32768)) >> 10) + 2097152) *
-            self.cal['dig_H2'] + 8192) >> 14))
+        v_x1_u32r = (((((self.adc_H << 14) - ((self.cal.dig_H4) << 20) - 
+            ((self.cal.dig_H5) * v_x1_u32r)) + 16384) >> 15) * 
+            (((((((v_x1_u32r * self.cal.dig_H6) >> 10) * (((v_x1_u32r *
+            self.cal.dig_H3) >> 11) + 32768)) >> 10) + 2097152) *
+            self.cal.dig_H2 + 8192) >> 14))
         v_x1_u32r = (v_x1_u32r - (((((v_x1_u32r >> 15) * (v_x1_u32r >> 15)) >> 7) * 
-            self.cal['dig_H1']) >> 4))
+            self.cal.dig_H1) >> 4))
         if v_x1_u32r < 0:
             v_x1_u32r = 0
         if v_x1_u32r > 419430400:
@@ -151,16 +208,55 @@ class BME280I2C:
         self.H = (v_x1_u32r>>12)/1024
 
     # Measure T/P/H
-    def meas(self):
-        if not self.id_read():
+    #  Calibration is read on the first meas() and again only after an
+    #  IOError or a failed ID read
+    #  In normal mode a reading is a single burst read once the sensor runs
+    def meas(self, mode=None):
+        if mode is not None:
+            self.mode = mode
+        start = self.transactions
+        try:
+            if self.mode == BME280I2C.MODE_NORMAL:
+                return self.meas_normal()
+            if not self.id_read():
+                self.cal = None
+                return False
+            if self.cal is None and not self.read_cal():
+                return False
+            self.forced()
+            if self.cal is None: # IOError while measuring
+                return False
+            self.comp()
+            return True
+        finally:
+            self.meas_transactions = self.transactions - start
+
+    def meas_normal(self):
+        if self.cal is None:
+            self.normal_running = False
+            if not self.id_read():
+                return False
+            if not self.read_cal():
+                return False
+        if not self.normal_running:
+            self.normal()
+            # First sample of the IIR filter
+            time.sleep(0.12)
+        self.read_data()
+        if self.cal is None: # IOError while reading
+            return False
+        if self.adc_T == 0x80000:
+            # Reset value, the sensor has been reset and is asleep
+            self.normal_running = False
             return False
-        self.read_cal()
-        self.forced()
+        self.comp()
+        return True
+
+    def comp(self):
         self.comp_T()
         self.comp_P()
         self.comp_H()
-        return True
-        
+
     def print_reg(self):
         print( ' t_fine : {}'.format(self.t_fine))
         print( ' adc_T  : {}'.format(self.adc_T))
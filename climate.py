@@ -0,0 +1,293 @@
+import argparse
+import json
+import math
+import os
+import statistics
+import time
+from datetime import datetime
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+import metrics
+
+# 体感温度(calcet)の傾向からエアコンを先回りして入れる
+#
+# 直近FIT秒の履歴に最小二乗で直線を当てはめ、HORIZON秒後の体感温度を予測する。
+#  動作中: 予測がCOLDを下回る(HOTを上回る)なら今のうちに暖房(冷房)を入れる
+#   入れたのにRETRY秒たっても効いていなければ(赤外線が届かなかったなど)送り直す(RETRY秒に1回まで)
+#  休止中: 朝(timerのmorning)に目標の体感温度になっているよう、
+#   学習した上がり方(下がり方)から逆算した時刻に入れる(最大MAX_LEAD秒前)
+# 切ってから(手動やAPI、夜など)HOLD秒は入れない
+# 上がり方はエアコンを入れた記録と履歴から学習する(運転ごとの傾きの中央値)
+#
+# 判断はdecide()に入力をまとめて渡して行い、入力と結果を'climate {...}'として記録する。
+#  python3 climate.py -d ./logs で記録した判断を今のdecide()で再現し、違うものを表示する
+
+# 体感温度(℃)
+COLD = 19.0
+HOT = 28.0
+HEAT_TARGET = 23.0
+COOL_TARGET = 27.0
+# 秒
+FIT = 30 * 60
+HORIZON = 20 * 60
+RETRY = 60 * 60
+HOLD = 60 * 60
+MAX_LEAD = 2 * 60 * 60
+MARGIN = 5 * 60
+# 入れてから効き始めるまで(学習ではこの後RUN_FIT秒を使う)
+SETTLE = 5 * 60
+RUN_FIT = 30 * 60
+# 当てはめに使う最少の点数と期間
+MIN_SAMPLES = 12
+MIN_SPAN = 10 * 60
+# 傾向の上限(℃/秒)、外れ値で大きく先回りしないように
+MAX_SLOPE = 3.0 / 3600
+# 学習前の上がり方(℃/秒)
+RATES = {'heating': 2.0 / 3600, 'cooling': -1.5 / 3600}
+LEARN_RUNS = 10
+KEEP_RUNS = 50
+# 何もしないときの判断を記録する間隔(秒)
+TRACE = 60
+
+# 直線y = slope * (t - at) + valueを当てはめる
+#  (slope, value, 残差の二乗平均平方根, 点数)、点が足りなければNone
+def fit(ts, ys, at):
+  if numpy is not None:
+    ts = numpy.asarray(ts, dtype=numpy.float64)
+    ys = numpy.asarray(ys, dtype=numpy.float64)
+    ok = numpy.isfinite(ys)
+    (ts, ys) = (ts[ok], ys[ok])
+    n = len(ts)
+    if n < MIN_SAMPLES or ts[-1] - ts[0] < MIN_SPAN:
+      return None
+    a = numpy.column_stack((ts - at, numpy.ones(n)))
+    coef = numpy.linalg.lstsq(a, ys, rcond=None)[0]
+    rmse = math.sqrt(float(numpy.mean((ys - a @ coef) ** 2)))
+    return float(coef[0]), float(coef[1]), rmse, n
+  points = [(t - at, y) for (t, y) in zip(ts, ys) if math.isfinite(y)]
+  n = len(points)
+  if n < MIN_SAMPLES or points[-1][0] - points[0][0] < MIN_SPAN:
+    return None
+  mx = sum(x for (x, y) in points) / n
+  my = sum(y for (x, y) in points) / n
+  sxx = sum((x - mx) ** 2 for (x, y) in points)
+  slope = sum((x - mx) * (y - my) for (x, y) in points) / sxx
+  value = my - slope * mx
+  rmse = math.sqrt(sum((y - slope * x - value) ** 2 for (x, y) in points) / n)
+  return slope, value, rmse, n
+
+# 入力xから(暖房/冷房/None, 理由)を決める。xは記録した判断の'x'と同じ
+#  now, e(体感温度), slope(℃/秒、なければNone), active(動作中), running(運転中の種類),
+#  started(運転を始めた時刻), resent(最後に送り直した時刻), off(最後に切った時刻),
+#  morning(次の朝の時刻), rates(学習した上がり方)
+def decide(x):
+  now = x['now']
+  e = x['e']
+  slope = max(-MAX_SLOPE, min(MAX_SLOPE, x['slope'] or 0.0))
+  running = x['running']
+  off = x.get('off')
+  if running is None and off is not None and now - off < HOLD:
+    return None, f'off {(now - off) / 60:.0f} min ago'
+  if x['active']:
+    p = e + slope * HORIZON
+    if running is None:
+      if min(e, p) < COLD:
+        return 'heating', f'{p:.1f} in {HORIZON // 60} min < {COLD}'
+      if max(e, p) > HOT:
+        return 'cooling', f'{p:.1f} in {HORIZON // 60} min > {HOT}'
+      return None, 'comfortable'
+    if now - max(x['started'], x.get('resent') or 0) >= RETRY:
+      # 入れたのに効いていない
+      if running == 'heating' and e < COLD and slope <= 0:
+        return 'heating', f'not warming after {(now - x["started"]) / 60:.0f} min'
+      if running == 'cooling' and e > HOT and slope >= 0:
+        return 'cooling', f'not cooling after {(now - x["started"]) / 60:.0f} min'
+    return None, f'{running} running'
+
+  morning = x['morning']
+  if running is not None or morning is None or not 0 < morning - now <= MAX_LEAD:
+    return None, 'idle'
+  # 朝の体感温度(このままの場合)
+  p = e + slope * (morning - now)
+  if p < HEAT_TARGET:
+    (mode, need) = ('heating', HEAT_TARGET - p)
+  elif p > COOL_TARGET:
+    (mode, need) = ('cooling', p - COOL_TARGET)
+  else:
+    return None, f'{p:.1f} at morning'
+  lead = need / abs(x['rates'][mode]) + MARGIN
+  if morning - now <= lead:
+    return mode, f'{p:.1f} at morning, {lead / 60:.0f} min to {HEAT_TARGET if mode == "heating" else COOL_TARGET}'
+  return None, f'{mode} in {(morning - now - lead) / 60:.0f} min'
+
+class Climate():
+  def __init__(self, logger, history, path):
+    self.logger = logger
+    self.history = history
+    self.path = path
+    self.channel = history.channels.index('etemp')
+    self.rates = dict(RATES)
+    # [{'mode', 'start', 'end', 'resent'}] endは運転中ならNone、resentは送り直したときだけ
+    self.runs = []
+    # 最後に切った時刻
+    self.off = None
+    # 最後の当てはめ(fit()の結果)
+    self.trend = None
+    self.traced = 0
+    self.load()
+    self.learn()
+    metrics.gauge('room_climate_rate', 'learned effective temperature change per hour with the ac on',
+      lambda: { (('mode', m),): r * 3600 for (m, r) in self.rates.items() })
+
+  @property
+  def running(self):
+    if self.runs and self.runs[-1]['end'] is None:
+      return self.runs[-1]['mode']
+    return None
+
+  def load(self):
+    try:
+      with open(self.path) as f:
+        state = json.load(f)
+      self.runs = state.get('runs', [])
+      self.off = state.get('off')
+      # 履歴に残っていない運転の分は保存した値を使う
+      self.rates.update(state.get('rates', {}))
+    except (OSError, ValueError):
+      self.runs = []
+
+  def save(self):
+    os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+    with open(self.path + '.tmp', 'w') as f:
+      json.dump({ 'runs': self.runs[-KEEP_RUNS:], 'rates': self.rates, 'off': self.off }, f)
+    os.replace(self.path + '.tmp', self.path)
+
+  # [start, end]の(時刻, 体感温度)
+  def samples(self, start, end):
+    if numpy is None:
+      rows = [(r[0], r[1 + self.channel]) for r in self.history.read(start, end)]
+      return [r[0] for r in rows], [r[1] for r in rows]
+    dtype = numpy.dtype([('t', '<f8'), ('v', '<f4', (len(self.history.channels),)), ('crc', '<u4')])
+    rec = numpy.frombuffer(b''.join(self.history.chunks(start, end)), dtype=dtype)
+    return rec['t'], rec['v'][:, self.channel]
+
+  # エアコンを入れた(同じ種類を送り直しただけなら続きとして扱う)
+  def started(self, mode, now=None):
+    now = time.time() if now is None else now
+    if self.running == mode:
+      self.runs[-1]['resent'] = now
+      self.save()
+      return
+    if self.running is not None:
+      self.runs[-1]['end'] = now
+    self.runs.append({ 'mode': mode, 'start': now, 'end': None })
+    self.save()
+
+  # エアコンを切った(運転を記録していなくてもHOLD秒は入れない)
+  def stopped(self, now=None):
+    now = time.time() if now is None else now
+    self.off = now
+    if self.running is not None:
+      self.runs[-1]['end'] = now
+      self.learn()
+    self.save()
+
+  # 運転ごとの効き始めてからの傾きの中央値を上がり方とする
+  def learn(self, now=None):
+    now = time.time() if now is None else now
+    for mode in RATES:
+      slopes = []
+      for run in reversed(self.runs):
+        if len(slopes) >= LEARN_RUNS:
+          break
+        end = now if run['end'] is None else run['end']
+        if run['mode'] != mode or end - run['start'] < SETTLE + MIN_SPAN:
+          continue
+        start = run['start'] + SETTLE
+        end = min(end, start + RUN_FIT)
+        (ts, ys) = self.samples(start, end)
+        f = fit(ts, ys, end)
+        # 逆向きなら窓を開けていたなど、学習しない
+        if f is not None and f[0] * RATES[mode] > 0:
+          slopes.append(f[0])
+      if slopes:
+        rate = statistics.median(slopes)
+        if rate != self.rates[mode]:
+          self.logger.info(f'learned {mode} rate {rate * 3600:+.2f} C/h from {len(slopes)} runs')
+        self.rates[mode] = rate
+
+  # 今の傾向(fit()の結果)
+  def fittrend(self, now):
+    (ts, ys) = self.samples(now - FIT, now)
+    self.trend = fit(ts, ys, now)
+    return self.trend
+
+  # 手動や朝に入れるときの種類(HORIZON秒後の予測で決める)
+  def choose(self, e):
+    slope = max(-MAX_SLOPE, min(MAX_SLOPE, self.trend[0])) if self.trend is not None else 0.0
+    p = e + slope * HORIZON
+    if p < HEAT_TARGET:
+      return 'heating'
+    if p > COOL_TARGET:
+      return 'cooling'
+    return None
+
+  # 定期的に呼び、入れるべき種類を返す(入れたらstarted()を呼ぶこと)
+  #  e: 今の体感温度、active: 動作中か、morning: 次の朝の時刻
+  def update(self, e, active, morning, now=None):
+    now = time.time() if now is None else now
+    trend = self.fittrend(now)
+    run = self.runs[-1] if self.runs else None
+    if run is not None and run['end'] is None and not run.get('learned') and now - run['start'] >= SETTLE + RUN_FIT:
+      # 運転中でも十分たてば学習する
+      run['learned'] = True
+      self.learn(now)
+    x = {
+      'now': now,
+      'e': e,
+      'slope': trend[0] if trend is not None else None,
+      'rmse': trend[2] if trend is not None else None,
+      'n': trend[3] if trend is not None else 0,
+      'active': active,
+      'running': self.running,
+      'started': run['start'] if self.running is not None else None,
+      'resent': run.get('resent') if self.running is not None else None,
+      'off': self.off,
+      'morning': morning,
+      'rates': dict(self.rates) }
+    (mode, reason) = decide(x)
+    if mode is not None or now - self.traced >= TRACE:
+      self.traced = now
+      self.logger.info('climate ' + json.dumps({ 'x': x, 'action': mode, 'reason': reason }))
+    return mode
+
+if __name__ == '__main__':
+  import clog
+  from api import parsetime
+
+  p = argparse.ArgumentParser(description='replay climate decisions from room logs')
+  p.add_argument('-d', '--dir', default='./logs', help='log directory')
+  p.add_argument('-f', '--from', dest='start', type=parsetime, help='start time (epoch seconds or ISO 8601)')
+  p.add_argument('-t', '--to', dest='end', type=parsetime, help='end time (epoch seconds or ISO 8601)')
+  p.add_argument('-a', '--all', action='store_true', help='print every decision, not only the changed ones')
+  args = p.parse_args()
+
+  (total, changed) = (0, 0)
+  for r in clog.query(args.dir, args.start, args.end):
+    msg = r.get('msg', '')
+    if not msg.startswith('climate {'):
+      continue
+    trace = json.loads(msg[len('climate '):])
+    (mode, reason) = decide(trace['x'])
+    total += 1
+    if mode != trace['action']:
+      changed += 1
+    elif not args.all:
+      continue
+    t = datetime.fromtimestamp(trace['x']['now']).strftime('%Y-%m-%d %H:%M:%S')
+    print(f"{t} e={trace['x']['e']:.1f} logged={trace['action']} ({trace['reason']}) now={mode} ({reason})")
+  print(f'{changed} of {total} decisions changed')
@@ -1,44 +1,314 @@
+import argparse
+import atexit
+import gzip
+import json
 import logging
+import logging.handlers
+import math
 import os
-from datetime import datetime
+import queue
+import re
+import selectors
 import sys
+import threading
+import time
+from datetime import datetime
+
+# 子プロセスの出力を読むスレッド(全てのパイプを1つのselectorで読む)
+class Capture():
+  def __init__(self):
+    self.selector = selectors.DefaultSelector()
+    self.lock = threading.Lock()
+    # 読み口: (LoggerWriter, 行の途中)
+    self.pipes = {}
+    (self.rwake, self.wwake) = os.pipe()
+    os.set_blocking(self.rwake, False)
+    self.selector.register(self.rwake, selectors.EVENT_READ)
+    self.thread = threading.Thread(target=self.run, name='capture', daemon=True)
+    self.thread.start()
+
+  # 新しいパイプを作り、書き口を返す
+  def open(self, writer):
+    (r, w) = os.pipe()
+    os.set_blocking(r, False)
+    with self.lock:
+      self.pipes[r] = (writer, b'')
+      self.selector.register(r, selectors.EVENT_READ)
+    os.write(self.wwake, b'\0')
+    return w
+
+  def run(self):
+    while True:
+      for (key, mask) in self.selector.select():
+        if key.fd == self.rwake:
+          try:
+            os.read(self.rwake, 4096)
+          except BlockingIOError:
+            pass
+          continue
+        self.read(key.fd)
 
+  def read(self, fd):
+    try:
+      data = os.read(fd, 65536)
+    except BlockingIOError:
+      return
+    except OSError:
+      data = b''
+    with self.lock:
+      (writer, rest) = self.pipes[fd]
+    if not data:
+      # 書き口が全て閉じた
+      with self.lock:
+        self.selector.unregister(fd)
+        del self.pipes[fd]
+      os.close(fd)
+      if rest:
+        writer.line(rest.decode('utf-8', 'replace'))
+      writer.suppressed()
+      return
+    lines = (rest + data).split(b'\n')
+    with self.lock:
+      self.pipes[fd] = (writer, lines.pop())
+    for line in lines:
+      writer.line(line.decode('utf-8', 'replace'))
+
+capture = None
+capturelock = threading.Lock()
+
+def getcapture():
+  global capture
+  with capturelock:
+    if capture is None:
+      capture = Capture()
+    return capture
+
+# ログに書くファイルのようなもの
+#  sys.stdoutなどに置き換えるとwrite()で、subprocessに渡すとfileno()のパイプで受け取る
+#  patternsのどれかを含む行があればcallback(pattern, line)を呼ぶ
+#  1秒にrate行を超える分はログに書かない(patternsは調べる)
 class LoggerWriter():
-  def __init__(self, logger, level, patterns=[], callback=None):
+  def __init__(self, logger, level, patterns=[], callback=None, rate=20, burst=50):
     self.level = level
     self.logger = logger
     self.patterns = patterns
     self.callback = callback
-    
+    # 全てのパターンを1回で探す
+    self.regex = re.compile('|'.join(re.escape(p) for p in patterns)) if patterns else None
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.refilled = time.monotonic()
+    self.dropped = 0
+    self.fds = []
+
   def write(self, buf):
     for line in buf.rstrip().splitlines():
-      t = line.rstrip()
+      self.line(line)
+
+  def line(self, line):
+    t = line.rstrip()
+    if not t:
+      return
+    now = time.monotonic()
+    self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+    self.refilled = now
+    if self.tokens >= 1:
+      self.tokens -= 1
+      self.suppressed()
       self.logger.log(self.level, t)
-      
-      matched = None
-      for pattern in self.patterns:
-        if pattern in t:
-          matched = pattern
-          break
-      if matched:
-        callback(matched, t)
+    else:
+      self.dropped += 1
+
+    if self.regex is not None:
+      m = self.regex.search(t)
+      if m and self.callback is not None:
+        try:
+          self.callback(m.group(0), t)
+        except Exception:
+          self.logger.exception(f'callback for {m.group(0)} failed')
+
+  # 書かなかった行の数
+  def suppressed(self):
+    if self.dropped > 0:
+      self.logger.log(self.level, f'({self.dropped} lines suppressed)')
+      self.dropped = 0
 
   def flush(self):
-    self.logger.log(self.level, sys.stderr)
+    pass
+
+  # 子プロセス用のパイプの書き口。起動したらclose()で親の分を閉じる
   def fileno(self):
-    # emulate fileno
-    if self.level == logging.DEBUG:
-      return 1
-    elif self.level == logging.INFO:
-      return 1
-    elif self.level == logging.WARNING:
-      return 2
-    elif self.level == logging.ERROR:
-      return 2
-    elif self.level == logging.CRITICAL:
-      return 2
-    else:
-      return 2
+    fd = getcapture().open(self)
+    self.fds.append(fd)
+    return fd
+
+  def close(self):
+    for fd in self.fds:
+      os.close(fd)
+    self.fds = []
+
+  def __del__(self):
+    self.close()
+
+# ログの保存
+#
+# 1行1レコードのJSON({"t": epoch秒, "level", "thread", "msg", "exc"})を./logs/*.jsonlに書く。
+# SEGMENTバイトを超えたら次のファイルに移り、閉じたファイルは別スレッドでgzipにする。
+# gzipはBLOCKバイトごとに別のメンバーにし、.idxに各メンバーの時刻の範囲と位置を書いておく。
+# 検索では範囲に入るメンバーだけを展開する。合計がTOTALバイトを超えたら古いものから消す
+
+SEGMENT = 4 * 1024 * 1024
+TOTAL = 64 * 1024 * 1024
+BLOCK = 256 * 1024
+
+class JSONFormatter(logging.Formatter):
+  def format(self, record):
+    r = { 't': round(record.created, 3), 'level': record.levelname,
+      'thread': record.threadName, 'msg': record.getMessage() }
+    if record.exc_info:
+      r['exc'] = self.formatException(record.exc_info)
+    if record.stack_info:
+      r['stack'] = self.formatStack(record.stack_info)
+    return json.dumps(r, ensure_ascii=False)
+
+class SegmentHandler(logging.Handler):
+  def __init__(self, logdir, segment=SEGMENT, total=TOTAL):
+    super(SegmentHandler, self).__init__()
+    self.logdir = logdir
+    self.segment = segment
+    self.total = total
+    self.setFormatter(JSONFormatter())
+    self.closed = queue.Queue()
+    self.stream = None
+    # 前回閉じずに終わったファイルも圧縮する
+    for name in sorted(os.listdir(logdir)):
+      if name.endswith('.jsonl'):
+        self.closed.put(os.path.join(logdir, name))
+    self.open()
+    self.compressor = threading.Thread(target=self.compressrun, name='logcompress', daemon=True)
+    self.compressor.start()
+
+  def open(self):
+    self.path = os.path.join(self.logdir, datetime.now().strftime('%Y%m%d-%H%M%S-%f') + '.jsonl')
+    self.stream = open(self.path, 'a', encoding='utf-8')
+    self.size = 0
+
+  def emit(self, record):
+    try:
+      line = self.format(record) + '\n'
+      self.stream.write(line)
+      self.stream.flush()
+      self.size += len(line.encode('utf-8'))
+      if self.size >= self.segment:
+        self.stream.close()
+        self.closed.put(self.path)
+        self.open()
+    except Exception:
+      self.handleError(record)
+
+  def close(self):
+    if self.stream is not None:
+      self.stream.close()
+      self.stream = None
+    super(SegmentHandler, self).close()
+
+  def compressrun(self):
+    while True:
+      path = self.closed.get()
+      try:
+        compress(path)
+        self.trim()
+      except Exception as e:
+        # ログを書く処理の中なのでloggerは使わない
+        print(f'failed to compress {path}: {e}', file=sys.__stderr__)
+
+  # 合計がtotalを超えたら古い圧縮済みのファイルから消す
+  #  索引(.jsonl.idx)は本体と一緒に消し、大きさにも含める
+  def trim(self):
+    files = set(os.listdir(self.logdir))
+    for name in files:
+      # 本体のない索引(消す途中で落ちた)
+      if name.endswith('.jsonl.idx') and name[:-4] not in files and name[:-4] + '.gz' not in files:
+        os.remove(os.path.join(self.logdir, name))
+    names = sorted(n for n in files if n.endswith('.jsonl.gz') or n.endswith('.jsonl'))
+    sizes = []
+    for name in names:
+      size = os.path.getsize(os.path.join(self.logdir, name))
+      idx = name[:-3] + '.idx' if name.endswith('.gz') else name + '.idx'
+      if idx in files:
+        size += os.path.getsize(os.path.join(self.logdir, idx))
+      sizes.append(size)
+    total = sum(sizes)
+    for (name, size) in zip(names, sizes):
+      if total <= self.total or not name.endswith('.gz'):
+        break
+      # 本体を先に消す(索引だけ残っても次のtrimで消える)
+      os.remove(os.path.join(self.logdir, name))
+      if name[:-3] + '.idx' in files:
+        os.remove(os.path.join(self.logdir, name[:-3] + '.idx'))
+      total -= size
+
+# path(.jsonl)をBLOCKごとのgzipメンバーにし、索引(.jsonl.idx)を作る
+def compress(path):
+  blocks = []
+  with open(path, 'rb') as f, open(path + '.gz.tmp', 'wb') as out:
+    while True:
+      chunk = f.read(BLOCK)
+      if not chunk:
+        break
+      # 行の途中で切らない
+      chunk += f.readline()
+      lines = chunk.splitlines()
+      (first, last) = (linetime(lines[0]), linetime(lines[-1]))
+      data = gzip.compress(chunk)
+      blocks.append([first, last, out.tell(), len(data)])
+      out.write(data)
+  times = [t for b in blocks for t in b[:2] if t is not None]
+  with open(path + '.idx.tmp', 'w') as f:
+    json.dump({ 'first': min(times, default=None), 'last': max(times, default=None), 'blocks': blocks }, f)
+  os.replace(path + '.gz.tmp', path + '.gz')
+  os.replace(path + '.idx.tmp', path + '.idx')
+  os.remove(path)
+
+def linetime(line):
+  try:
+    return json.loads(line)['t']
+  except (ValueError, KeyError, TypeError):
+    return None
+
+# [start, end]のレコードを古い順に返す
+def query(logdir, start=None, end=None):
+  start = -math.inf if start is None else start
+  end = math.inf if end is None else end
+  for name in sorted(os.listdir(logdir)):
+    path = os.path.join(logdir, name)
+    if name.endswith('.jsonl.gz'):
+      try:
+        with open(path[:-3] + '.idx') as f:
+          index = json.load(f)
+      except (OSError, ValueError):
+        continue
+      if index['first'] is None or index['last'] < start or index['first'] > end:
+        continue
+      with open(path, 'rb') as f:
+        for (first, last, offset, length) in index['blocks']:
+          if (last is not None and last < start) or (first is not None and first > end):
+            continue
+          f.seek(offset)
+          yield from records(gzip.decompress(f.read(length)).splitlines(), start, end)
+    elif name.endswith('.jsonl'):
+      with open(path, 'rb') as f:
+        yield from records(f, start, end)
+
+def records(lines, start, end):
+  for line in lines:
+    try:
+      r = json.loads(line)
+    except ValueError:
+      continue
+    if start <= r.get('t', 0) <= end:
+      yield r
 
 def initlogger():
     logdir = './logs'
@@ -50,14 +320,51 @@ def initlogger():
         logger.setLevel(logging.DEBUG)
     else:
         logger.setLevel(logging.INFO)
-    logFormatter = logging.Formatter(fmt='%(asctime)s %(levelname)s: %(message)s',
-                                     datefmt='%Y%m%d-%H%M')
-    fileHandler = logging.FileHandler(f'{logdir}/{starttime}')
-    fileHandler.setFormatter(logFormatter)
-    logger.addHandler(fileHandler)
+    logFormatter = logging.Formatter(fmt='%(asctime)s %(levelname)s: %(message)s')
+    fileHandler = SegmentHandler(logdir,
+        int(os.environ.get('LOG_SEGMENT', default=SEGMENT)), int(os.environ.get('LOG_TOTAL', default=TOTAL)))
     consoleHandler = logging.StreamHandler()
     consoleHandler.setFormatter(logFormatter)
-    logger.addHandler(consoleHandler)
+    # ファイルや端末への書き込みは別スレッドで行い、ログを出す側を待たせない
+    logqueue = queue.Queue()
+    logger.addHandler(logging.handlers.QueueHandler(logqueue))
+    listener = logging.handlers.QueueListener(logqueue, fileHandler, consoleHandler)
+    listener.start()
+    atexit.register(listener.stop)
     sys.stdout = LoggerWriter(logger, logging.DEBUG)
     sys.stderr = LoggerWriter(logger, logging.WARNING)
     return logger, starttime
+
+# ログの検索
+#  python3 clog.py --from 2026-10-18T06:00 --to 2026-10-18T07:00 --level WARNING --grep rtmpdump
+if __name__ == '__main__':
+  # APIのfrom/toと同じ書式
+  from api import parsetime
+
+  p = argparse.ArgumentParser(description='query room logs')
+  p.add_argument('-d', '--dir', default='./logs', help='log directory')
+  p.add_argument('-f', '--from', dest='start', type=parsetime, help='start time (epoch seconds or ISO 8601)')
+  p.add_argument('-t', '--to', dest='end', type=parsetime, help='end time (epoch seconds or ISO 8601)')
+  p.add_argument('-l', '--level', default='DEBUG', help='minimum level')
+  p.add_argument('-g', '--grep', help='regular expression for messages')
+  p.add_argument('-j', '--json', action='store_true', help='print JSON lines')
+  args = p.parse_args()
+
+  level = logging.getLevelName(args.level.upper())
+  pattern = re.compile(args.grep) if args.grep else None
+  try:
+    for r in query(args.dir, args.start, args.end):
+      if logging.getLevelName(r.get('level')) < level:
+        continue
+      if pattern and not pattern.search(r.get('msg', '')):
+        continue
+      if args.json:
+        print(json.dumps(r, ensure_ascii=False))
+      else:
+        t = datetime.fromtimestamp(r['t']).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        print(f"{t} {r.get('level')} [{r.get('thread')}] {r.get('msg')}")
+        for k in ('exc', 'stack'):
+          if k in r:
+            print(r[k])
+  except BrokenPipeError:
+    pass
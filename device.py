@@ -1,38 +1,121 @@
+import os
 import pigpio
 import bme280i2c
+import queue
 import time
 import tsl2572
-import logging
-import subprocess
+import irrp
+import metrics
 
-import clog
+class Button():
+  # イベントの種類
+  SHORT = 1
+  LONG = 2
+  DOUBLE = 3
+
+  # pigpioのエッジコールバックでボタンを検出し、(name, kind, tick)をeventsに入れる
+  # 押すと0(プルアップ)。tickはpigpioのマイクロ秒
+  def __init__(self, io, gpio, name, events, debounce=20, long=1.0, double=0.3):
+    self.io = io
+    self.gpio = gpio
+    self.name = name
+    self.events = events
+    self.long = int(long * 1000000)
+    self.double = int(double * 1000000)
+    self.doublems = int(double * 1000)
+    self.pressed = None # 押した時のtick
+    self.released = None # 未確定のshortを離した時のtick
+    self.io.set_mode(gpio, pigpio.INPUT)
+    # debounce ms 安定するまでエッジを通知しない
+    self.io.set_glitch_filter(gpio, debounce * 1000)
+    self.cb = self.io.callback(gpio, pigpio.EITHER_EDGE, self.edge)
+
+  def edge(self, gpio, level, tick):
+    if level == pigpio.TIMEOUT:
+      # ダブルクリック待ちが終わったのでshortを確定
+      self.io.set_watchdog(self.gpio, 0)
+      if self.released is not None:
+        self.events.put((self.name, Button.SHORT, self.released))
+        self.released = None
+    elif level == 0:
+      # press
+      self.pressed = tick
+    elif self.pressed is not None:
+      # release
+      held = pigpio.tickDiff(self.pressed, tick)
+      if held >= self.long:
+        self.events.put((self.name, Button.LONG, tick))
+        self.released = None
+      elif self.released is not None and \
+        pigpio.tickDiff(self.released, self.pressed) <= self.double:
+        self.io.set_watchdog(self.gpio, 0)
+        self.events.put((self.name, Button.DOUBLE, tick))
+        self.released = None
+      else:
+        self.released = tick
+        self.io.set_watchdog(self.gpio, self.doublems)
+      self.pressed = None
+
+  def cancel(self):
+    self.cb.cancel()
+    self.io.set_watchdog(self.gpio, 0)
+    self.io.set_glitch_filter(self.gpio, 0)
 
 class Device():
-  def __init__(self, logger, radio):
+  def __init__(self, logger, radio, events=None):
     self.logger = logger
     self.radio = radio
 
+    # SW1, SW2のイベントはeventsに入る(APIのコマンドと共有できる)
+    self.events = queue.Queue() if events is None else events
+    self.ledpin = [27, 22, 18, 17]
+    self.connect()
+    # IR送信の要求から音が戻るまでの秒数(最後の値)
+    self.irlatency = None
+
+    self.tsl = tsl2572.TSL2572(0x39)
+    # BME280_MODE=forced で測定ごとに起動(低消費電力)、既定は連続測定
+    if os.environ.get('BME280_MODE', default='normal') == 'forced':
+      self.bmemode = bme280i2c.BME280I2C.MODE_FORCED
+    else:
+      self.bmemode = bme280i2c.BME280I2C.MODE_NORMAL
+    self.bmech1 = bme280i2c.BME280I2C(0x76, self.bmemode)
+    self.bmech2 = bme280i2c.BME280I2C(0x77, self.bmemode)
+
+  # pigpiodにつなぎ、ボタン・LED・赤外線送信を準備する
+  def connect(self):
     # GPIOの準備
     self.io = pigpio.pi()
+    if not self.io.connected:
+      raise ConnectionError("can't connect to pigpiod")
 
     # SW1, SW2ピン入力設定
-    self.io.set_mode(5, pigpio.INPUT)
-    self.io.set_mode(6, pigpio.INPUT)
+    self.buttons = [
+      Button(self.io, 5, 'sw1', self.events),
+      Button(self.io, 6, 'sw2', self.events)]
 
     # LED1, 2, 3, 4ピン出力設定
-    self.ledpin = [27, 22, 18, 17]
     for i in range(4):
       self.io.set_mode(self.ledpin[i], pigpio.OUTPUT)
-    
+
     # human sensor
     # GPIO.setup(23, GPIO.IN)
 
-    self.sw1press = 0
-    self.sw2press = 0
+    # 赤外線送信(GPIO13)
+    self.ir = irrp.IRTransmitter(self.io, 13, 'ir/data', logger=self.logger)
 
-    self.tsl = tsl2572.TSL2572(0x39)
-    self.bmech1 = bme280i2c.BME280I2C(0x76)
-    self.bmech2 = bme280i2c.BME280I2C(0x77)
+  # pigpiodが再起動したらつなぎ直す(古い接続は使わない)
+  def reconnect(self):
+    self.logger.warning('lost pigpiod, reconnecting')
+    try:
+      for b in self.buttons:
+        b.cb.cancel()
+      self.ir.close()
+      self.io.stop()
+    except Exception:
+      # 切れた接続の後始末の失敗は構わない
+      pass
+    self.connect()
 
   def all(self, mode):
     for b in range(3):
@@ -51,61 +134,54 @@ class Device():
   # def human(self):
   #   return int(1==GPIO.input(23))
 
-  def sw1(self):
-    if self.io.read(5):
-      #release
-      if self.sw1press != 0:
-        ret = 1
-        if time.time() - self.sw1press > 1:
-          ret = 2
-        self.sw1press = 0
-        return ret
-      else:
-        return 0
-    else:
-      #press
-      if self.sw1press == 0:
-        self.sw1press = time.time()
-      return 0
-
-  def sw2(self):
-    if self.io.read(6):
-      #release
-      if self.sw2press != 0:
-        ret = 1
-        if time.time() - self.sw2press > 1:
-          ret = 2
-        self.sw2press = 0
-        return ret
-      else:
-        return 0
-    else:
-      #press
-      if self.sw2press == 0:
-        self.sw2press = time.time()
-      return 0
-      
+  @metrics.timed('room_sensor_seconds', 'sensor reads', op='lux')
   def lux(self):
+    # (照度, 測定した時刻) 初回だけ測定を待ち、以降は連続測定の最新値を返す(待たない)
+    #  連続測定が止まっていれば時刻は進まない
+    if self.tsl.continuous:
+      return self.tsl.read(), self.tsl.updated
     if self.tsl.id_read():
       self.tsl.meas_single()
-      return self.tsl.lux
+      self.tsl.start_continuous()
+      return self.tsl.lux, self.tsl.updated
     else:
       raise Exception('TSL2572 failed to read id')
 
-  def tph(self):
-    if self.bmech1.meas(): # 外付け
+  @metrics.timed('room_sensor_seconds', 'sensor reads', op='tph')
+  def tph(self, mode=None):
+    if mode is None:
+      mode = self.bmemode
+    if self.bmech1.meas(mode): # 外付け
       return (self.bmech1.T, self.bmech1.P, self.bmech1.H / 100.0)
-    elif self.bmech2.meas(): # 内蔵
+    elif self.bmech2.meas(mode): # 内蔵
       return (self.bmech2.T, self.bmech2.P, self.bmech2.H / 100.0)
     else:
       raise Exception('BME280 failed to read')
 
+  @metrics.timed('room_ir_send_seconds', 'IR sends including mute and unmute')
   def sendir(self, name):
-    self.radio.pause()
-    command = ['python3', 'irrp.py', '-p', '-g13', '-f', 'ir/data', name]
-    self.logger.info('executing command: {}'.format(' '.join(command)))
-    subprocess.run(command, stdout=clog.LoggerWriter(self.logger, logging.DEBUG), stderr=clog.LoggerWriter(self.logger, logging.WARNING))
-    self.radio.resume()
+    if name not in self.ir:
+      self.logger.warning(f'ir code {name} not found')
+      return
+    # 送信中は音だけ消す(ストリームはつないだまま)
+    requested = time.time()
+    muted = self.radio.mute()
+    try:
+      try:
+        latency = self.ir.send(name)
+      except ConnectionError:
+        self.reconnect()
+        latency = self.ir.send(name)
+      self.logger.info(f'sent ir {name} in {latency * 1000:.1f} ms')
+    finally:
+      if muted:
+        self.radio.unmute()
+        self.irlatency = time.time() - requested
+        self.logger.info(f'audio back {self.irlatency * 1000:.1f} ms after ir {name} request')
 
   def close(self):
-    pass
+    for b in self.buttons:
+      b.cancel()
+    # pigpiodは切断してもwaveを残すので消してから切る
+    self.ir.close()
+    self.io.stop()
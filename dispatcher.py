@@ -0,0 +1,134 @@
+import time
+
+import metrics
+
+# APIから届いたコマンドをまとめて実行する
+#
+# 溜まっているコマンドを一度に取り出し、
+#  同じコマンドの繰り返しは1回にまとめる(radio-nextは回数を数えて1回で進める)
+#  ac-onの後のac-offのように打ち消し合うものは両方捨てる
+#  radio-nextの後のradio-stopはradio-stopだけにする
+# 残ったものを優先度順(ac-offなど安全側が先)に実行する。
+# 同じグループ内の順序は変わらない
+#
+# コマンドは{'command': ..., 'enqueued': 時刻, 'future': concurrent.futures.Future(任意)}
+
+# 名前: (優先度, グループ, 回数を数えるか)
+COMMANDS = {
+  'ac-off': (0, 'ac', False),
+  'radio-stop': (0, 'radio', False),
+  'iris-off': (1, 'iris', False),
+  'ac-on': (2, 'ac', False),
+  'iris-on': (2, 'iris', False),
+  'radio-next': (3, 'radio', True),
+}
+# (先, 後): 打ち消し合う
+CANCELS = {
+  ('ac-on', 'ac-off'), ('ac-off', 'ac-on'),
+  ('iris-on', 'iris-off'), ('iris-off', 'iris-on'),
+}
+# (先, 後): 後だけ残す
+SUPERSEDES = {
+  ('radio-next', 'radio-stop'),
+}
+
+class Op():
+  __slots__ = ('command', 'count', 'items')
+
+  def __init__(self, command, item):
+    self.command = command
+    self.count = 1
+    self.items = [item]
+
+class Dispatcher():
+  def __init__(self, logger, handlers):
+    self.logger = logger
+    # 名前: 関数(回数を数えるコマンドは回数を引数に取る)
+    self.handlers = handlers
+    # 名前: [回数, 合計, 最大, 最後] (キューに入ってから完了するまでの秒数)
+    self.latency = {}
+
+  # まとめた実行単位のリストを返す。捨てたコマンドは完了にする
+  def coalesce(self, items):
+    ops = []
+    for item in items:
+      c = item.get('command')
+      if c not in COMMANDS:
+        ops.append(Op(c, item))
+        continue
+      group = COMMANDS[c][1]
+      last = None
+      for op in reversed(ops):
+        if op.command in COMMANDS and COMMANDS[op.command][1] == group:
+          last = op
+          break
+      if last is None:
+        ops.append(Op(c, item))
+      elif last.command == c:
+        if COMMANDS[c][2]:
+          last.count += 1
+        last.items.append(item)
+      elif (last.command, c) in CANCELS:
+        ops.remove(last)
+        self.finish(last.items, { 'command': last.command, 'coalesced': 'cancelled' })
+        self.finish([item], { 'command': c, 'coalesced': 'cancelled' })
+      elif (last.command, c) in SUPERSEDES:
+        ops.remove(last)
+        self.finish(last.items, { 'command': last.command, 'coalesced': c })
+        ops.append(Op(c, item))
+      else:
+        ops.append(Op(c, item))
+    # 優先度順(同じ優先度なら届いた順)
+    ops.sort(key=lambda op: COMMANDS[op.command][0] if op.command in COMMANDS else len(COMMANDS))
+    return ops
+
+  # 取り出したコマンドをまとめて実行する
+  def dispatch(self, items):
+    for op in self.coalesce(items):
+      if len(op.items) > 1:
+        self.logger.debug(f'coalesced {len(op.items)} {op.command} commands')
+      handler = self.handlers.get(op.command)
+      if handler is None:
+        # クライアントの誤りなのでスタックは残さない
+        self.logger.warning(f'unknown command: {op.command}')
+        self.finish(op.items, error=ValueError(f'unknown command: {op.command}'))
+        continue
+      try:
+        if op.command in COMMANDS and COMMANDS[op.command][2]:
+          result = handler(op.count)
+        else:
+          result = handler()
+      except Exception as e:
+        self.logger.exception(f'command {op.command} failed')
+        self.finish(op.items, error=e)
+        continue
+      self.finish(op.items, { 'command': op.command, 'count': op.count, 'result': result })
+
+  # futureに結果を返し、待ち時間を記録する
+  def finish(self, items, result=None, error=None):
+    now = time.time()
+    for item in items:
+      c = item.get('command')
+      if c in COMMANDS and 'enqueued' in item:
+        self.record(c, now - item['enqueued'])
+      future = item.get('future')
+      if future is None or not future.set_running_or_notify_cancel():
+        # 待っていないか、待ち側がタイムアウトした
+        continue
+      if error is not None:
+        future.set_exception(error)
+      else:
+        future.set_result(result)
+
+  def record(self, command, latency):
+    metrics.histogram('room_command_latency_seconds', 'API commands from enqueue to completion', command=command).observe(latency)
+    s = self.latency.setdefault(command, [0, 0.0, 0.0, 0.0])
+    s[0] += 1
+    s[1] += latency
+    s[2] = max(s[2], latency)
+    s[3] = latency
+
+  # コマンドごとの待ち時間 {名前: {'count', 'mean', 'max', 'last'}}
+  def stats(self):
+    return { c: { 'count': n, 'mean': total / n, 'max': mx, 'last': last }
+      for (c, (n, total, mx, last)) in self.latency.items() }
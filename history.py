@@ -0,0 +1,286 @@
+import json
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+# 固定長レコード(時刻 + float32のチャネル)をmmapしたリングファイルに保存する
+#
+# header  magic, version, チャネル数, 容量(レコード数), チャネル名
+# slot 0/1 seq, head(これまでに追加した数), crc  交互に書き、有効で新しい方を使う
+# data    レコード(時刻 float64, チャネル float32..., crc32) x 容量
+#
+# レコードを書いてからheadを進めるので、途中で落ちても書きかけのレコードは読まれない。
+# ページの書き戻し順は保証されないので、開くときに末尾のレコードのcrcも確かめる。
+# 時刻は単調増加(範囲検索は二分探索)。時計が戻って古い時刻になったものは追加しない
+#
+# 追加(samplerスレッド)と読み出し(API、制御ループ)はlockで排他し、
+# 読み出しはCHUNKレコードずつlockを持ってコピーする(mmapのviewは渡さない)
+
+HEADER = struct.Struct('<4sHHQ')
+SLOT = struct.Struct('<QQI')
+MAGIC = b'RING'
+VERSION = 1
+SLOTS = (64, 96)
+NAMES = 128
+NAMESMAX = 256
+DATA = 4096
+CHUNK = 4096
+
+class History():
+  CHANNELS = ('temp', 'humid', 'press', 'lux', 'etemp')
+
+  def __init__(self, path, channels=CHANNELS, capacity=31 * 24 * 60 * 12, lock=None):
+    self.path = path
+    # 集計のリングは生の履歴と同じlockを使う
+    self.lock = threading.RLock() if lock is None else lock
+    self.channels = tuple(channels)
+    self.capacity = capacity
+    self.body = struct.Struct('<d' + 'f' * len(self.channels))
+    self.record = struct.Struct(self.body.format + 'I')
+    self.size = self.record.size
+    self.head = 0
+    self.seq = 0
+    names = ','.join(self.channels).encode('utf-8')
+    if len(names) > NAMESMAX:
+      raise ValueError('too many channels')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    if os.path.exists(path) and not self.compatible(path, names):
+      # チャネルや容量が違うファイルは残して作り直す
+      os.replace(path, path + '.old')
+    if not os.path.exists(path):
+      with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(self.channels), capacity))
+        f.seek(NAMES)
+        f.write(names)
+        f.truncate(DATA + capacity * self.size)
+
+    self.f = open(path, 'r+b')
+    self.mm = mmap.mmap(self.f.fileno(), 0)
+    self.recover()
+
+  def compatible(self, path, names):
+    with open(path, 'rb') as f:
+      header = f.read(DATA)
+    if len(header) < DATA or \
+      HEADER.unpack_from(header) != (MAGIC, VERSION, len(self.channels), self.capacity):
+      return False
+    return header[NAMES:NAMES + NAMESMAX].rstrip(b'\0') == names and \
+      os.path.getsize(path) == DATA + self.capacity * self.size
+
+  def recover(self):
+    # 有効なslotのうちseqが大きい方のheadを使う
+    best = (0, 0)
+    for off in SLOTS:
+      (seq, head, crc) = SLOT.unpack_from(self.mm, off)
+      if crc == zlib.crc32(self.mm[off:off + 16]) and seq >= best[0]:
+        best = (seq, head)
+    (self.seq, self.head) = best
+    # 書き戻されていない末尾のレコードを捨てる
+    while len(self) > 0 and not self.valid(self.head - 1):
+      self.head -= 1
+
+  def valid(self, n):
+    off = self.offset(n)
+    crc = struct.unpack_from('<I', self.mm, off + self.body.size)[0]
+    return crc == zlib.crc32(self.mm[off:off + self.body.size])
+
+  def offset(self, n):
+    return DATA + (n % self.capacity) * self.size
+
+  def __len__(self):
+    return min(self.head, self.capacity)
+
+  # O(1)で1レコード追加、最後のレコードより前の時刻なら追加せずFalse
+  def append(self, t, values):
+    body = self.body.pack(t, *values)
+    with self.lock:
+      if len(self) > 0 and t < self.time(self.head - 1):
+        return False
+      off = self.offset(self.head)
+      self.mm[off:off + self.size] = body + struct.pack('<I', zlib.crc32(body))
+      self.head += 1
+      self.seq += 1
+      off = SLOTS[self.seq % 2]
+      slot = SLOT.pack(self.seq, self.head, 0)
+      self.mm[off:off + SLOT.size] = slot[:16] + struct.pack('<I', zlib.crc32(slot[:16]))
+    return True
+
+  # 最後のレコードの時刻(なければNone)
+  def last(self):
+    with self.lock:
+      return self.time(self.head - 1) if len(self) > 0 else None
+
+  def time(self, n):
+    return struct.unpack_from('<d', self.mm, self.offset(n))[0]
+
+  # 時刻がt以上(right=Trueならtより大)の最初のレコード番号
+  def bisect(self, t, right=False):
+    lo = self.head - len(self)
+    hi = self.head
+    while lo < hi:
+      mid = (lo + hi) // 2
+      tm = self.time(mid)
+      if tm < t or (right and tm == t):
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  # [start, end]のレコード(crc付き)をCHUNKレコードまでのbytesで返す
+  #  読んでいる間に上書きされた古いレコードは飛ばし、閉じたら終わる
+  def chunks(self, start=None, end=None):
+    with self.lock:
+      if self.mm.closed:
+        return
+      lo = self.head - len(self) if start is None else self.bisect(start)
+      hi = self.head if end is None else self.bisect(end, right=True)
+    while lo < hi:
+      with self.lock:
+        if self.mm.closed:
+          return
+        lo = max(lo, self.head - len(self))
+        if lo >= hi:
+          return
+        n = min(hi - lo, CHUNK, self.capacity - lo % self.capacity)
+        off = self.offset(lo)
+        data = self.mm[off:off + n * self.size]
+      yield data
+      lo += n
+
+  # [start, end]のレコードを(時刻, チャネル...)で返す
+  def read(self, start=None, end=None):
+    for data in self.chunks(start, end):
+      for rec in self.record.iter_unpack(data):
+        yield rec[:-1]
+
+  def flush(self):
+    with self.lock:
+      self.mm.flush()
+
+  def close(self):
+    with self.lock:
+      if self.mm.closed:
+        return
+      self.mm.flush()
+      self.mm.close()
+      self.f.close()
+
+# 1つの粒度(step秒)の集計。チャネルごとに最小・最大・平均・個数(NaNは数えない)
+class Rollup():
+  STATS = ('min', 'max', 'mean', 'count')
+
+  def __init__(self, path, step, channels, capacity, lock=None):
+    self.step = step
+    self.channels = tuple(channels)
+    self.ring = History(path, [f'{c}_{s}' for c in self.channels for s in Rollup.STATS], capacity, lock)
+    # 保存済みの最後の区間
+    self.last = self.ring.last()
+    self.bucket = None
+    self.acc = None
+
+  # 区間の開始時刻(ローカル時刻の0時などにそろえる)
+  def start(self, t):
+    off = time.localtime(t).tm_gmtoff
+    return t - (t + off) % self.step
+
+  def add(self, t, values):
+    b = self.start(t)
+    if self.last is not None and b <= self.last:
+      # 集計済み(起動時の再集計)
+      return
+    if self.bucket is not None and b < self.bucket:
+      # 時計が戻った
+      return
+    if b != self.bucket:
+      self.flush()
+      self.bucket = b
+      self.acc = [[math.inf, -math.inf, 0.0, 0] for c in self.channels]
+    for (a, v) in zip(self.acc, values):
+      if not math.isnan(v):
+        a[0] = min(a[0], v)
+        a[1] = max(a[1], v)
+        a[2] += v
+        a[3] += 1
+
+  # 集計中の区間を保存する
+  def flush(self):
+    if self.bucket is None:
+      return
+    values = []
+    for (lo, hi, total, n) in self.acc:
+      if n > 0:
+        values += [lo, hi, total / n, n]
+      else:
+        values += [math.nan, math.nan, math.nan, 0]
+    self.ring.append(self.bucket, values)
+    self.last = self.bucket
+    self.bucket = None
+
+  def close(self):
+    self.ring.close()
+
+# 生の履歴と分・時・日の集計
+#  add()で集計を更新し、query()で要求された間隔に合う最も粗いものから返す
+#  集計中の区間とリングは生の履歴のlockで守る(add()はsamplerスレッド、query()はAPI)
+class Rollups():
+  LEVELS = (
+    ('minute', 60, 31 * 24 * 60),
+    ('hour', 60 * 60, 2 * 366 * 24),
+    ('day', 24 * 60 * 60, 10 * 366))
+
+  def __init__(self, raw, path):
+    self.raw = raw
+    self.lock = raw.lock
+    self.levels = [(name, Rollup(f'{path}.{name}', step, raw.channels, capacity, self.lock))
+      for (name, step, capacity) in Rollups.LEVELS]
+    # 集計より新しい生データを集計し直す(前回の終了時に集計中だった区間)
+    last = [r.last for (name, r) in self.levels]
+    start = None if None in last else min(last)
+    for rec in self.raw.read(start):
+      self.add(rec[0], rec[1:])
+
+  def add(self, t, values):
+    with self.lock:
+      for (name, r) in self.levels:
+        r.add(t, values)
+
+  # [start, end]をstep秒以上の間隔で返す
+  #  (名前, 列名, 行のイテレータ)、集計中の区間は含まない
+  #  行はリングから少しずつコピーするので、返した後もadd()と並行に読める
+  def query(self, start, end, step):
+    with self.lock:
+      source = ('raw', self.raw)
+      for (name, r) in self.levels:
+        if r.step <= step:
+          source = (name, r.ring)
+      (name, ring) = source
+      return name, ('time',) + ring.channels, ring.read(start, end)
+
+  # 集計中の区間は保存しない(次の起動時に生データから集計し直す)
+  def close(self):
+    with self.lock:
+      for (name, r) in self.levels:
+        r.close()
+
+# query()の結果をcsvまたはjsonの文字列の塊にする
+#  時刻はミリ秒まで、値はfloat32の有効桁(7桁)まで、NaNは空(csv)かnull(json)
+def format_rows(fmt, source, columns, rows):
+  def values(row):
+    return [round(row[0], 3)] + [None if math.isnan(v) else float(f'{v:.7g}') for v in row[1:]]
+  if fmt == 'csv':
+    yield ','.join(columns) + '\n'
+    for row in rows:
+      yield ','.join('' if v is None else str(int(v)) if v.is_integer() else repr(v)
+        for v in values(row)) + '\n'
+  else:
+    yield '{' + f'"source": {json.dumps(source)}, "columns": {json.dumps(columns)}, "rows": ['
+    sep = ''
+    for row in rows:
+      yield sep + json.dumps(values(row))
+      sep = ',\n'
+    yield ']}\n'
@@ -31,10 +31,18 @@ where
 
 and 2 3 4 is a list of codes to transmit.
 
+Playback reads codes.bin, a compiled copy of the codes holding
+each code's pulse table and compressed wave chain.  It is written
+after recording and rebuilt whenever codes is newer.  To compile
+by hand use
+
+./irrp.py -c -fcodes
+
 OPTIONS
 
 -r record
 -p playback
+-c compile
 -g GPIO (receiver for record, transmitter for playback)
 -f file
 
@@ -53,59 +61,44 @@ TRANSMIT
 
 --freq       IR carrier frequency, default 38 kHz
 --gap        gap in milliseconds between transmitted codes, default 100 ms
+
+MODULE
+
+The playback half is also available as a class which keeps the
+pigpio connection and the code file resident between sends.
+
+import irrp
+tx = irrp.IRTransmitter(gpio=17, file="codes")
+tx.send("2")
 """
 
 import time
 import json
+import logging
 import os
 import argparse
+import array
+import collections
+import functools
+import hashlib
+import mmap
+import struct
 
 import pigpio # http://abyz.co.uk/rpi/pigpio/python.html
 
-p = argparse.ArgumentParser()
-
-g = p.add_mutually_exclusive_group(required=True)
-g.add_argument("-p", "--play",   help="play keys",   action="store_true")
-g.add_argument("-r", "--record", help="record keys", action="store_true")
-
-p.add_argument("-g", "--gpio", help="GPIO for RX/TX", required=True, type=int)
-p.add_argument("-f", "--file", help="Filename",       required=True)
-
-p.add_argument('id', nargs='+', type=str, help='IR codes')
-
-p.add_argument("--freq",      help="frequency kHz",   type=float, default=38.0)
-
-p.add_argument("--gap",       help="key gap ms",        type=int, default=100)
-p.add_argument("--glitch",    help="glitch us",         type=int, default=100)
-p.add_argument("--post",      help="postamble ms",      type=int, default=15)
-p.add_argument("--pre",       help="preamble ms",       type=int, default=200)
-p.add_argument("--short",     help="short code length", type=int, default=10)
-p.add_argument("--tolerance", help="tolerance percent", type=int, default=15)
-
-p.add_argument("-v", "--verbose", help="Be verbose",     action="store_true")
-p.add_argument("--no-confirm", help="No confirm needed", action="store_true")
+try:
+   import numpy
+except ImportError:
+   numpy = None
 
-args = p.parse_args()
-
-GPIO       = args.gpio
-FILE       = args.file
-GLITCH     = args.glitch
-PRE_MS     = args.pre
-POST_MS    = args.post
-FREQ       = args.freq
-VERBOSE    = args.verbose
-SHORT      = args.short
-GAP_MS     = args.gap
-NO_CONFIRM = args.no_confirm
-TOLERANCE  = args.tolerance
-
-POST_US    = POST_MS * 1000
-PRE_US     = PRE_MS  * 1000
-GAP_S      = GAP_MS  / 1000.0
-CONFIRM    = not NO_CONFIRM
+VERBOSE    = False
+TOLERANCE  = 15
 TOLER_MIN =  (100 - TOLERANCE) / 100.0
 TOLER_MAX =  (100 + TOLERANCE) / 100.0
 
+ENTRY_MAX  = 600 # Compress wave chains longer than this.
+LOOP_MAX   = 20  # Maximum number of loops in a wave chain.
+
 last_tick = 0
 in_code = False
 code = []
@@ -130,23 +123,40 @@ def backup(f):
    except:
       pass
 
-def carrier(gpio, frequency, micros):
+def carrier_timings(frequency, micros):
    """
-   Generate carrier square wave.
+   Return (on, offs), the carrier mark length and the space length
+   of each cycle.  Cycle c ends at round((c+1)*cycle) so the rounding
+   errors don't add up over a long mark.
    """
-   wf = []
    cycle = 1000.0 / frequency
    cycles = int(round(micros/cycle))
    on = int(round(cycle / 2.0))
-   sofar = 0
-   for c in range(cycles):
-      target = int(round((c+1)*cycle))
-      sofar += on
-      off = target - sofar
-      sofar += off
-      wf.append(pigpio.pulse(1<<gpio, 0, on))
-      wf.append(pigpio.pulse(0, 1<<gpio, off))
-   return wf
+   if numpy is not None:
+      ends = numpy.rint(numpy.arange(cycles+1) * cycle).astype(numpy.int64)
+      return on, (numpy.diff(ends) - on).tolist()
+   ends = [int(round(c*cycle)) for c in range(cycles+1)]
+   return on, [ends[c+1] - ends[c] - on for c in range(cycles)]
+
+@functools.lru_cache(maxsize=256)
+def _carrier(gpio, frequency, micros):
+   on, offs = carrier_timings(frequency, micros)
+   # Only a few distinct pulses, share them between the cycles.
+   mark = pigpio.pulse(1<<gpio, 0, on)
+   spaces = {off: pigpio.pulse(0, 1<<gpio, off) for off in set(offs)}
+   wf = []
+   for off in offs:
+      wf.append(mark)
+      wf.append(spaces[off])
+   return tuple(wf)
+
+def carrier(gpio, frequency, micros):
+   """
+   Generate carrier square wave.
+
+   Memoised per (gpio, frequency, micros).
+   """
+   return list(_carrier(gpio, frequency, micros))
 
 def normalise(c):
    """
@@ -316,6 +326,585 @@ def tidy(records):
 
    tidy_mark_space(records, 1) # Spaces.
 
+def _lce(s, a, b, limit):
+   """
+   Length of the longest common prefix of s[a:] and s[b:], at most limit.
+   Slices are compared in C, doubling then bisecting the length.
+   """
+   if limit <= 0 or s[a] != s[b]:
+      return 0
+   n = 1
+   while n < limit:
+      m = min(n*2, limit)
+      if s[a:a+m] != s[b:b+m]:
+         break
+      n = m
+   if n >= limit:
+      return limit
+   lo, hi = n, min(n*2, limit) - 1 # s[a:a+lo] matches, s[a:a+hi+1] doesn't.
+   while lo < hi:
+      mid = (lo + hi + 1) // 2
+      if s[a:a+mid] == s[b:b+mid]:
+         lo = mid
+      else:
+         hi = mid - 1
+   return lo
+
+def find_runs(wave):
+   """
+   Find the tandem repeats (runs) in wave.
+
+   For each period p only the anchors 0, p, 2p, ... are visited; a run
+   of period p covers at least two of them, so extending the match
+   forwards and backwards from an anchor finds it.  That is n/p
+   extensions per period, O(n log n) in total.
+
+   Returns a set of (start, period, count).
+   """
+   symbols = {}
+   s = array.array("L", [symbols.setdefault(w, len(symbols)) for w in wave])
+   r = s[::-1]
+   n = len(s)
+   runs = set()
+   for p in range(1, n//2 + 1):
+      j = 0
+      while j + p < n:
+         fwd = _lce(s, j, j+p, n - j - p)
+         bwd = _lce(r, n-j, n-j-p, j)
+         length = bwd + p + fwd
+         if length >= 2*p:
+            start = j - bwd
+            runs.add((start, p, length // p))
+            # The next run of period p overlaps this one by less than p.
+            j = max(j + p, (start + length) // p * p)
+         else:
+            j += p
+   return runs
+
+def _encode(wave, loops):
+   """
+   Encode wave with at most loops pigpio chain loops.
+   Returns (chain, loops used).
+   """
+   if len(wave) < 2 or loops <= 0:
+      return list(wave), 0
+
+   # A loop costs 6 entries: 255 0 ... 255 1 x y.
+   candidates = []
+   for start, p, count in find_runs(wave):
+      saving = p*(count-1) - 6
+      if saving > 0:
+         candidates.append((saving, start, p, count))
+   candidates.sort(key=lambda c: (-c[0], c[1]))
+
+   # Take the best non-overlapping runs.
+   chosen = []
+   used = []
+   for saving, start, p, count in candidates:
+      if len(chosen) >= loops:
+         break
+      end = start + p*count
+      if all(end <= s or start >= e for s, e in used):
+         chosen.append((start, p, count))
+         used.append((start, end))
+
+   chosen.sort()
+   rest = loops - len(chosen)
+   chain = []
+   i = 0
+   for start, p, count in chosen:
+      chain.extend(wave[i:start])
+      unit, nested = _encode(wave[start:start+p], rest)
+      rest -= nested
+      chain += [255, 0] + unit + [255, 1, count & 255, count >> 8]
+      i = start + p*count
+   chain.extend(wave[i:])
+   return chain, loops - rest
+
+def compress(wave):
+   """
+   Compress a wave chain if the length is more than ENTRY_MAX.
+
+   Repeated runs of wave ids are replaced by pigpio chain loops
+   (255,0 ... 255,1,n,0) using at most LOOP_MAX loops.  The runs
+   with the biggest saving are taken first, then the repeated unit
+   of each is compressed with the loops left over.
+   """
+   if len(wave) <= ENTRY_MAX:
+      return wave
+
+   chain, loops = _encode(wave, LOOP_MAX)
+   return chain
+
+STORE_MAGIC   = b"IRRP"
+STORE_VERSION = 1
+STORE_HEADER  = struct.Struct("<4sHH") # magic, version, codes
+STORE_ENTRY   = struct.Struct("<8sIHIHIH") # hash, name, table, chain (offset, length)
+
+def compile_code(code):
+   """
+   Compile a recorded code into its pulse table and chain layout.
+
+   The table holds each distinct (base, length) once, base 0 for
+   marks and 1 for spaces.  The layout is the compressed chain with
+   table indices in place of wave ids, so playback only has to map
+   the indices to the waves it created.
+   """
+   table = []
+   index = {}
+   layout = [0]*len(code)
+   for i in range(0, len(code)):
+      key = (i & 1, int(round(code[i])))
+      if key not in index:
+         index[key] = len(table)
+         table.append(key)
+      layout[i] = index[key]
+   if len(table) >= 255:
+      raise ValueError("too many distinct pulses")
+   return table, compress(layout)
+
+def compile_codes(records):
+   """
+   Compile the records dict into the binary code store.
+
+   header  magic, version, number of codes
+   entries hash, offset/length of the name, table and chain
+   data    utf-8 names, uint32 table entries (base << 31 | length)
+           and uint8 chains (table index or 255 loop commands)
+   """
+   names = sorted(records)
+   entries = []
+   data = bytearray()
+   offset = STORE_HEADER.size + STORE_ENTRY.size * len(names)
+   for name in names:
+      table, layout = compile_code(records[name])
+      packed = struct.pack("<%dI" % len(table), *[b << 31 | l for b, l in table])
+      chain = bytes(layout)
+      digest = hashlib.blake2b(packed + chain, digest_size=8).digest()
+      encoded = name.encode("utf-8")
+      noff = offset + len(data)
+      data += encoded
+      toff = offset + len(data)
+      data += packed
+      coff = offset + len(data)
+      data += chain
+      entries.append(STORE_ENTRY.pack(digest, noff, len(encoded),
+         toff, len(table), coff, len(chain)))
+   return STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, len(names)) + \
+      b"".join(entries) + bytes(data)
+
+def compile_file(f):
+   """
+   Compile the code file f into its sidecar f.bin.
+   """
+   with open(f, "r") as fp:
+      records = json.load(fp)
+   store = compile_codes(records)
+   tmp = f + ".bin.tmp"
+   with open(tmp, "wb") as fp:
+      fp.write(store)
+   os.replace(tmp, f + ".bin")
+   return len(records)
+
+class CodeStore():
+   """
+   Memory mapped view of a compiled code file.
+
+   Only the entry index is read when opening, a code's table and
+   chain are read from the map when it is looked up.
+   """
+   def __init__(self, path):
+      with open(path, "rb") as f:
+         self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+      try:
+         magic, version, count = STORE_HEADER.unpack_from(self.mm, 0)
+         if magic != STORE_MAGIC or version != STORE_VERSION:
+            raise ValueError("unknown code store format")
+         self.index = {}
+         for i in range(count):
+            entry = STORE_ENTRY.unpack_from(self.mm,
+               STORE_HEADER.size + i * STORE_ENTRY.size)
+            digest, noff, nlen = entry[:3]
+            self.index[self.mm[noff:noff+nlen].decode("utf-8")] = (digest,) + entry[3:]
+      except:
+         self.mm.close()
+         raise
+
+   @classmethod
+   def open(cls, f):
+      """
+      Open the sidecar of code file f, compiling it first if it is
+      missing, older than f or in another format.
+      """
+      path = f + ".bin"
+      if not os.path.exists(path) or os.stat(path).st_mtime < os.stat(f).st_mtime:
+         compile_file(f)
+      try:
+         return cls(path)
+      except (ValueError, struct.error):
+         compile_file(f)
+         return cls(path)
+
+   def __contains__(self, name):
+      return name in self.index
+
+   def __len__(self):
+      return len(self.index)
+
+   def __getitem__(self, name):
+      """
+      Returns (hash, table, layout) of the code name.
+      """
+      digest, toff, tlen, coff, clen = self.index[name]
+      packed = struct.unpack_from("<%dI" % tlen, self.mm, toff)
+      table = [(v >> 31, v & 0x7fffffff) for v in packed]
+      return digest, table, self.mm[coff:coff+clen]
+
+   def close(self):
+      self.mm.close()
+
+class WaveCache():
+   """
+   LRU cache of pigpio waves.
+
+   One wave is kept per distinct mark and space length and one
+   compressed chain per code name, so a repeated send only needs
+   wave_chain.  When pigpio runs out of wave ids, pulses or control
+   blocks the least recently sent codes are evicted and the waves
+   no other cached code uses are deleted.
+
+   pigpiod only reuses the resources of a deleted wave once every
+   higher numbered wave has been deleted too, so deleted waves below
+   a live one are counted as holes.  When the holes leave no room the
+   waves are cleared and the ones still cached are created again
+   without the holes (compacted), and their chains relinked.
+   """
+   MAX_WAVES = 250    # pigpio wave ids.
+   CBS_PER_PULSE = 2  # Estimated DMA control blocks per pulse.
+
+   def __init__(self, pi, gpio, freq):
+      self.pi = pi
+      self.gpio = gpio
+      self.freq = freq
+      self.max_pulses = pi.wave_get_max_pulses()
+      self.max_cbs = pi.wave_get_max_cbs()
+      self.waves = {} # (base, length) -> [wave id, pulses, refs]
+      self.codes = collections.OrderedDict() # name -> (chain, keys, hash, table, layout)
+      self.holes = {} # wave id -> pulses, deleted below a live wave
+      self.pulses = 0 # Pulses of the live waves.
+      self.holed = 0  # Pulses of the holes.
+      self.hits = 0
+      self.misses = 0
+      self.compactions = 0
+
+   def __contains__(self, name):
+      return name in self.codes
+
+   def chain(self, name, digest, table, layout):
+      """
+      Return the wave chain for a compiled code (see CodeStore),
+      creating the waves on a miss.
+      """
+      if name in self.codes:
+         if self.codes[name][2] == digest:
+            self.codes.move_to_end(name)
+            self.hits += 1
+            return self.codes[name][0]
+         # The code has been recorded again.
+         self.release(self.codes.pop(name)[1])
+
+      self.misses += 1
+      keys = []
+      created = []
+      try:
+         # Hold the waves we already have so that evicting does not delete them.
+         for key in table:
+            if key in self.waves:
+               self.waves[key][2] += 1
+               keys.append(key)
+         missing = [key for key in dict.fromkeys(table) if key not in self.waves]
+         wfs = [self.waveform(key) for key in missing]
+         self.reserve(len(missing), sum(len(wf) for wf in wfs))
+         for key, wf in zip(missing, wfs):
+            self.create(key, wf)
+            created.append(key)
+      except:
+         self.release(keys)
+         self.release(created)
+         raise
+      for key in table:
+         if key in created:
+            self.waves[key][2] += 1
+            keys.append(key)
+
+      wave = self.link(table, layout)
+      self.codes[name] = (wave, keys, digest, table, layout)
+      return wave
+
+   def link(self, table, layout):
+      """
+      Wave chain of a compiled layout with the current wave ids.
+      """
+      ids = [self.waves[key][0] for key in table]
+      wave = []
+      i = 0
+      while i < len(layout):
+         c = layout[i]
+         if c == 255: # Loop start 255 0, loop repeat 255 1 x y.
+            n = 2 if layout[i+1] == 0 else 4
+            wave.extend(layout[i:i+n])
+            i += n
+         else:
+            wave.append(ids[c])
+            i += 1
+      return wave
+
+   def waveform(self, key):
+      if key[0]: # Space
+         return [pigpio.pulse(0, 0, key[1])]
+      else: # Mark
+         return carrier(self.gpio, self.freq, key[1])
+
+   def fits(self, waves, pulses, used_waves, used_pulses):
+      pulses += used_pulses
+      return (used_waves + waves <= self.MAX_WAVES and
+         pulses <= self.max_pulses and
+         pulses * self.CBS_PER_PULSE <= self.max_cbs)
+
+   def reserve(self, waves, pulses):
+      """
+      Make room for new waves, evicting codes until they would fit
+      without the holes and compacting if the holes are in the way.
+      """
+      while self.codes and not self.fits(waves, pulses, len(self.waves), self.pulses):
+         self.evict()
+      top = max([w[0] for w in self.waves.values()] + list(self.holes), default=-1)
+      if self.holes and not self.fits(waves, pulses, top + 1, self.pulses + self.holed):
+         self.compact()
+
+   def create(self, key, wf):
+      while True:
+         try:
+            wid = self.add(wf)
+            break
+         except pigpio.error:
+            # Our estimate was short, make more room and try again.
+            if not self.codes:
+               raise
+            self.evict()
+            self.compact()
+
+      self.waves[key] = [wid, len(wf), 0]
+      self.pulses += len(wf)
+
+   def add(self, wf):
+      self.pi.wave_add_new()
+      self.pi.wave_add_generic(wf)
+      wid = self.pi.wave_create()
+      if wid in self.holes: # pigpiod reused a hole of the same size.
+         self.holed -= self.holes.pop(wid)
+      return wid
+
+   def compact(self):
+      """
+      Clear the waves and create the live ones again from id 0 so that
+      the holes are given back, then relink the cached chains.
+      """
+      self.compactions += 1
+      self.pi.wave_clear()
+      self.holes = {}
+      self.holed = 0
+      for key, w in sorted(self.waves.items(), key=lambda kw: kw[1][0]):
+         w[0] = self.add(self.waveform(key))
+      for name, (wave, keys, digest, table, layout) in self.codes.items():
+         self.codes[name] = (self.link(table, layout), keys, digest, table, layout)
+
+   def evict(self):
+      name, code = self.codes.popitem(last=False)
+      self.release(code[1])
+
+   def release(self, keys):
+      for key in keys:
+         w = self.waves[key]
+         w[2] -= 1
+         if w[2] <= 0:
+            self.pi.wave_delete(w[0])
+            self.pulses -= w[1]
+            del self.waves[key]
+            self.holes[w[0]] = w[1]
+            self.holed += w[1]
+      # Deleted waves above the highest live one are given back.
+      top = max((w[0] for w in self.waves.values()), default=-1)
+      for wid in [wid for wid in self.holes if wid > top]:
+         self.holed -= self.holes.pop(wid)
+
+   def clear(self, forget=False):
+      """
+      Drop every cached code.  With forget the waves are assumed to be
+      gone already (e.g. pigpiod has been restarted) and not deleted.
+      """
+      if not forget:
+         for key in self.waves:
+            try:
+               self.pi.wave_delete(self.waves[key][0])
+            except pigpio.error:
+               pass # Already deleted.
+      self.waves = {}
+      self.codes = collections.OrderedDict()
+      self.holes = {}
+      self.pulses = 0
+      self.holed = 0
+
+class IRTransmitter():
+   """
+   Resident IR transmitter.
+
+   Keeps one pigpio connection, the code file and a WaveCache
+   resident so that a repeated send only has to chain the waves.
+
+   tx = IRTransmitter(gpio=13, file="ir/data")
+   latency = tx.send("ac:off")
+   tx.close()
+
+   A missing or broken code file is logged and leaves no codes
+   loaded, it is tried again on the next lookup.
+   """
+   def __init__(self, pi=None, gpio=13, file="ir/data", freq=38.0, gap=100,
+         logger=None):
+      if pi is None:
+         pi = pigpio.pi() # Connect to Pi.
+         self.own_pi = True
+      else:
+         self.own_pi = False
+      self.pi = pi
+      self.gpio = gpio
+      self.file = file
+      self.freq = freq
+      self.gap_s = gap / 1000.0
+      self.logger = logger or logging.getLogger("irrp")
+      self.store = None
+      self.mtime = None
+      self.load_error = None
+      self.emit_time = 0
+      self.last_latency = None
+
+      if not self.pi.connected:
+         raise ConnectionError("can't connect to pigpiod")
+
+      self.pi.set_mode(self.gpio, pigpio.OUTPUT) # IR TX connected to this GPIO.
+      # pigpiod keeps waves after a client disconnects, drop the ones
+      # left by an earlier run so that they do not use up the ids.
+      self.pi.wave_clear()
+      self.cache = WaveCache(self.pi, self.gpio, self.freq)
+      self.load()
+
+   def load(self):
+      """
+      (Re)open the compiled code file if the code file has been changed
+      since the last load.  Cached chains are kept for the codes whose
+      hash is unchanged.
+      """
+      try:
+         mtime = os.stat(self.file).st_mtime
+         if mtime != self.mtime:
+            store = CodeStore.open(self.file)
+            if self.store is not None:
+               self.store.close()
+            self.store = store
+            self.mtime = mtime
+         self.load_error = None
+      except (OSError, ValueError, KeyError, TypeError, struct.error) as e:
+         # Only log when the error changes, this is retried on every send.
+         if str(e) != self.load_error:
+            self.logger.warning("can't load IR codes from %s: %s", self.file, e)
+         self.load_error = str(e)
+         if self.store is not None:
+            self.store.close()
+         self.store = None
+         self.mtime = None
+
+   def __contains__(self, name):
+      self.load()
+      return self.store is not None and name in self.store
+
+   def reconnect(self):
+      """
+      Rebuild the wave cache after a failed send.  If pigpiod still
+      answers our waves are deleted, otherwise it has been restarted
+      and taken them with it, so they are forgotten and we reconnect.
+      A connection given by the caller is not replaced, ConnectionError
+      is raised for the caller to reconnect (and make a new transmitter).
+      """
+      try:
+         self.pi.get_pigpio_version()
+         self.cache.clear()
+      except (pigpio.error, struct.error, OSError):
+         self.cache.clear(forget=True)
+         if not self.own_pi:
+            raise ConnectionError("lost the connection to pigpiod")
+         try:
+            self.pi.stop()
+         except Exception:
+            pass
+         self.pi = pigpio.pi() # Connect to Pi.
+         if not self.pi.connected:
+            raise ConnectionError("can't connect to pigpiod")
+      self.pi.set_mode(self.gpio, pigpio.OUTPUT)
+      self.cache = WaveCache(self.pi, self.gpio, self.freq)
+
+   def send(self, name):
+      """
+      Transmit the code name and wait until it has been sent.
+
+      Returns the time in seconds from the call to the end of
+      transmission.  Raises KeyError if the code is unknown.
+      """
+      start = time.time()
+      self.load()
+      if self.store is None:
+         raise KeyError(name)
+      code = self.store[name]
+
+      try:
+         wave = self.cache.chain(name, *code)
+         self.wait_gap()
+         self.pi.wave_chain(wave)
+      except (pigpio.error, struct.error, OSError):
+         # pigpiod has rejected the chain, has been restarted (the closed
+         # socket gives struct.error or ConnectionError) or our waves
+         # have been cleared.
+         self.reconnect()
+         wave = self.cache.chain(name, *code)
+         self.wait_gap()
+         self.pi.wave_chain(wave)
+
+      if VERBOSE:
+         print("key " + name)
+
+      while self.pi.wave_tx_busy():
+         time.sleep(0.002)
+
+      self.emit_time = time.time() + self.gap_s
+
+      self.last_latency = time.time() - start
+      return self.last_latency
+
+   def wait_gap(self):
+      delay = self.emit_time - time.time()
+
+      if delay > 0.0:
+         time.sleep(delay)
+
+   def close(self):
+      try:
+         self.cache.clear()
+      except (struct.error, OSError):
+         self.cache.clear(forget=True) # pigpiod has gone.
+      if self.store is not None:
+         self.store.close()
+      if self.own_pi:
+         self.pi.stop() # Disconnect from Pi.
+
 def end_of_code():
    global code, fetching_code
    if len(code) > SHORT:
@@ -354,219 +943,158 @@ def cbf(gpio, level, tick):
          in_code = False
          end_of_code()
 
-pi = pigpio.pi() # Connect to Pi.
+if __name__ == "__main__":
 
-if not pi.connected:
-   exit(0)
+   p = argparse.ArgumentParser()
 
-if args.record: # Record.
+   g = p.add_mutually_exclusive_group(required=True)
+   g.add_argument("-p", "--play",   help="play keys",   action="store_true")
+   g.add_argument("-r", "--record", help="record keys", action="store_true")
+   g.add_argument("-c", "--compile", help="compile keys", action="store_true")
 
-   try:
-      f = open(FILE, "r")
-      records = json.load(f)
-      f.close()
-   except:
-      records = {}
+   p.add_argument("-g", "--gpio", help="GPIO for RX/TX", type=int)
+   p.add_argument("-f", "--file", help="Filename",       required=True)
 
-   pi.set_mode(GPIO, pigpio.INPUT) # IR RX connected to this GPIO.
+   p.add_argument('id', nargs='*', type=str, help='IR codes')
 
-   pi.set_glitch_filter(GPIO, GLITCH) # Ignore glitches.
+   p.add_argument("--freq",      help="frequency kHz",   type=float, default=38.0)
 
-   cb = pi.callback(GPIO, pigpio.EITHER_EDGE, cbf)
+   p.add_argument("--gap",       help="key gap ms",        type=int, default=100)
+   p.add_argument("--glitch",    help="glitch us",         type=int, default=100)
+   p.add_argument("--post",      help="postamble ms",      type=int, default=15)
+   p.add_argument("--pre",       help="preamble ms",       type=int, default=200)
+   p.add_argument("--short",     help="short code length", type=int, default=10)
+   p.add_argument("--tolerance", help="tolerance percent", type=int, default=15)
 
-   # Process each id
+   p.add_argument("-v", "--verbose", help="Be verbose",     action="store_true")
+   p.add_argument("--no-confirm", help="No confirm needed", action="store_true")
 
-   print("Recording")
-   for arg in args.id:
-      print("Press key for '{}'".format(arg))
-      code = []
-      fetching_code = True
-      while fetching_code:
-         time.sleep(0.1)
-      print("Okay")
-      time.sleep(0.5)
-
-      if CONFIRM:
-         press_1 = code[:]
-         done = False
-
-         tries = 0
-         while not done:
-            print("Press key for '{}' to confirm".format(arg))
-            code = []
-            fetching_code = True
-            while fetching_code:
-               time.sleep(0.1)
-            press_2 = code[:]
-            the_same = compare(press_1, press_2)
-            if the_same:
-               done = True
-               records[arg] = press_1[:]
-               print("Okay")
-               time.sleep(0.5)
-            else:
-               tries += 1
-               if tries <= 3:
-                  print("No match")
-               else:
-                  print("Giving up on key '{}'".format(arg))
-                  done = True
-               time.sleep(0.5)
-      else: # No confirm.
-         records[arg] = code[:]
+   args = p.parse_args()
 
-   pi.set_glitch_filter(GPIO, 0) # Cancel glitch filter.
-   pi.set_watchdog(GPIO, 0) # Cancel watchdog.
+   if args.compile:
+      try:
+         n = compile_file(args.file)
+      except (IOError, ValueError) as e:
+         print("Can't compile {}: {}".format(args.file, e))
+         exit(1)
+      print("Compiled {} codes into {}.bin".format(n, args.file))
+      exit(0)
 
-   tidy(records)
+   if args.gpio is None or not args.id:
+      p.error("-g and at least one id are required to record or play")
+
+   GPIO       = args.gpio
+   FILE       = args.file
+   GLITCH     = args.glitch
+   PRE_MS     = args.pre
+   POST_MS    = args.post
+   FREQ       = args.freq
+   VERBOSE    = args.verbose
+   SHORT      = args.short
+   GAP_MS     = args.gap
+   NO_CONFIRM = args.no_confirm
+   TOLERANCE  = args.tolerance
+
+   POST_US    = POST_MS * 1000
+   PRE_US     = PRE_MS  * 1000
+   GAP_S      = GAP_MS  / 1000.0
+   CONFIRM    = not NO_CONFIRM
+   TOLER_MIN =  (100 - TOLERANCE) / 100.0
+   TOLER_MAX =  (100 + TOLERANCE) / 100.0
+
+   pi = pigpio.pi() # Connect to Pi.
+
+   if not pi.connected:
+      exit(0)
 
-   backup(FILE)
+   if args.record: # Record.
+
+      try:
+         f = open(FILE, "r")
+         records = json.load(f)
+         f.close()
+      except:
+         records = {}
+
+      pi.set_mode(GPIO, pigpio.INPUT) # IR RX connected to this GPIO.
+
+      pi.set_glitch_filter(GPIO, GLITCH) # Ignore glitches.
+
+      cb = pi.callback(GPIO, pigpio.EITHER_EDGE, cbf)
+
+      # Process each id
+
+      print("Recording")
+      for arg in args.id:
+         print("Press key for '{}'".format(arg))
+         code = []
+         fetching_code = True
+         while fetching_code:
+            time.sleep(0.1)
+         print("Okay")
+         time.sleep(0.5)
+
+         if CONFIRM:
+            press_1 = code[:]
+            done = False
+
+            tries = 0
+            while not done:
+               print("Press key for '{}' to confirm".format(arg))
+               code = []
+               fetching_code = True
+               while fetching_code:
+                  time.sleep(0.1)
+               press_2 = code[:]
+               the_same = compare(press_1, press_2)
+               if the_same:
+                  done = True
+                  records[arg] = press_1[:]
+                  print("Okay")
+                  time.sleep(0.5)
+               else:
+                  tries += 1
+                  if tries <= 3:
+                     print("No match")
+                  else:
+                     print("Giving up on key '{}'".format(arg))
+                     done = True
+                  time.sleep(0.5)
+         else: # No confirm.
+            records[arg] = code[:]
+
+      pi.set_glitch_filter(GPIO, 0) # Cancel glitch filter.
+      pi.set_watchdog(GPIO, 0) # Cancel watchdog.
 
-   f = open(FILE, "w")
-   f.write(json.dumps(records, sort_keys=True).replace("],", "],\n")+"\n")
-   f.close()
+      tidy(records)
 
-else: # Playback.
+      backup(FILE)
 
-   try:
-      f = open(FILE, "r")
-   except:
-      print("Can't open: {}".format(FILE))
-      exit(0)
+      f = open(FILE, "w")
+      f.write(json.dumps(records, sort_keys=True).replace("],", "],\n")+"\n")
+      f.close()
 
-   records = json.load(f)
+      compile_file(FILE)
 
-   f.close()
+   else: # Playback.
 
-   pi.set_mode(GPIO, pigpio.OUTPUT) # IR TX connected to this GPIO.
+      try:
+         tx = IRTransmitter(pi, GPIO, FILE, FREQ, GAP_MS)
+      except (IOError, ValueError):
+         print("Can't open: {}".format(FILE))
+         exit(0)
 
-   pi.wave_add_new()
+      if VERBOSE:
+         print("Playing")
 
-   emit_time = time.time()
+      for arg in args.id:
+         if arg in tx:
+            tx.send(arg)
+            if VERBOSE:
+               print("sent {} in {:.3f} s".format(arg, tx.last_latency))
+         else:
+            print("Id {} not found".format(arg))
 
-   if VERBOSE:
-      print("Playing")
-
-   for arg in args.id:
-      if arg in records:
-
-         code = records[arg]
-
-         # Create wave
-
-         marks_wid = {}
-         spaces_wid = {}
-
-         wave = [0]*len(code)
-
-         for i in range(0, len(code)):
-            ci = code[i]
-            if i & 1: # Space
-               if ci not in spaces_wid:
-                  pi.wave_add_generic([pigpio.pulse(0, 0, ci)])
-                  spaces_wid[ci] = pi.wave_create()
-               wave[i] = spaces_wid[ci]
-            else: # Mark
-               if ci not in marks_wid:
-                  wf = carrier(GPIO, FREQ, ci)
-                  pi.wave_add_generic(wf)
-                  marks_wid[ci] = pi.wave_create()
-               wave[i] = marks_wid[ci]
-
-         delay = emit_time - time.time()
-
-         if delay > 0.0:
-            time.sleep(delay)
-
-         ### Compressing a wave code if the length is more than 600 ###
-         ENTRY_MAX = 600
-         LOOP_MAX = 20
-         if len(wave) > ENTRY_MAX:
-             import collections
-
-             def make_ngram(l, n):
-                 ngrams = list(zip(*(l[i:] for i in range(n))))
-                 return(collections.Counter(ngrams).most_common())
-
-             def depth_of_tuple(t):
-                 if isinstance(t, tuple):
-                     if t == tuple() : return 1
-                     return 1 + max(depth_of_tuple(item) for item in t)
-                 else:
-                     return 0
-
-             def nonloop_decode(wave, i, t):
-                 wave[i:i+1] = [t[num] for num in range(len(t)-1)]*t[-1]
-                 return wave
-
-             def loop_decode(wave, i, t):
-                 repeat_unit = [t[num] for num in range(len(t)-1)]
-                 code = [255, 0, 255, 1, t[-1], 0]
-                 code[2:2] = repeat_unit
-                 wave[i:i+1] = code
-                 return wave
-
-             #encoding the original wave to the tuple code
-             for wl in range(2, len(wave)//2):
-                 pre_len = 0
-                 while len(wave) != pre_len:
-                     pre_len = len(wave)
-                     ngrams = make_ngram(wave, wl)
-                     for ngram in ngrams:
-                         ngram_wave = ngram[0]
-                         ngram_freq = ngram[1]
-                         if ngram_freq >= 2:
-                             for i in range(len(wave) - len(ngram_wave)):
-                                 if tuple(wave[i:i+wl]) == ngram_wave:
-                                     for rn in range(2, ngram_freq):
-                                         if wave[i:i+(wl*rn)] != list(ngram_wave * rn):
-                                             if wl*(rn-2) > 6 or depth_of_tuple(ngram_wave) >= 2 and rn-1 >= 2 :
-                                                 loop_code = list(ngram_wave) + [rn-1]
-                                                 wave[i:i+((rn-1)*wl)] = [tuple(loop_code)]
-                                             break
-
-             #decoding the tuple-type code into the wave code
-             rest_loop_count = LOOP_MAX
-             for d in range(depth_of_tuple(tuple(wave))):
-                 for i,item in enumerate(wave):
-                     if isinstance(item, tuple):
-                         if rest_loop_count <= 0:
-                             nonloop_decode(wave, i, item)
-                         elif depth_of_tuple(item) > 1:
-                             loop_decode(wave, i, item)
-                             rest_loop_count -= 1
-             efficiencies = sorted(set([(len(item)-1)*(item[-1]-1) for item in wave if isinstance(item, tuple)]), reverse=True)
-             for eff in efficiencies:
-                 for i,item in enumerate(wave):
-                     if isinstance(item, tuple):
-                         if rest_loop_count <= 0:
-                             nonloop_decode(wave, i, item)
-                         elif (len(item)-1)*(item[-1]-1) == eff:
-                             loop_decode(wave, i, item)
-                             rest_loop_count -= 1
-
-         ### Compression end ###
-
-         pi.wave_chain(wave)
-
-         if VERBOSE:
-            print("key " + arg)
-
-         while pi.wave_tx_busy():
-            time.sleep(0.002)
-
-         emit_time = time.time() + GAP_S
-
-         for i in marks_wid:
-            pi.wave_delete(marks_wid[i])
-
-         marks_wid = {}
-
-         for i in spaces_wid:
-            pi.wave_delete(spaces_wid[i])
-
-         spaces_wid = {}
-      else:
-         print("Id {} not found".format(arg))
+      tx.close()
 
-pi.stop() # Disconnect from Pi.
+   pi.stop() # Disconnect from Pi.
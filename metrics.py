@@ -0,0 +1,151 @@
+import bisect
+import functools
+import threading
+import time
+
+# 処理時間のヒストグラムと回数
+#
+# 記録はスレッドごとの配列に足すだけで、ロックは取らない(各スレッドが自分の配列だけに書く)。
+# exposition()で全スレッドの分を合計し、Prometheusのテキスト形式で返す
+#
+#  @metrics.timed('room_sensor_seconds', 'sensor reads', op='lux')
+#  def lux(self): ...
+#
+#  with metrics.timed('room_ir_send_seconds', 'IR sends'):
+#    ...
+
+# 秒
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Cells():
+  def __init__(self, size):
+    self.size = size
+    self.local = threading.local()
+    self.cells = []
+    self.lock = threading.Lock()
+
+  # このスレッドの配列(初回だけロックを取って登録する)
+  def cell(self):
+    try:
+      return self.local.cell
+    except AttributeError:
+      c = [0] * self.size
+      with self.lock:
+        self.cells.append(c)
+      self.local.cell = c
+      return c
+
+  def total(self):
+    with self.lock:
+      cells = list(self.cells)
+    return [sum(c[i] for c in cells) for i in range(self.size)]
+
+class Histogram():
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = buckets
+    # 各区間の回数 + 合計
+    self.cells = Cells(len(buckets) + 2)
+
+  def observe(self, v):
+    c = self.cells.cell()
+    c[bisect.bisect_left(self.buckets, v)] += 1
+    c[-1] += v
+
+  def samples(self, name, labels):
+    t = self.cells.total()
+    n = 0
+    for (le, count) in zip(self.buckets + ('+Inf',), t[:-1]):
+      n += count
+      yield (f'{name}_bucket', labels + (('le', str(le)),), n)
+    yield (f'{name}_sum', labels, t[-1])
+    yield (f'{name}_count', labels, n)
+
+class Counter():
+  def __init__(self):
+    self.cells = Cells(1)
+
+  def inc(self, n=1):
+    self.cells.cell()[0] += n
+
+  def samples(self, name, labels):
+    yield (name, labels, self.cells.total()[0])
+
+# 名前: [種類, 説明, {ラベル: Histogram/Counter}]
+registry = {}
+# 名前: (種類, 説明, 関数) 関数は値か{ラベル: 値}を返す
+gauges = {}
+lock = threading.Lock()
+
+def get(kind, name, help, labels):
+  key = tuple(sorted(labels.items()))
+  with lock:
+    family = registry.setdefault(name, [kind, help, {}])
+    m = family[2].get(key)
+    if m is None:
+      m = family[2][key] = Histogram() if kind == 'histogram' else Counter()
+    return m
+
+def histogram(name, help='', **labels):
+  return get('histogram', name, help, labels)
+
+def counter(name, help='', **labels):
+  return get('counter', name, help, labels)
+
+# 値を取り出すときに呼ぶ関数を登録する(他で数えている回数はkind='counter')
+def gauge(name, help, fn, kind='gauge'):
+  with lock:
+    gauges[name] = (kind, help, fn)
+
+# 処理時間を記録するデコレータ兼コンテキストマネージャ
+class timed():
+  def __init__(self, name, help='', **labels):
+    self.histogram = histogram(name, help, **labels)
+    self.local = threading.local()
+
+  def __enter__(self):
+    self.local.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc):
+    self.histogram.observe(time.perf_counter() - self.local.start)
+    return False
+
+  def __call__(self, f):
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+      start = time.perf_counter()
+      try:
+        return f(*args, **kwargs)
+      finally:
+        self.histogram.observe(time.perf_counter() - start)
+    return wrapper
+
+def escape(v):
+  return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def line(name, labels, value):
+  if labels:
+    name += '{' + ','.join(f'{k}="{escape(v)}"' for (k, v) in labels) + '}'
+  return f'{name} {value:.9g}\n' if isinstance(value, float) else f'{name} {value}\n'
+
+# Prometheusのテキスト形式
+def exposition():
+  with lock:
+    families = [(name, kind, help, list(children.items())) for (name, (kind, help, children)) in sorted(registry.items())]
+    gs = sorted(gauges.items())
+  out = []
+  for (name, kind, help, children) in families:
+    out.append(f'# HELP {name} {help}\n# TYPE {name} {kind}\n')
+    for (labels, m) in children:
+      out += [line(*s) for s in m.samples(name, labels)]
+  for (name, (kind, help, fn)) in gs:
+    try:
+      v = fn()
+    except Exception:
+      continue
+    out.append(f'# HELP {name} {help}\n# TYPE {name} {kind}\n')
+    if isinstance(v, dict):
+      out += [line(name, labels, value) for (labels, value) in v.items()]
+    else:
+      out.append(line(name, (), v))
+  return ''.join(out)
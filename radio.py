@@ -1,21 +1,197 @@
 import base64
+import json
 import logging
 import os
+import struct
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
 import urllib.parse
+import zlib
 import xml.etree.ElementTree as et
 
 import retry
 import requests
 import clog
+import metrics
 
+# radikoのURL(bench/では手元のものに差し替える)
+RADIKO_HTTP = 'http://radiko.jp'
+RADIKO_HTTPS = 'https://radiko.jp'
+PLAYER_URL = RADIKO_HTTP + '/apps/js/flash/myplayer-release.swf'
+# プレーヤーの鍵が入っているDefineBinaryDataのcharacter id
+KEY_TAG = 12
+# 認証トークンを使い回す秒数(期限より少し短くする)
+TOKEN_TTL = 50 * 60
+# radikoへのリクエストの(接続, 読み込み)の待ち時間(秒)
+#  再起動は制御ループから行うので、通信が止まっても待ち続けないように
+HTTP_TIMEOUT = (5, 10)
+# 局のストリームURLを使い回す秒数
+STREAM_TTL = 6 * 60 * 60
+# 待機系(次の局を音を出さずに受信しておく)の上限
+#  最後に切り替えてからこの秒数が過ぎたら止める(余分な通信量を抑える)
+STANDBY_IDLE = 15 * 60
+#  1日(ローカル時刻)に待機系を動かす合計秒数(約48kbpsなので2時間で40MBほど)
+STANDBY_DAILY = 2 * 60 * 60
+#  1コアあたりのロードアベレージがこれを超えていたら起動しない
+STANDBY_MAXLOAD = 0.5
+
+# swfのDefineBinaryData(tag 87)のうちcharacter idがtagのデータを返す
+#  FWS(無圧縮)、CWS(zlib)
+def swfbinary(data, tag):
+  (signature, version, size) = struct.unpack_from('<3sBI', data)
+  if signature == b'CWS':
+    body = zlib.decompress(data[8:])
+  elif signature == b'FWS':
+    body = data[8:]
+  else:
+    raise ValueError(f'not a swf file: {signature}')
+  # RECT(上位5bitがフィールドのビット数) + フレームレート + フレーム数
+  nbits = body[0] >> 3
+  pos = (5 + 4 * nbits + 7) // 8 + 4
+  while pos + 2 <= len(body):
+    (code,) = struct.unpack_from('<H', body, pos)
+    pos += 2
+    (kind, length) = (code >> 6, code & 0x3f)
+    if length == 0x3f:
+      (length,) = struct.unpack_from('<I', body, pos)
+      pos += 4
+    if kind == 87 and struct.unpack_from('<H', body, pos)[0] == tag:
+      # character id(2) + 予約(4)
+      return body[pos + 6:pos + length]
+    if kind == 0:
+      break
+    pos += length
+  raise ValueError(f'binary tag {tag} not found')
+
+def atomicwrite(path, data):
+  os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+  with open(path + '.tmp', 'wb') as f:
+    f.write(data)
+  os.replace(path + '.tmp', path)
+
+# rtmpdump | mplayer の組
+#  mplayerの音量は-input file=のFIFOに書いたコマンドで変える
+class Pipeline():
+  def __init__(self, logger, channel, url, authtoken, volume, reboot, switched=None):
+    self.logger = logger
+    self.channel = channel
+    # 切り替えを始めた時刻(再生が始まるまでの時間を記録する)
+    self.switched = switched
+    self.playing = None
+    self.dir = tempfile.mkdtemp(prefix='radio-')
+    self.fifo = os.path.join(self.dir, 'input')
+    os.mkfifo(self.fifo)
+    # 読み手がいなくても開けるようにO_RDWRで開く
+    self.input = os.open(self.fifo, os.O_RDWR | os.O_NONBLOCK)
+    self.mplayer = None
+    u = urllib.parse.urlparse(url)
+    rtmpdumpcommand = [
+      'rtmpdump',
+      '-v',
+      '-r', f'{u.scheme}://{u.netloc}',
+      '--app', '/'.join(u.path.strip('/').split('/')[:-1]),
+      '--playpath', u.path.split('/')[-1],
+      '-W', PLAYER_URL,
+      '-C', 'S:', '-C', 'S:', '-C', 'S:', '-C', 'S:' + authtoken,
+      '--live']
+    if not os.environ.get('DEBUG'):
+      rtmpdumpcommand.append('-q')
+    self.logger.debug(' '.join(rtmpdumpcommand))
+    err = clog.LoggerWriter(self.logger, logging.WARNING)
+    self.rtmpdump = subprocess.Popen(rtmpdumpcommand, stdout=subprocess.PIPE, stderr=err, shell=False)
+    err.close()
+    mplayercommand = ['mplayer', '-nolirc', '-noconsolecontrols', '-ao', 'alsa', '-channels', '2', '-af', 'pan=1:1',
+      '-softvol', '-volume', str(volume), '-input', f'file={self.fifo}', '-']
+    if not os.environ.get('DEBUG'):
+      mplayercommand.append('-quiet')
+    if self.rtmpdump.poll() != None:
+      self.kill()
+      raise Exception('cannot launch rtmpdump')
+    out = clog.LoggerWriter(self.logger, logging.DEBUG,
+      patterns=['Starting playback'], callback=self.started)
+    err = clog.LoggerWriter(self.logger, logging.WARNING,
+      patterns=['Audio device got stuck'], callback=reboot)
+    self.mplayer = subprocess.Popen(mplayercommand, stdin=self.rtmpdump.stdout,
+      stdout=out, stderr=err, shell=False)
+    out.close()
+    err.close()
+    # mplayerだけがパイプを読むようにする
+    self.rtmpdump.stdout.close()
+
+  # mplayerが再生を始めた(clogのスレッド)
+  def started(self, pattern, line):
+    if self.playing is None:
+      self.playing = time.time()
+      if self.switched is not None:
+        self.logger.info(f'switched to {self.channel} in {(self.playing - self.switched) * 1000:.0f} ms')
+
+  def alive(self):
+    return self.mplayer != None and self.mplayer.poll() == None and \
+      self.rtmpdump != None and self.rtmpdump.poll() == None
+
+  def command(self, c):
+    try:
+      os.write(self.input, (c + '\n').encode('utf-8'))
+    except OSError as e:
+      self.logger.warning(f'failed mplayer command {c}: {e}')
+
+  def volume(self, v):
+    self.command(f'volume {v} 1')
+
+  def mute(self, on):
+    self.command(f'mute {1 if on else 0}')
+
+  def kill(self):
+    for p in (self.mplayer, self.rtmpdump):
+      if p != None and p.poll() == None:
+        p.kill()
+    if self.input is not None:
+      os.close(self.input)
+      self.input = None
+    shutil.rmtree(self.dir, ignore_errors=True)
 
 class Radio():
-  def __init__(self, logger):
+  def __init__(self, logger, cache='./cache/radiko', supervisor=None):
     self.logger = logger
     self.channels = []
     self.current = 0
-    self.player = None
+    # 認証トークン、プレーヤーの鍵の保存先(拡張子を付けて使う)
+    self.cache = cache
+    self.authtoken = None
+    self.authexpires = 0
+    self.areaid = None
+    try:
+      self.tokenttl = int(os.environ.get('RADIKO_TOKEN_TTL'))
+    except (TypeError, ValueError):
+      self.tokenttl = TOKEN_TTL
+    # radikoへの接続は使い回す
+    self.session = requests.Session()
+    self.authlock = threading.Lock()
+    # 再生中と待機中のPipeline
+    self.active = None
+    self.standby = None
+    self.standbyenabled = os.environ.get('RADIO_STANDBY', '0') not in ('', '0')
+    try:
+      self.standbydaily = int(os.environ.get('RADIO_STANDBY_DAILY'))
+    except (TypeError, ValueError):
+      self.standbydaily = STANDBY_DAILY
+    # 今日(standbyday)待機系を動かした秒数と、動いている待機系を起動した時刻
+    self.standbyday = None
+    self.standbyused = 0
+    self.standbystart = None
+    self.lastswitch = 0
+    # 最後の切り替えにかかった秒数
+    self.switchlatency = None
+    # 再生中のPipelineが落ちたらsupervisorが再起動する
+    self.supervisor = supervisor
+    if supervisor is not None:
+      supervisor.add('radio', self.restart, self.prepare)
+    # 局: (ストリームURL, 取得時刻)
+    self.streams = {}
+    self.prefetching = None
     self.rtmpdump = None
     self.mplayer = None
 
@@ -26,103 +202,283 @@ class Radio():
     subprocess.run(command)
 
   @retry.retry(tries=50, delay=10)
-  def auth(self):
-    # auth
-    self.player = requests.get('http://radiko.jp/apps/js/flash/myplayer-release.swf')
-    if self.player.status_code != 200:
+  def auth(self, force=False):
+    self.authorize(force)
+
+  # 認証トークン(期限内なら何もしない)
+  @metrics.timed('room_radio_auth_seconds', 'auth checks (cached or full)')
+  def authorize(self, force=False):
+    # supervisorのprepare(別スレッド)と制御ループが同時に認証しないように
+    with self.authlock:
+      if not force and self.authtoken is not None and time.time() < self.authexpires:
+        return
+      if not force and self.loadtoken():
+        self.logger.debug(f'reuse authtoken (expires at {time.ctime(self.authexpires)})')
+      else:
+        self.authtoken = None
+        metrics.counter('room_radio_auths_total', 'full radiko authentications').inc()
+        key = self.playerkey()
+        auth1 = self.session.post(f'{RADIKO_HTTPS}/v2/api/auth1_fms', headers={
+            'pragma': 'no-cache',
+            'X-Radiko-App': 'pc_ts',
+            'X-Radiko-App-Version': '4.0.0',
+            'X-Radiko-User': 'test-stream',
+            'X-Radiko-Device': 'pc',
+          },
+          data='\r\n',
+          verify=False,
+          timeout=HTTP_TIMEOUT)
+        if auth1.status_code != 200:
+          raise ConnectionError('failed auth1 process')
+        authtoken = auth1.headers['x-radiko-authtoken']
+        offset = int(auth1.headers['x-radiko-keyoffset'])
+        length = int(auth1.headers['x-radiko-keylength'])
+        partialkey = base64.b64encode(key[offset:offset + length])
+        auth2 = self.session.post(f'{RADIKO_HTTPS}/v2/api/auth2_fms',
+          headers={
+            'pragma': 'no-cache',
+            'X-Radiko-App': 'pc_ts',
+            'X-Radiko-App-Version': '4.0.0',
+            'X-Radiko-User': 'test-stream',
+            'X-Radiko-Device': 'pc',
+            'X-Radiko-Authtoken': authtoken,
+            'X-Radiko-Partialkey': partialkey,
+          },
+          data='\r\n',
+          verify=False,
+          timeout=HTTP_TIMEOUT)
+        if auth2.status_code != 200:
+          raise ConnectionError('failed auth2 process')
+        self.authtoken = authtoken
+        self.authexpires = time.time() + self.tokenttl
+        self.areaid = auth2.content.decode('utf-8').replace('\r\n', '').split(',')[0]
+        self.savetoken()
+        self.logger.debug(f'areaid={self.areaid}, self.authtoken={self.authtoken}')
+      # get channel list
+      if len(self.channels) == 0:
+        self.channels = ['']
+        self.current = 0
+        chan = self.session.get(f'{RADIKO_HTTP}/v2/api/program/today?area_id={self.areaid}', timeout=HTTP_TIMEOUT)
+        for i in et.fromstring(chan.content).findall('./stations/station[@id]'):
+          self.channels.append(i.attrib['id'])
+        self.logger.debug(f'self.channels={self.channels}')
+        self.prefetch()
+
+  # 保存したトークンが期限内なら使う
+  def loadtoken(self):
+    try:
+      with open(self.cache + '.token') as f:
+        t = json.load(f)
+    except (OSError, ValueError):
+      return False
+    if t.get('expires', 0) <= time.time():
+      return False
+    (self.authtoken, self.authexpires, self.areaid) = (t['authtoken'], t['expires'], t['areaid'])
+    return True
+
+  def savetoken(self):
+    atomicwrite(self.cache + '.token', json.dumps({
+      'authtoken': self.authtoken, 'expires': self.authexpires, 'areaid': self.areaid }).encode('utf-8'))
+
+  # プレーヤー(swf)の鍵(バイナリタグ12)
+  #  取り出した鍵とETag/Last-Modifiedを保存しておき、変わっていなければ(304)ダウンロードしない
+  def playerkey(self):
+    meta = {}
+    key = None
+    try:
+      with open(self.cache + '.key.json') as f:
+        meta = json.load(f)
+      with open(self.cache + '.key', 'rb') as f:
+        key = f.read()
+    except (OSError, ValueError):
+      meta = {}
+    headers = {}
+    if key is not None and meta.get('url') == PLAYER_URL:
+      if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+      if meta.get('last-modified'):
+        headers['If-Modified-Since'] = meta['last-modified']
+    player = self.session.get(PLAYER_URL, headers=headers, timeout=HTTP_TIMEOUT)
+    if player.status_code == 304 and headers:
+      return key
+    if player.status_code != 200:
       raise ConnectionError("failed get player")
-    auth1 = requests.post('https://radiko.jp/v2/api/auth1_fms', headers={
-        'pragma': 'no-cache',
-        'X-Radiko-App': 'pc_ts',
-        'X-Radiko-App-Version': '4.0.0',
-        'X-Radiko-User': 'test-stream',
-        'X-Radiko-Device': 'pc',
-      },
-      data='\r\n',
-      verify=False)
-    if auth1.status_code != 200:
-      raise ConnectionError('failed auth1 process')
-    self.authtoken = auth1.headers['x-radiko-authtoken']
-    offset = auth1.headers['x-radiko-keyoffset']
-    length = auth1.headers['x-radiko-keylength']
-    swf = subprocess.check_output(['swfextract', '-b', '12', '/dev/stdin', '-o', '/dev/stdout'], input=self.player.content, stderr=clog.LoggerWriter(self.logger, logging.WARNING))
-    dd = subprocess.check_output(['dd', 'bs=1', 'skip=' + offset, 'count=' + length], input=swf, stderr=clog.LoggerWriter(self.logger, logging.WARNING))
-    partialkey = base64.b64encode(dd)
-    auth2 = requests.post('https://radiko.jp/v2/api/auth2_fms',
-      headers={
-        'pragma': 'no-cache',
-        'X-Radiko-App': 'pc_ts',
-        'X-Radiko-App-Version': '4.0.0',
-        'X-Radiko-User': 'test-stream',
-        'X-Radiko-Device': 'pc',
-        'X-Radiko-Authtoken': self.authtoken,
-        'X-Radiko-Partialkey': partialkey,
-      },
-      data='\r\n',
-      verify=False)
-    if auth2.status_code != 200:
-      raise ConnectionError('failed auth2 process')
-    areaid = auth2.content.decode('utf-8').replace('\r\n', '').split(',')[0]
-    self.logger.debug(f'areaid={areaid}, self.authtoken={self.authtoken}')
-    # get channel list
-    self.channels = ['']
-    self.current = 0
-    chan = requests.get(f'http://radiko.jp/v2/api/program/today?area_id={areaid}')
-    for i in et.fromstring(chan.content).findall('./stations/station[@id]'):
-      self.channels.append(i.attrib['id'])
-    self.logger.debug(f'self.channels={self.channels}')
+    key = swfbinary(player.content, KEY_TAG)
+    atomicwrite(self.cache + '.key', key)
+    atomicwrite(self.cache + '.key.json', json.dumps({
+      'url': PLAYER_URL,
+      'etag': player.headers.get('etag'),
+      'last-modified': player.headers.get('last-modified') }).encode('utf-8'))
+    self.logger.debug(f'extracted player key ({len(key)} bytes from {len(player.content)} bytes swf)')
+    return key
 
-  @retry.retry(tries=50, delay=10)
+  # 局を切り替える。失敗したらsupervisorに任せて待たない(supervisorが無ければ例外)
+  @metrics.timed('room_radio_switch_seconds', 'channel switches until the player is spawned')
   def changechannel(self, channel):
+    try:
+      self.switch(channel)
+    except Exception as e:
+      if self.supervisor is None:
+        raise
+      self.supervisor.failed('radio', e)
+
+  # 再起動に要る通信(認証、ストリームURL)を済ませておく(supervisorが別スレッドで呼ぶ)
+  #  restart()は保存したものを使うので制御ループを止めない
+  def prepare(self):
+    channel = self.channels[self.current] if self.channels else ''
     if channel == '':
-      if self.mplayer != None and self.mplayer.poll() == None:
-        self.mplayer.kill()
-      if self.rtmpdump != None and self.rtmpdump.poll() == None:
-        self.rtmpdump.kill()
       return
+    self.authorize()
+    self.streamurl(channel)
 
-    r = requests.get(f'http://radiko.jp/v2/station/stream/{channel}.xml')
-    streamurl = et.fromstring(r.content).find('./item').text
-    u = urllib.parse.urlparse(streamurl)
+  # 今の局で起動し直す(supervisorから呼ぶ、1回だけ試す)
+  def restart(self):
+    self.switch(self.channels[self.current])
 
-    if self.mplayer != None and self.mplayer.poll() == None:
-      self.mplayer.kill()
-    if self.rtmpdump != None and self.rtmpdump.poll() == None:
-      self.rtmpdump.kill()
-    
-    rtmpdumpcommand = [
-      'rtmpdump',
-      '-v',
-      '-r', f'{u.scheme}://{u.netloc}',
-      '--app', '/'.join(u.path.strip('/').split('/')[:-1]),
-      '--playpath', u.path.split('/')[-1],
-      '-W', self.player.url,
-      '-C', 'S:', '-C', 'S:', '-C', 'S:', '-C', 'S:' + self.authtoken,
-      '--live']
-    if not os.environ.get('DEBUG'):
-      rtmpdumpcommand.append('-q')
-    self.logger.debug(' '.join(rtmpdumpcommand))
-    self.rtmpdump = subprocess.Popen(rtmpdumpcommand, stdout=subprocess.PIPE, stderr=clog.LoggerWriter(self.logger, logging.WARNING), shell=False)
-    mplayercommand = ['mplayer', '-nolirc', '-ao', 'alsa', '-channels', '2', '-af', 'pan=1:1', '-']
-    if not os.environ.get('DEBUG'):
-      mplayercommand.append('-quiet')
-    if self.rtmpdump != None and self.rtmpdump.poll() != None:
-      raise Exception('cannot launch rtmpdump')
-    self.mplayer = subprocess.Popen(mplayercommand, stdin=self.rtmpdump.stdout,
-      stdout=clog.LoggerWriter(self.logger, logging.DEBUG),
-      stderr=clog.LoggerWriter(self.logger, logging.WARNING,
-        patterns=['Audio device got stuck'], callback=self.reboot), shell=False)
-    
-  def nextchannel(self):
-    if self.mplayer != None and self.mplayer.poll() == None and \
-       self.rtmpdump != None and self.rtmpdump.poll() == None:
-      if self.current + 1 >= len(self.channels):
-        self.current = 0
-      else:
-        self.current += 1
+  def switch(self, channel):
+    switched = time.time()
+    if channel == '':
+      self.pause()
+      return
+
+    self.authorize()
+    self.lastswitch = switched
+    if self.standby is not None and self.standby.channel == channel and self.standby.alive():
+      # 待機系の音を出して入れ替える
+      self.standbyend()
+      (old, self.active, self.standby) = (self.active, self.standby, None)
+      self.active.volume(100)
+      self.watch()
+      if old is not None:
+        old.kill()
+      self.switchlatency = time.time() - switched
+      self.logger.info(f'switched to {channel} in {self.switchlatency * 1000:.0f} ms (standby)')
     else:
-      if self.current == 0:
-        self.current += 1
+      url = self.streamurl(channel)
+      if self.active is not None:
+        if self.active.alive():
+          # 落ちたものはsupervisorの失敗の回数を残す
+          self.unwatch()
+        self.active.kill()
+        self.active = None
+      try:
+        self.active = Pipeline(self.logger, channel, url, self.authtoken, 100, self.reboot, switched)
+      except Exception:
+        # URLが変わったかもしれないので次は取り直す
+        self.streams.pop(channel, None)
+        raise
+      self.watch()
+      self.switchlatency = None
+    (self.rtmpdump, self.mplayer) = (self.active.rtmpdump, self.active.mplayer)
+    self.prefetch()
+    self.warmup()
+
+  # 次の局を待機系として受信しておく(RADIO_STANDBY=1のとき)
+  def warmup(self):
+    if not self.standbyenabled or self.active is None or len(self.channels) <= 1:
+      return
+    n = len(self.channels)
+    # 最後の局の次は停止なので待機しない
+    channel = self.channels[(self.current + 1) % n]
+    if self.standby is not None:
+      if self.standby.channel == channel and self.standby.alive():
+        return
+      self.killstandby()
+    if channel == '' or channel == self.active.channel:
+      return
+    if self.standbytime() >= self.standbydaily:
+      self.logger.debug(f'skip standby for {channel} (daily limit)')
+      return
+    load = os.getloadavg()[0] / (os.cpu_count() or 1)
+    if load > STANDBY_MAXLOAD:
+      self.logger.debug(f'skip standby for {channel} (load {load:.2f})')
+      return
+    try:
+      self.standby = Pipeline(self.logger, channel, self.streamurl(channel), self.authtoken, 0, self.reboot)
+      self.standbystart = time.time()
+      self.logger.debug(f'standby {channel}')
+    except Exception as e:
+      self.logger.debug(f'failed standby {channel}: {e}')
+
+  # しばらく切り替えていないか、今日の上限を使い切ったら待機系を止める(定期的に呼ぶ)
+  def maintain(self):
+    if self.standby is None:
+      return
+    if time.time() - self.lastswitch > STANDBY_IDLE:
+      self.logger.debug(f'stop standby {self.standby.channel}')
+      self.killstandby()
+    elif self.standbytime() >= self.standbydaily:
+      self.logger.info(f'stop standby {self.standby.channel} (used {self.standbydaily} s today)')
+      self.killstandby()
+
+  # 今日待機系を動かした秒数(動いているものを含む)
+  def standbytime(self):
+    now = time.time()
+    day = time.localtime(now)[:3]
+    if day != self.standbyday:
+      # 日が変わったら数え直す(動いているものは0時から数える)
+      self.standbyday = day
+      self.standbyused = 0
+      if self.standbystart is not None:
+        self.standbystart = max(self.standbystart, time.mktime(day + (0, 0, 0, 0, 0, -1)))
+    if self.standbystart is None:
+      return self.standbyused
+    return self.standbyused + now - self.standbystart
+
+  # 待機系を使い終わった(音を出すか止める)ので動かした秒数を足す
+  def standbyend(self):
+    if self.standbystart is not None:
+      self.standbyused = self.standbytime()
+      self.standbystart = None
+
+  def killstandby(self):
+    self.standbyend()
+    self.standby.kill()
+    self.standby = None
+
+  # 局のストリームURL(期限内なら保存したもの)
+  def streamurl(self, channel):
+    cached = self.streams.get(channel)
+    if cached is not None and time.time() - cached[1] < STREAM_TTL:
+      return cached[0]
+    r = self.session.get(f'{RADIKO_HTTP}/v2/station/stream/{channel}.xml', timeout=HTTP_TIMEOUT)
+    if r.status_code != 200:
+      raise ConnectionError(f'failed get stream of {channel}')
+    url = et.fromstring(r.content).find('./item').text
+    self.streams[channel] = (url, time.time())
+    return url
+
+  # 前後の局のストリームURLを裏で取っておく
+  def prefetch(self):
+    if len(self.channels) <= 1 or (self.prefetching is not None and self.prefetching.is_alive()):
+      return
+    n = len(self.channels)
+    neighbours = [self.channels[(self.current + d) % n] for d in (1, -1)]
+    self.prefetching = threading.Thread(target=self.prefetchrun,
+      args=([c for c in neighbours if c != ''],), name='prefetch', daemon=True)
+    self.prefetching.start()
+
+  def prefetchrun(self, channels):
+    for channel in channels:
+      try:
+        self.streamurl(channel)
+      except Exception as e:
+        self.logger.debug(f'failed prefetch {channel}: {e}')
+
+  # count局先に切り替える(途中の局は起動しない)
+  def nextchannel(self, count=1):
+    playing = self.active is not None and self.active.alive()
+    for i in range(count):
+      if playing:
+        if self.current + 1 >= len(self.channels):
+          self.current = 0
+        else:
+          self.current += 1
+      else:
+        if self.current == 0:
+          self.current += 1
+      # 2回目以降は再生中として進める
+      playing = True
     self.changechannel(self.channels[self.current])
 
   def close(self):
@@ -132,11 +488,36 @@ class Radio():
     self.pause()
     self.current = 0
 
+  def watch(self):
+    if self.supervisor is not None:
+      self.supervisor.started('radio', [self.active.rtmpdump, self.active.mplayer])
+
+  def unwatch(self):
+    if self.supervisor is not None:
+      self.supervisor.stopped('radio')
+
   def pause(self):
-    if self.mplayer != None and self.mplayer.poll() == None:
-      self.mplayer.kill()
-    if self.rtmpdump != None and self.rtmpdump.poll() == None:
-      self.rtmpdump.kill()
+    self.unwatch()
+    self.standbyend()
+    for p in (self.active, self.standby):
+      if p is not None:
+        p.kill()
+    (self.active, self.standby) = (None, None)
+
+  # IR送信などの間だけ音を消す(ストリームは止めない)
+  #  再生中でなければFalse
+  def mute(self):
+    if self.active is not None and self.active.alive():
+      self.active.mute(True)
+      return True
+    return False
+
+  def unmute(self):
+    if self.active is not None and self.active.alive():
+      self.active.mute(False)
+    elif self.current != 0:
+      # 消音中に止まっていたら起動し直す
+      self.resume()
 
   def resume(self):
     self.changechannel(self.channels[self.current])
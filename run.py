@@ -1,4 +1,4 @@
-# requirements: swfextract (swftools), rtmpdump, mplayer, irsend(lirc)
+# requirements: rtmpdump, mplayer, irsend(lirc)
 
 import asyncio
 import base64
@@ -18,10 +18,16 @@ import queue
 import requests
 
 import device
+import dispatcher
+import history
+import metrics
 import radio
-import schedule
+import sampler
+import supervisor
+import timer
 import clog
 import api
+import climate
 
 def calcet(t, h):
   # expecting value
@@ -31,43 +37,59 @@ def calcet(t, h):
   tm = 37 - ((37 - t) / ((0.68 - 0.14 * h) + (1 / a))) - 0.29 * t * (1 - h)
   return tm
 
-class Scheduler():
-  def __init__(self, logger, loop, main):
-    self.logger = logger
-    self.loop = loop
-    self.main = main
-
-  def run(self):
-    asyncio.set_event_loop(self.loop)
-    sys.stdout = clog.LoggerWriter(self.logger, logging.DEBUG)
-    sys.stderr = clog.LoggerWriter(self.logger, logging.WARNING)
-    self.logger.debug('launch scheduler')
-    morningtime = os.environ.get('MORNING', default='06:30')
-    odekaketime = os.environ.get('ODEKAKE', default='07:40')
-    nighttime = os.environ.get('NIGHT', default='00:30')
-    schedule.every().day.at(morningtime).do(self.main.morning)
-    schedule.every().day.at(odekaketime).do(self.main.odekake)
-    schedule.every().day.at(nighttime).do(self.main.night)
-    while True:
-      schedule.run_pending()
-      time.sleep(1)
+# 制御ループの1回(待ち時間50msを含む)がこれを超えたら遅れとして数える
+#  radioの再起動の通信はsupervisorが別スレッドで済ませるので制御ループは待たないが、
+#  ボタンやAPIで局を変えたときにトークンやURLが期限切れなら、radikoへの1リクエストにつき
+#  最大radio.HTTP_TIMEOUT(接続5秒 + 読み込み10秒)待つ
+LOOP_OVERRUN = 0.1
 
 class Main():
   def __init__(self, logger):
     self.logger = logger
     self.queue = queue.Queue()
-    self.radio = radio.Radio(self.logger)
-    self.device = device.Device(self.logger, self.radio)
-    self.scheduler = Scheduler(self.logger, asyncio.new_event_loop(), self)
-    self.schedulerthread = threading.Thread(target=self.scheduler.run, name='scheduler', daemon=True)
-    self.api = api.API(asyncio.new_event_loop(), self.queue, self.logger, os.environ.get('TOKEN'))
+    # 子プロセスが落ちたらキューにNoneを入れて制御ループを起こす
+    self.supervisor = supervisor.Supervisor(self.logger, lambda: self.queue.put(None))
+    self.radio = radio.Radio(self.logger, supervisor=self.supervisor)
+    metrics.gauge('room_child_restarts_total', 'child process restarts',
+      lambda: { (('child', k),): v['restarts'] for (k, v) in self.supervisor.stats().items() }, 'counter')
+    metrics.gauge('room_child_uptime_seconds', 'uptime of the running child process',
+      lambda: { (('child', k),): v['uptime'] for (k, v) in self.supervisor.stats().items() })
+    metrics.gauge('room_child_breaker_open', 'restart circuit breaker is open',
+      lambda: { (('child', k),): int(v['open']) for (k, v) in self.supervisor.stats().items() })
+    self.looptime = metrics.histogram('room_loop_seconds', 'control loop iterations')
+    self.overruns = metrics.counter('room_loop_overruns_total', f'control loop iterations longer than {LOOP_OVERRUN} s')
+    # ボタンイベントとAPIのコマンドは同じキューに入る
+    self.device = device.Device(self.logger, self.radio, self.queue)
+    self.sampler = sampler.Sampler(self.logger, self.device)
+    self.history = history.History('./history/sensors')
+    self.rollups = history.Rollups(self.history, './history/sensors')
+    self.sampler.listeners.append(self.record)
+    self.dispatcher = dispatcher.Dispatcher(self.logger, {
+      'ac-on': self.acon,
+      'ac-off': self.acoff,
+      'iris-on': self.irison,
+      'iris-off': self.irisoff,
+      'radio-next': self.radio.nextchannel,
+      'radio-stop': self.radiooff })
+    self.api = api.API(asyncio.new_event_loop(), self.queue, self.logger, os.environ.get('TOKEN'), self.rollups)
+    # 朝・夜の切り替えと5秒ごとの自動制御は制御ループで実行する
+    self.timer = timer.Timer(self.logger)
+    self.timer.daily('morning', os.environ.get('MORNING', default='06:30'), self.morning)
+    self.timer.daily('odekake', os.environ.get('ODEKAKE', default='07:40'), self.odekake)
+    self.timer.daily('night', os.environ.get('NIGHT', default='00:30'), self.night)
+    self.timer.every('autocontrol', 5, self.tick)
+    # エアコンは体感温度の傾向から先回りして入れる
+    self.climate = climate.Climate(self.logger, self.history, './history/climate.json')
     self.apithread = threading.Thread(target=self.api.run, name='api', daemon=True)
     self.mode = 1
+    self.hmode = 0
     self.nightmode = 0
+    self.lux = 0
     self.temp = 0
     self.press = 0
     self.humid = 0
     self.etemp = 0
+    self.clockback = False
 
   def subrun(self, command):
     self.logger.info('executing command: {}'.format(' '.join(command)))
@@ -107,7 +129,9 @@ class Main():
   def morning(self):
     self.logger.debug('morning mode')
     self.irison()
-    self.acon()
+    # 朝に間に合うように先に入れていればそのまま
+    if self.climate.running is None:
+      self.acon()
     self.radio.nextchannel()
     self.nightmode = 0
     self.mode = 1
@@ -120,116 +144,151 @@ class Main():
     if self.lux > 20:
       self.device.sendir('iris:off')
 
-  def acon(self):
-    if self.etemp < 23:
-      name = 'ac:heating'
-    elif self.etemp > 27:
-      name = 'ac:cooling'
-    else:
+  # mode: 'heating'か'cooling'、Noneなら体感温度の予測で決める
+  def acon(self, mode=None):
+    if mode is None:
+      mode = self.climate.choose(self.etemp)
+    if mode is None:
       self.logger.debug(f'no need ac (etemp={self.etemp})')
       return
+    name = f'ac:{mode}'
     self.logger.debug(f'turn on ac, name={name} (etemp={self.etemp})')
     self.device.sendir(name)
+    self.climate.started(mode)
 
   def acoff(self):
     self.device.sendir('ac:off')
+    self.climate.stopped()
 
   def radiooff(self):
     self.device.blink(0b0111, 0b0111, 0.5, 1)
     self.radio.stop()
 
+  # センサ値を履歴に保存する(samplerスレッド)
+  def record(self, s):
+    lux = float('nan') if s.luxstale or s.lux is None else s.lux
+    values = (s.temp, s.humid, s.press, lux, calcet(s.temp, s.humid))
+    if not self.history.append(s.tphtime, values):
+      # 時計が戻った(RTCがないので起動時やNTPの同期で起こる)、追いつくまで保存しない
+      if not self.clockback:
+        self.logger.warning(f'clock went back to {time.ctime(s.tphtime)}, not recording until it passes {time.ctime(self.history.last())}')
+      self.clockback = True
+      return
+    self.clockback = False
+    self.rollups.add(s.tphtime, values)
+
   def close(self):
+    self.sampler.stop()
+    self.rollups.close()
+    self.history.close()
     self.device.close()
     self.radio.close()
 
-  def parsequeue(self):
-    if self.queue.empty() == False:
-      q = self.queue.get()
-      c = q.get('command')
-      if c == 'ac-on':
-        self.acon()
-      elif c == 'ac-off':
-        self.acoff()
-      elif c == 'iris-on':
-        self.irison()
-      elif c == 'iris-off':
-        self.irisoff()
-      elif c == 'radio-next':
+  # キューに溜まったボタンイベントとコマンドを処理する(最大timeout秒待つ)
+  #  ボタンイベントは(name, kind, tick)、APIのコマンドはdict、Noneは起こすだけ
+  def parsequeue(self, timeout):
+    try:
+      items = [self.queue.get(timeout=timeout)]
+    except queue.Empty:
+      return
+    while not self.queue.empty():
+      items.append(self.queue.get())
+    for item in items:
+      if isinstance(item, tuple):
+        (name, kind, tick) = item
+        self.button(name, kind)
+    commands = [item for item in items if isinstance(item, dict)]
+    if len(commands) > 0:
+      self.dispatcher.dispatch(commands)
+
+  def button(self, name, kind):
+    if name == 'sw2':
+      # SW2 blackが押された場合
+      if kind == device.Button.SHORT:
+        self.logger.debug('pressed sw2(short), change next channel')
         self.radio.nextchannel()
-      elif c == 'radio-stop':
+      elif kind == device.Button.DOUBLE:
+        self.logger.debug('pressed sw2(double), change next channel twice')
+        # 1回で2局進める(途中の局はつながない)
+        self.radio.nextchannel(2)
+      elif kind == device.Button.LONG:
         self.radiooff()
+    elif name == 'sw1':
+      self.hmode = (kind == device.Button.SHORT)
+
+  # センサ値による空調・ラジオの自動制御
+  def autocontrol(self):
+    s = self.sampler.snapshot()
+    if s.luxstale or s.tphstale:
+      # センサ値が古いときは自動制御しない
+      self.logger.debug(f'sensor values are stale (lux errors={s.luxerrors}, tph errors={s.tpherrors})')
+      return
+    self.lux = s.lux
+    (self.temp, self.press, self.humid) = (s.temp, s.press, s.humid)
+    self.etemp = calcet(self.temp, self.humid)
+    #self.logger.debug(f't={self.temp} h={self.humid} et={self.etemp} m={self.mode}')
+    if self.mode != 0:
+      # 動作中
+      if self.lux < 5:
+        self.logger.debug(f'the room is gloomy, turn off radio, ac (lux={self.lux})')
+        self.mode = 0
+        self.radio.stop()
+        self.acoff()
+        return
+    else:
+      # 休止中
+      if self.lux > 20:
+        self.logger.debug(f'the room is bright, turn on radio, ac(lux={self.lux})')
+        self.mode = 1
+        self.acon()
+        self.radio.nextchannel()
+        return
+    # 寒く(暑く)なりそうなら今のうちに、休止中なら朝に間に合うように入れる
+    mode = self.climate.update(self.etemp, self.mode != 0, self.timer.stats()['morning']['next'])
+    if mode is not None:
+      self.logger.debug(f'the room is getting {"cold" if mode == "heating" else "hot"}, turn on ac (etemp={self.etemp})')
+      self.acon(mode)
+
+  # 空調自動調節等(5秒ごと)
+  def tick(self):
+    self.radio.maintain()
+    self.autocontrol()
 
   def run(self):
-    self.schedulerthread.start()
+    sys.stdout = clog.LoggerWriter(self.logger, logging.DEBUG)
+    sys.stderr = clog.LoggerWriter(self.logger, logging.WARNING)
     self.apithread.start()
-    
+    self.sampler.start()
+    self.supervisor.start()
+
     self.radio.auth()
     self.radio.changechannel(self.radio.channels[0])
     stoptimer = None
 
-    counter = 0
-    aconauto = 0
     try:
       while True:
-        counter += 1
-
-        # 子プロセスの死活監視, 空調自動調節等(5secごと)
-        if counter % 100 == 0:
-          counter = 0
-          if aconauto > 0:
-            aconauto -= 1
-
-          self.lux = self.device.lux()
-          (self.temp, self.press, self.humid) = self.device.tph()
-          self.etemp = calcet(self.temp, self.humid)
-          #self.logger.debug(f't={self.temp} h={self.humid} et={self.etemp} m={self.mode}')
-          if self.mode != 0:
-            # 動作中
-            if self.radio.current != 0:
-              if (self.radio.mplayer != None and self.radio.mplayer.poll() != None) or \
-                (self.radio.rtmpdump != None and self.radio.rtmpdump.poll() != None):
-                self.logger.warning('radio process dead. restarting...')
-                self.radio.stop()
-                self.radio.changechannel(self.radio.channels[self.radio.current])
-            if self.lux < 5:
-              self.logger.debug(f'the room is gloomy, turn off radio, ac (lux={self.lux})')
-              self.mode = 0
-              self.radio.stop()
-              self.device.sendir('ac:off')
-            elif self.etemp < 19 and aconauto == 0:
-              self.logger.debug(f'the room is cold, turn on ac (etemp={self.etemp})')
-              self.acon()
-              # 1h待機
-              aconauto = 1 * 60 * 60 / 5
-            elif self.etemp > 28 and aconauto == 0:
-              self.logger.debug(f'the room is hot, turn on ac (etemp={self.etemp})')
-              self.acon()
-              aconauto = 1 * 60 * 60 / 5
-          else:
-            # 休止中
-            if self.lux > 20:
-              self.logger.debug(f'the room is bright, turn on radio, ac(lux={self.lux})')
-              self.mode = 1
-              self.acon()
-              self.radio.nextchannel()
-    
-        # SW2 blackが押された場合
-        sw2 = self.device.sw2()
-        if sw2 == 1:
-          # short
-          self.logger.debug('pressed sw2(short), change next channel')
-          self.radio.nextchannel()
-        elif sw2 == 2:
-          # long
-          self.radiooff()
-
-        hmode = (self.device.sw1() == 1)
+        started = time.perf_counter()
+
+        # 落ちた子プロセスの再起動(予定の時刻になったものだけ)
+        self.supervisor.poll()
+
+        # 予定の時刻を過ぎたもの(朝・夜の切り替え、空調自動調節等)
+        self.timer.run()
 
         # 暗かったらOFF
         #if self.mode != 0
 
-        self.device.all(hmode << 3 | self.radio.current)
-        time.sleep(0.05)
+        self.device.all(self.hmode << 3 | self.radio.current)
+        self.hmode = 0
+
+        # ボタンイベントかコマンドを待つ(最大50msか次の予定まで)、届いたらすぐに処理する
+        timeout = self.timer.timeout()
+        self.parsequeue(0.05 if timeout is None else min(0.05, timeout))
+
+        elapsed = time.perf_counter() - started
+        self.looptime.observe(elapsed)
+        if elapsed > LOOP_OVERRUN:
+          self.overruns.inc()
 
     # Ctrl+Cが押されたらGPIOを解放
     except KeyboardInterrupt:
@@ -0,0 +1,85 @@
+import collections
+import os
+import threading
+import time
+
+# 最新のセンサ値。time, luxtime, tphtimeはtime.time()、値がまだ無ければNone
+Snapshot = collections.namedtuple('Snapshot', [
+  'time',
+  'lux', 'luxtime', 'luxstale', 'luxerrors',
+  'temp', 'press', 'humid', 'tphtime', 'tphstale', 'tpherrors'])
+
+class Sampler():
+  # Deviceのセンサを専用スレッドで読み、snapshot()で待たずに最新値を返す
+  # luxinterval, tphinterval: 測定間隔(秒)
+  # 間隔のstale倍以上更新がなければstale
+  def __init__(self, logger, device, luxinterval=1.0, tphinterval=5.0, stale=3):
+    self.logger = logger
+    self.device = device
+    self.luxinterval = float(os.environ.get('LUX_INTERVAL', default=luxinterval))
+    self.tphinterval = float(os.environ.get('TPH_INTERVAL', default=tphinterval))
+    self.stale = stale
+    # (値, 時刻, エラー回数) スレッドから丸ごと差し替える
+    self.luxreading = (None, 0, 0)
+    self.tphreading = ((None, None, None), 0, 0)
+    # 温湿度を読むたびにsnapshotを渡して呼ぶ(samplerスレッド)
+    self.listeners = []
+    self.stopped = threading.Event()
+    self.thread = threading.Thread(target=self.run, name='sampler', daemon=True)
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    self.stopped.set()
+
+  def snapshot(self):
+    now = time.time()
+    (lux, luxtime, luxerrors) = self.luxreading
+    ((temp, press, humid), tphtime, tpherrors) = self.tphreading
+    return Snapshot(now,
+      lux, luxtime, now - luxtime > self.luxinterval * self.stale, luxerrors,
+      temp, press, humid, tphtime, now - tphtime > self.tphinterval * self.stale, tpherrors)
+
+  # luxtimeは測定した時刻(新しい測定がなければ進めず、エラーとして数える)
+  def samplelux(self):
+    (lux, t, errors) = self.luxreading
+    try:
+      (value, updated) = self.device.lux()
+    except Exception as e:
+      self.luxreading = (lux, t, errors + 1)
+      self.logger.warning(f'failed to read lux ({errors + 1} errors): {e}')
+      return
+    if not updated or updated <= t:
+      self.luxreading = (lux, t, errors + 1)
+      self.logger.debug(f'no new lux since {time.ctime(t)} ({errors + 1} errors)')
+      return
+    self.luxreading = (value, updated, errors)
+
+  def sampletph(self):
+    (tph, t, errors) = self.tphreading
+    try:
+      self.tphreading = (self.device.tph(), time.time(), errors)
+    except Exception as e:
+      self.tphreading = (tph, t, errors + 1)
+      self.logger.warning(f'failed to read temperature ({errors + 1} errors): {e}')
+      return
+    s = self.snapshot()
+    for listener in self.listeners:
+      try:
+        listener(s)
+      except Exception as e:
+        self.logger.warning(f'sampler listener failed: {e}')
+
+  def run(self):
+    self.logger.debug('launch sampler')
+    nextlux = nexttph = time.time()
+    while not self.stopped.is_set():
+      now = time.time()
+      if now >= nextlux:
+        self.samplelux()
+        nextlux = max(nextlux + self.luxinterval, now)
+      if now >= nexttph:
+        self.sampletph()
+        nexttph = max(nexttph + self.tphinterval, now)
+      self.stopped.wait(max(0, min(nextlux, nexttph) - time.time()))
@@ -0,0 +1,267 @@
+import os
+import random
+import selectors
+import threading
+import time
+
+# 子プロセスの監視
+#
+# 監視スレッドがpidfdで子プロセスの終了をすぐに検出し、wake()で制御ループを起こす。
+# 再起動は制御ループから呼ぶpoll()で行う(1回だけ試して待たない)。
+#  prepareがあれば先に別スレッドで呼び(通信など待つもの)、済んだら次のpoll()で再起動する
+#  失敗や短命な終了が続くと間隔を指数的に伸ばす(ゆらぎ付き)
+#  BREAKER回続けて失敗したらCOOLDOWN秒は再起動しない(その後1回だけ試す)
+#  再起動したものがSTABLE秒動いたら失敗の回数を戻して回路を閉じる
+# pidfdが使えない環境ではINTERVAL秒ごとに調べる
+
+# 再起動の間隔(秒)
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 5 * 60
+# この秒数以上動いていたら失敗の回数を戻す
+STABLE = 60
+BREAKER = 6
+COOLDOWN = 10 * 60
+INTERVAL = 0.5
+
+class Child():
+  __slots__ = ('name', 'restart', 'prepare', 'procs', 'started', 'uptime', 'restarts', 'failures', 'due', 'opened',
+    'preparing', 'ready', 'generation')
+
+  def __init__(self, name, restart, prepare=None):
+    self.name = name
+    # 1回だけ起動を試す関数。成功したらSupervisor.started()を呼ぶ
+    self.restart = restart
+    # restartの前に別スレッドで呼ぶ関数(なければNone)
+    self.prepare = prepare
+    self.procs = []
+    self.started = None
+    # 終了した分の稼働時間の合計
+    self.uptime = 0.0
+    self.restarts = 0
+    # 続けて失敗した回数
+    self.failures = 0
+    # 次に再起動する時刻(Noneなら予定なし)
+    self.due = None
+    # 回路が開いた時刻
+    self.opened = None
+    # prepareを実行中か、済んで再起動を待っているか
+    self.preparing = False
+    self.ready = False
+    # started()/stopped()で進める。prepare中に変わったらその再起動はやめる
+    self.generation = 0
+
+class Supervisor():
+  def __init__(self, logger, wake=None):
+    self.logger = logger
+    self.wake = wake
+    self.children = {}
+    self.lock = threading.Lock()
+    self.selector = selectors.DefaultSelector()
+    # 監視対象が変わったら監視スレッドを起こす
+    (self.rpipe, self.wpipe) = os.pipe()
+    os.set_blocking(self.rpipe, False)
+    self.selector.register(self.rpipe, selectors.EVENT_READ)
+    self.pidfds = {}
+    self.pidfd = hasattr(os, 'pidfd_open')
+    self.thread = threading.Thread(target=self.run, name='supervisor', daemon=True)
+
+  def start(self):
+    self.thread.start()
+
+  def add(self, name, restart, prepare=None):
+    with self.lock:
+      self.children[name] = Child(name, restart, prepare)
+
+  # 起動した(procsを監視する)
+  def started(self, name, procs):
+    with self.lock:
+      c = self.children[name]
+      self.account(c)
+      c.procs = [p for p in procs if p is not None]
+      c.started = time.time()
+      c.due = None
+      c.ready = False
+      c.generation += 1
+    self.notify()
+
+  # 意図して止めた(再起動しない)
+  def stopped(self, name):
+    with self.lock:
+      c = self.children[name]
+      self.account(c)
+      c.procs = []
+      c.due = None
+      c.ready = False
+      c.generation += 1
+      c.failures = 0
+      c.opened = None
+    self.notify()
+
+  # 起動に失敗した
+  def failed(self, name, error):
+    with self.lock:
+      c = self.children[name]
+      self.account(c)
+      c.procs = []
+      self.schedule(c, f'failed to start: {error}')
+
+  # 稼働時間を締める
+  def account(self, c):
+    if c.started is not None:
+      c.uptime += time.time() - c.started
+      c.started = None
+
+  # 次の再起動を予定する(lockを持って呼ぶ)
+  def schedule(self, c, reason):
+    if c.opened is not None or c.failures + 1 >= BREAKER:
+      c.failures += 1
+      c.opened = time.time()
+      c.due = c.opened + COOLDOWN
+      self.logger.error(f'{c.name} {reason}, giving up for {COOLDOWN} s ({c.failures} failures)')
+      return
+    delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** c.failures) * random.uniform(0.5, 1.5)
+    c.failures += 1
+    c.due = time.time() + delay
+    self.logger.warning(f'{c.name} {reason}, restarting in {delay:.1f} s ({c.failures} failures)')
+
+  # 子プロセスが終了した(監視スレッド)
+  def died(self, c, proc):
+    if proc not in c.procs:
+      return
+    uptime = time.time() - c.started if c.started is not None else 0
+    self.account(c)
+    # 組の残りも止める
+    for p in c.procs:
+      if p is not proc and p.poll() is None:
+        p.kill()
+    c.procs = []
+    if uptime >= STABLE:
+      c.failures = 0
+      c.opened = None
+    self.schedule(c, f'exited with {proc.poll()} after {uptime:.0f} s')
+    if self.wake is not None:
+      self.wake()
+
+  # STABLE秒動いていたら失敗の回数を戻して回路を閉じる(lockを持って呼ぶ)
+  def settle(self, c, now):
+    if c.started is None or now - c.started < STABLE or (c.failures == 0 and c.opened is None):
+      return
+    if c.opened is not None:
+      self.logger.info(f'{c.name} running for {now - c.started:.0f} s, closing the breaker')
+    c.failures = 0
+    c.opened = None
+
+  # 予定の時刻を過ぎた再起動を行う(制御ループ)
+  #  prepareのあるものはここでは別スレッドで始めるだけで、済んだら次に呼ばれたときに再起動する
+  def poll(self):
+    now = time.time()
+    with self.lock:
+      for c in self.children.values():
+        self.settle(c, now)
+      due = [c for c in self.children.values() if c.due is not None and c.due <= now and not c.preparing]
+      for c in due:
+        c.due = None
+        c.restarts += 1
+      ready = [c for c in self.children.values() if c.ready]
+      for c in ready:
+        c.ready = False
+    for c in due:
+      if c.prepare is None:
+        ready.append(c)
+        continue
+      self.logger.info(f'preparing to restart {c.name} (restart {c.restarts})')
+      c.preparing = True
+      threading.Thread(target=self.preparerun, args=(c, c.generation), name=f'prepare-{c.name}', daemon=True).start()
+    for c in ready:
+      self.logger.info(f'restarting {c.name} (restart {c.restarts})')
+      try:
+        c.restart()
+      except Exception as e:
+        self.failed(c.name, e)
+
+  # prepareを実行する(別スレッド)
+  def preparerun(self, c, generation):
+    try:
+      c.prepare()
+      error = None
+    except Exception as e:
+      error = e
+    with self.lock:
+      c.preparing = False
+      if c.generation != generation:
+        # その間に起動し直したか止めた
+        return
+      if error is None:
+        c.ready = True
+    if error is not None:
+      self.failed(c.name, error)
+    if self.wake is not None:
+      self.wake()
+
+  # {名前: {'running', 'uptime', 'restarts', 'failures', 'open'}}
+  def stats(self):
+    now = time.time()
+    with self.lock:
+      for c in self.children.values():
+        self.settle(c, now)
+      return { c.name: {
+        'running': c.started is not None,
+        'uptime': now - c.started if c.started is not None else 0.0,
+        'total': c.uptime + (now - c.started if c.started is not None else 0.0),
+        'restarts': c.restarts,
+        'failures': c.failures,
+        'open': c.opened is not None } for c in self.children.values() }
+
+  def notify(self):
+    try:
+      os.write(self.wpipe, b'\0')
+    except BlockingIOError:
+      pass
+
+  # 監視対象のpidfdを登録し直す(監視スレッド)
+  def refresh(self):
+    with self.lock:
+      procs = { p: c for c in self.children.values() for p in c.procs }
+    for p in list(self.pidfds):
+      if p not in procs:
+        self.selector.unregister(self.pidfds[p])
+        os.close(self.pidfds.pop(p))
+    for p in procs:
+      if p in self.pidfds:
+        continue
+      try:
+        fd = os.pidfd_open(p.pid)
+      except ProcessLookupError:
+        # もう回収されている
+        with self.lock:
+          self.died(procs[p], p)
+        continue
+      self.pidfds[p] = fd
+      self.selector.register(fd, selectors.EVENT_READ, p)
+
+  def run(self):
+    while True:
+      if not self.pidfd:
+        time.sleep(INTERVAL)
+        with self.lock:
+          for c in list(self.children.values()):
+            for p in list(c.procs):
+              if p.poll() is not None:
+                self.died(c, p)
+        continue
+      self.refresh()
+      for (key, mask) in self.selector.select():
+        if key.fd == self.rpipe:
+          while True:
+            try:
+              os.read(self.rpipe, 4096)
+            except BlockingIOError:
+              break
+          continue
+        p = key.data
+        with self.lock:
+          for c in self.children.values():
+            if p in c.procs:
+              # pidfdが読めるのは終了したとき。returncodeを埋める
+              p.poll()
+              self.died(c, p)
@@ -0,0 +1,172 @@
+import heapq
+import itertools
+import time
+
+import metrics
+
+# 時刻を決めた処理(制御ループで実行する)
+#
+# 予定はmonotonicの時刻の最小ヒープに入れ、制御ループは
+#  parsequeue(min(0.05, timer.timeout()))
+#  timer.run()
+# のように次の予定まで待って、予定の時刻を過ぎたものを実行する。
+#
+# daily()は毎日決まった時刻(ローカル時刻)に実行する
+#  予定はその都度mktimeで求めるので夏時間の切り替えにも追従する
+#  (飛ばされた時刻は切り替え直後、重複した時刻は1回だけ)
+#  時計が飛んだら(NTPの同期など)予定を立て直す
+#   飛び越した予定はGRACE秒以内の遅れなら実行し、それより遅ければ飛ばす
+#   戻ったときに同じ予定を2回実行しないよう、実行した予定以前のものはREFIRE秒以内には実行しない
+# every()は一定間隔(monotonic)で実行する。時計が飛んでも影響しない
+
+# 時計が飛んだとみなす差(秒)
+JUMP = 2.0
+GRACE = 15 * 60
+REFIRE = 12 * 60 * 60
+
+class Job():
+  __slots__ = ('name', 'fn', 'at', 'interval', 'due', 'wall', 'last', 'fired', 'runs', 'skipped', 'late', 'maxlate', 'lateness')
+
+  def __init__(self, name, fn, at=None, interval=None):
+    self.name = name
+    self.fn = fn
+    # (時, 分)(daily)か秒数(every)
+    self.at = at
+    self.interval = interval
+    # 次に実行するmonotonicの時刻
+    self.due = None
+    # dailyの予定のepoch秒
+    self.wall = None
+    # 最後に実行したdailyの予定のepoch秒
+    self.last = None
+    # 最後に実行したmonotonicの時刻
+    self.fired = None
+    self.runs = 0
+    self.skipped = 0
+    # 最後と最大の遅れ(秒)
+    self.late = None
+    self.maxlate = 0.0
+    self.lateness = metrics.histogram('room_timer_lateness_seconds', 'timer jobs from their deadline to their start', job=name)
+
+class Timer():
+  def __init__(self, logger):
+    self.logger = logger
+    self.jobs = {}
+    # (due, 順番, job) 予定を変えたものは古い項目が残るので、job.dueと比べて捨てる
+    self.heap = []
+    self.seq = itertools.count()
+    self.offset = self.clockoffset()
+
+  def clockoffset(self):
+    return time.time() - time.monotonic()
+
+  # 毎日at('HH:MM'、ローカル時刻)にfnを実行する
+  def daily(self, name, at, fn):
+    (hour, minute) = (int(v) for v in at.split(':'))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+      raise ValueError(f'bad time of day: {at}')
+    job = self.jobs[name] = Job(name, fn, at=(hour, minute))
+    self.plan(job, time.time())
+    return job
+
+  # seconds秒ごとにfnを実行する(最初はseconds秒後)
+  def every(self, name, seconds, fn):
+    job = self.jobs[name] = Job(name, fn, interval=seconds)
+    self.push(job, time.monotonic() + seconds)
+    return job
+
+  def push(self, job, due):
+    job.due = due
+    heapq.heappush(self.heap, (due, next(self.seq), job))
+
+  # nowより後の次のat(epoch秒)
+  def nextwall(self, job, now):
+    t = time.localtime(now)
+    day = 0
+    while True:
+      # tm_isdst=-1で夏時間かどうかはmktimeに決めさせる(存在しない時刻は後ろにずれる)
+      wall = time.mktime((t.tm_year, t.tm_mon, t.tm_mday + day, job.at[0], job.at[1], 0, 0, 0, -1))
+      if wall > now:
+        return wall
+      day += 1
+
+  # dailyの次の予定を立てる
+  def plan(self, job, now):
+    job.wall = self.nextwall(job, now)
+    self.push(job, time.monotonic() + job.wall - now)
+
+  # 次の予定までの秒数(予定がなければNone)
+  def timeout(self):
+    self.checkclock()
+    while self.heap and self.heap[0][2].due != self.heap[0][0]:
+      heapq.heappop(self.heap)
+    if not self.heap:
+      return None
+    return max(0.0, self.heap[0][0] - time.monotonic())
+
+  # 時計が飛んでいたらdailyの予定を立て直す
+  def checkclock(self):
+    offset = self.clockoffset()
+    jump = offset - self.offset
+    if abs(jump) < JUMP:
+      return
+    self.offset = offset
+    now = time.time()
+    self.logger.warning(f'wall clock jumped by {jump:+.0f} s, replanning timers')
+    for job in self.jobs.values():
+      if job.at is None:
+        continue
+      if job.wall <= now and now - job.wall <= GRACE:
+        # 飛び越したが遅れは許せる範囲なので、すぐに実行する
+        self.push(job, time.monotonic() - (now - job.wall))
+        continue
+      if job.wall <= now:
+        job.skipped += 1
+        self.logger.warning(f'skipped {job.name} at {time.ctime(job.wall)} ({now - job.wall:.0f} s ago)')
+      self.plan(job, now)
+
+  # 予定の時刻を過ぎたものを実行する(制御ループから呼ぶ)
+  def run(self):
+    self.checkclock()
+    while self.heap and self.heap[0][0] <= time.monotonic():
+      (due, seq, job) = heapq.heappop(self.heap)
+      if job.due != due:
+        continue
+      now = time.monotonic()
+      if job.at is not None:
+        # 次の予定は実行する前に立てる(実行中に時刻をまたいでも1回だけ)
+        wall = job.wall
+        self.plan(job, max(time.time(), wall))
+        if job.last is not None and wall <= job.last and now - job.fired < REFIRE:
+          # 時計が戻って同じ予定がもう一度来た
+          job.skipped += 1
+          self.logger.warning(f'skipped {job.name} at {time.ctime(wall)}, already ran {now - job.fired:.0f} s ago')
+          continue
+        job.last = wall
+      else:
+        # 遅れても間隔は詰めない
+        self.push(job, max(due + job.interval, now))
+      self.fire(job, now - due)
+
+  def fire(self, job, late):
+    job.fired = time.monotonic()
+    job.runs += 1
+    job.late = late
+    job.maxlate = max(job.maxlate, late)
+    job.lateness.observe(late)
+    if job.at is not None:
+      self.logger.info(f'timer {job.name} fired {late * 1000:.0f} ms late')
+    try:
+      job.fn()
+    except Exception:
+      self.logger.exception(f'timer {job.name} failed')
+
+  # {名前: {'next', 'runs', 'skipped', 'late', 'maxlate'}} nextはepoch秒
+  def stats(self):
+    offset = self.clockoffset()
+    return { job.name: {
+      'next': job.due + offset if job.due is not None else None,
+      'runs': job.runs,
+      'skipped': job.skipped,
+      'late': job.late,
+      'maxlate': job.maxlate } for job in self.jobs.values() }
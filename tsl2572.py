@@ -19,14 +19,27 @@ class TSL2572:
     ATIME_200MS = 0xB6
     ATIME_600MS = 0x24
 
+    # again/atime pairs of the auto range, least sensitive first
+    RANGES = [
+        (AGAIN_0_16, ATIME_50MS),
+        (AGAIN_1, ATIME_200MS),
+        (AGAIN_8, ATIME_200MS),
+        (AGAIN_120, ATIME_200MS),
+        (AGAIN_120, ATIME_600MS),
+    ]
+
     def __init__(self, i2c_addr):
         self.i2c_addr = i2c_addr
         self.i2c = smbus.SMBus(1)
         self.ch0 = 0
         self.ch1 = 0
         self.lux = 0
-        self.again = TSL2572.AGAIN_8
+        self.again = TSL2572.AGAIN_1      # Remembered between measurements
         self.atime = TSL2572.ATIME_200MS
+        self.integrating = False
+        self.continuous = False
+        self.started = 0                  # time.time() of start()
+        self.updated = 0                  # time.time() of the last lux
 
     # I2C read length byte from addr
     def read_address(self, addr, length):
@@ -77,32 +90,105 @@ class TSL2572:
         return avalid, aint
 
 
-    # One time ALS integration and update ch0 and ch1
-    def als_integration(self):
+    # Clear ALS interrupt (AINT) so the next one means new data
+    def clear_int(self):
+        self.i2c.write_byte(self.i2c_addr, 0xE6)
+
+    # Integration time in seconds, 2.73ms per ADC cycle
+    def integration_time(self):
+        return (256 - self.atime) * 0.00273
+
+    # Full scale count of the current atime
+    def max_count(self):
+        return min(65535, (256 - self.atime) * 1024)
+
+    # Start ALS integration with again/atime without waiting
+    #  continuous keeps the ALS running, poll() then picks up every cycle
+    def start(self, continuous=False):
         self.write_address(0x0, [0x1])    # Stop ALS integration
         self.set_again(self.again)
         self.set_atime(self.atime)
-        self.write_address(0x0, [0x3])     # Start ALS integration
-
-        # Check status every 10ms
-        while True:
-            avalid, aint = self.read_status()
-            if avalid==1 and aint==1:
-                self.write_address(0x0, [0x1])    # Stop ALS integration
-                break
-            else:
-                time.sleep(0.01)
+        self.clear_int()
+        self.write_address(0x0, [0x3])    # Start ALS integration
+        self.continuous = continuous
+        self.integrating = True
+        self.started = time.time()
+
+    # Check for a finished integration and update ch0, ch1 and lux
+    #  Return True if lux has been updated, never waits
+    def poll(self):
+        if not self.integrating:
+            return False
+        elapsed = time.time() - max(self.started, self.updated)
+        if elapsed < self.integration_time():
+            return False
+        avalid, aint = self.read_status()
+        if not (avalid==1 and aint==1):
+            if elapsed > self.integration_time() * 4 + 1:
+                # Lost the sensor (IOError reads as zero), start over
+                self.start(self.continuous)
+            return False
 
         data = self.read_address(0x14, 4)
         self.ch0 = (data[1] << 8) | data[0]
         self.ch1 = (data[3] << 8) | data[2]
 
-    # One time lux measurement
-    #  Run ALS integration with auto again/atime and calculate lux
-    #  Select below again/atime automatically based on default measurement result
+        current = (self.again, self.atime)
+        target = self.auto_range()
+        if target is None:
+            # Out of range, integrate again with the new again/atime
+            self.start(self.continuous)
+            return False
+
+        self.calc_lux()
+        self.updated = time.time()
+        (self.again, self.atime) = target
+        if self.continuous:
+            if target != current:
+                self.start(True)
+            else:
+                self.clear_int()
+        else:
+            self.write_address(0x0, [0x0])    # Sleep
+            self.integrating = False
+        return True
+
+    # Select again/atime from ch0/ch1
+    #  Scaled to gain 1, 200ms the thresholds are those of the table in
+    #  meas_single().  Return the again/atime for the next measurement,
+    #  or None (after setting again/atime) if this one has to be redone:
+    #  when it is saturated, or too dark to use and a higher gain is due
+    def auto_range(self):
+        count = max([self.ch0, self.ch1])
+        if count >= self.max_count():
+            if (self.again, self.atime) == TSL2572.RANGES[0]:
+                return TSL2572.RANGES[0]
+            (self.again, self.atime) = TSL2572.RANGES[0]
+            return None
+
+        c = count / self.scale()
+        if c >= 65535:
+            target = TSL2572.RANGES[0]
+        elif c < 100:
+            target = TSL2572.RANGES[4]
+        elif c < 300:
+            target = TSL2572.RANGES[3]
+        elif c < 3000:
+            target = TSL2572.RANGES[2]
+        else:
+            target = TSL2572.RANGES[1]
+
+        if target != (self.again, self.atime) and count < 100:
+            (self.again, self.atime) = target
+            return None
+        return target
+
+    # Blocking lux measurement
+    #  Auto range with again/atime selected as below, starting from the
+    #  last measurement's so a steady light needs one integration
     #  again, atime, scale, max count
     #   0.16,    50,  0.04,     19456
-    #      1,   200,     1,     65535  (Default)
+    #      1,   200,     1,     65535  (First)
     #      8,   200,     8,     65535
     #    120,   200,   120,     65535
     #    120,   600,   360,     65535
@@ -110,48 +196,53 @@ class TSL2572:
         if not self.id_read():
             return False
 
-        self.again = TSL2572.AGAIN_1
-        self.atime = TSL2572.ATIME_200MS
-        self.als_integration()
-        if max([self.ch0, self.ch1]) == 65535:
-            self.again = TSL2572.AGAIN_0_16
-            self.atime = TSL2572.ATIME_50MS
-            self.als_integration()
-        elif max([self.ch0, self.ch1]) < 100:
-            self.again = TSL2572.AGAIN_120
-            self.atime = TSL2572.ATIME_600MS
-            self.als_integration()
-        elif max([self.ch0, self.ch1]) < 300 :
-            self.again = TSL2572.AGAIN_120
-            self.atime = TSL2572.ATIME_200MS
-            self.als_integration()
-        elif max([self.ch0, self.ch1]) < 3000:
-            self.again = TSL2572.AGAIN_8
-            self.atime = TSL2572.ATIME_200MS
-            self.als_integration()
-        self.write_address(0x0, [0x0])    # Sleep
-        self.calc_lux()
+        self.start()
+        deadline = time.time() + 5
+        while not self.poll():
+            if time.time() > deadline:
+                self.write_address(0x0, [0x0])    # Sleep
+                self.integrating = False
+                return False
+            time.sleep(0.01)
         return True
 
-    # Calculate lux from ch0/ch0 then update lux
-    def calc_lux(self):
+    # Continuous lux measurement
+    #  The ALS runs on its own, read() returns the latest lux without waiting
+    def start_continuous(self):
+        self.start(continuous=True)
+
+    def read(self):
+        self.poll()
+        return self.lux
+
+    # again * atime relative to gain 1, 200ms
+    def scale(self):
+        return self.gain() * self.atime_ms() / 200
+
+    def atime_ms(self):
         if TSL2572.ATIME_50MS == self.atime:
-            t = 50
+            return 50
         elif TSL2572.ATIME_200MS == self.atime:
-            t = 200
+            return 200
         elif TSL2572.ATIME_600MS == self.atime:
-            t = 600
+            return 600
 
+    def gain(self):
         if TSL2572.AGAIN_0_16 == self.again:
-            g = 0.16
+            return 0.16
         elif TSL2572.AGAIN_1 == self.again:
-            g = 1
+            return 1
         elif TSL2572.AGAIN_8 == self.again:
-            g = 8
+            return 8
         elif TSL2572.AGAIN_16 == self.again:
-            g = 16
+            return 16
         elif TSL2572.AGAIN_120 == self.again:
-            g = 120
+            return 120
+
+    # Calculate lux from ch0/ch0 then update lux
+    def calc_lux(self):
+        t = self.atime_ms()
+        g = self.gain()
 
         cpl = (t * g)/60
         lux1 = (self.ch0 - 1.87*self.ch1) / cpl